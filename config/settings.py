@@ -26,10 +26,26 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.environ.get('SECRET_KEY')
 
+# Settings profile: 'prod' (lean middleware, persistent connections, cached templates),
+# 'bench' (prod stack for local benchmarks) or 'dev' (debug toolbar, media serving).
+# Deployments that set nothing get prod, dev has to be chosen with SETTINGS_PROFILE=dev.
+def env_bool(name, default):
+    """Boolean environment variable, '1', 'true' or 'yes' (any case) are true."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', )
+
+
+SETTINGS_PROFILE = os.environ.get('SETTINGS_PROFILE', 'prod')
+PROD_PROFILES = ['prod', 'bench', ]
+
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = os.environ.get('DEBUG')
+DEBUG = env_bool('DEBUG', SETTINGS_PROFILE == 'dev')
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [host for host in os.environ.get('ALLOWED_HOSTS', '').split(',') if host]
+if SETTINGS_PROFILE == 'bench':
+    ALLOWED_HOSTS += ['127.0.0.1', 'localhost', 'testserver', ]
 
 
 # Application definition
@@ -47,7 +63,6 @@ INSTALLED_APPS = [
     'django_filters',
 
     # local apps
-    'debug_toolbar',
     'rest_framework',
     'djoser',
     'core',
@@ -55,8 +70,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    "debug_toolbar.middleware.DebugToolbarMiddleware",
+    'shop.middleware.SlowQueryMiddleware',
+    'shop.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'django.middleware.gzip.GZipMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -65,10 +82,73 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+if SETTINGS_PROFILE == 'dev':
+    INSTALLED_APPS.insert(INSTALLED_APPS.index('rest_framework'), 'debug_toolbar')
+    # As early as possible, but after middleware that encodes the response
+    MIDDLEWARE.insert(MIDDLEWARE.index('django.middleware.gzip.GZipMiddleware') + 1,
+                      "debug_toolbar.middleware.DebugToolbarMiddleware")
+
 INTERNAL_IPS = [
     "127.0.0.1",
 ]
 
+# Best seller / top rated / trending listings, see shop/rankings.py
+SHOP_RANKINGS = {
+    'TRENDING_HALF_LIFE_DAYS': 7,
+    'RATING_PRIOR_COUNT': 10,
+    'RATING_PRIOR_MEAN': 3.0,
+}
+
+# Per view latency / SQL metrics exposed on /shop/metrics/
+# Scrapers are let in by address or with `Authorization: Bearer <TOKEN>`. Behind a reverse proxy
+# on the same host every client comes from 127.0.0.1, so the prod profiles trust no address by default.
+SHOP_METRICS = {
+    'SAMPLE_RATE': float(os.environ.get('METRICS_SAMPLE_RATE', 1.0)),
+    'ALLOWED_IPS': [
+        ip for ip in os.environ.get('METRICS_ALLOWED_IPS', '' if SETTINGS_PROFILE in PROD_PROFILES else ','.join(INTERNAL_IPS)).split(',')
+        if ip
+    ],
+    'TOKEN': os.environ.get('METRICS_TOKEN', ''),
+}
+
+# Queries slower than the threshold are stored per fingerprint, see `manage.py slow_queries`
+SHOP_SLOW_QUERIES = {
+    'ENABLED': True,
+    'THRESHOLD_MS': float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 100)),
+    'EXPLAIN': env_bool('SLOW_QUERY_EXPLAIN', False),
+}
+
+# Side effects of catalog and order changes, see shop/outbox.py. INLINE applies them right
+# after the commit in the request. It stays on in every profile until OUTBOX_INLINE=false
+# is set on a deployment that runs `manage.py run_outbox`.
+SHOP_OUTBOX = {
+    'INLINE': env_bool('OUTBOX_INLINE', True),
+    'BATCH_SIZE': 500,
+    'LEASE_SECONDS': 60,
+    'MAX_BACKOFF_SECONDS': 600,
+}
+
+# Responses replayed for retried writes sent with an Idempotency-Key header, see
+# shop/idempotency.py. Larger responses are not stored, expired ones are deleted by the
+# purge_idempotency_keys task of SHOP_TASKS['PERIODIC'].
+SHOP_IDEMPOTENCY = {
+    'TTL_SECONDS': 60 * 60 * 24,
+    'MAX_BODY_BYTES': 64 * 1024,
+}
+
+# Deferred work queued with shop.tasks, run by `manage.py run_tasks`. EAGER runs the tasks
+# right after the commit in the request instead, the default until TASKS_EAGER=false is set
+# on a deployment that runs the worker. PERIODIC
+# tasks are queued by `manage.py enqueue_periodic_tasks`, run it from cron (e.g. hourly).
+SHOP_TASKS = {
+    'EAGER': env_bool('TASKS_EAGER', True),
+    'BATCH_SIZE': 100,
+    'LEASE_SECONDS': 300,
+    'MAX_BACKOFF_SECONDS': 3600,
+    'CART_MAX_AGE_DAYS': 30,
+    'PERIODIC': ['purge_stale_carts', 'purge_idempotency_keys', ],
+}
+
 ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
@@ -87,6 +167,16 @@ TEMPLATES = [
     },
 ]
 
+if SETTINGS_PROFILE in PROD_PROFILES:
+    # Templates (admin, browsable API) are compiled once per process
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 WSGI_APPLICATION = 'config.wsgi.application'
 
 
@@ -104,6 +194,72 @@ DATABASES = {
     }
 }
 
+if SETTINGS_PROFILE in PROD_PROFILES:
+    # Reuse connections between requests and drop the ones the server closed
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('CONN_MAX_AGE', 60))
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+# Read replicas: REPLICA_HOSTS for server databases, REPLICA_DB_NAMES to try it locally
+# with extra SQLite files. Safe requests of catalog viewsets read from them.
+REPLICA_DATABASES = []
+for index, host in enumerate(host for host in os.environ.get('REPLICA_HOSTS', '').split(',') if host):
+    REPLICA_DATABASES.append(f'replica_{index}')
+    DATABASES[f'replica_{index}'] = dict(DATABASES['default'], HOST=host, TEST={'MIRROR': 'default'})
+for index, name in enumerate(name for name in os.environ.get('REPLICA_DB_NAMES', '').split(',') if name):
+    REPLICA_DATABASES.append(f'replica_local_{index}')
+    DATABASES[f'replica_local_{index}'] = dict(DATABASES['default'], NAME=name, TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['shop.db_routers.ReplicaRouter', ]
+
+SHOP_REPLICAS = {
+    'DATABASES': REPLICA_DATABASES,
+    # Users and carts read from the primary for this long after a write
+    'STICKY_SECONDS': int(os.environ.get('REPLICA_STICKY_SECONDS', 10)),
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+        }
+    }
+elif os.environ.get('MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': os.environ.get('MEMCACHED_LOCATION'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Write budgets, see shop/throttling.py. 'local_bucket' keeps token buckets in the process
+# (single node), 'cache_window' shares sliding window counters through the cache above (several nodes).
+SHOP_THROTTLE = {
+    'ENABLED': env_bool('THROTTLE_ENABLED', True),
+    'BACKEND': os.environ.get(
+        'THROTTLE_BACKEND',
+        'cache_window' if CACHES['default']['BACKEND'].endswith(('RedisCache', 'PyMemcacheCache', )) else 'local_bucket',
+    ),
+    # Per `throttle_scope`: burst of `capacity` requests, refilled at `rate`
+    # ('cache_window': `capacity` requests per `capacity / rate`)
+    'BUDGETS': {
+        'carts': {'capacity': 10, 'rate': '30/hour'},
+        'cart_items': {'capacity': 30, 'rate': '10/min'},
+        'comments': {'capacity': 5, 'rate': '20/hour'},
+        'reviews': {'capacity': 5, 'rate': '20/hour'},
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -149,8 +305,17 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING': False,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        'core.authentication.CachedJWTAuthentication',
+    ),
+    'DEFAULT_THROTTLE_CLASSES': (
+        'shop.throttling.WriteBudgetThrottle',
+    ),
+}
+
+# Seconds a token's user is served from the cache instead of the database, see
+# core/authentication.py. Saving or deleting the user drops it right away.
+SHOP_AUTH = {
+    'USER_CACHE_SECONDS': int(os.environ.get('AUTH_USER_CACHE_SECONDS', 300)),
 }
 
 from datetime import timedelta
@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+
+USER_CACHE_KEY = 'core:user:{user_id}'
+# Fields the request path reads, the others (password included) load on first access
+CACHED_USER_FIELDS = ['id', 'username', 'is_active', 'is_staff', 'is_superuser', ]
+
+
+def get_user_cache_key(user_id):
+    return USER_CACHE_KEY.format(user_id=user_id)
+
+
+def invalidate_cached_user(user_id):
+    cache.delete(get_user_cache_key(user_id))
+
+
+def cache_user(user):
+    values = {field: getattr(user, field) for field in CACHED_USER_FIELDS}
+    # The digest the revoke claim of the token is compared with, never the password hash itself
+    values['password_digest'] = get_md5_hash_password(user.password) if api_settings.CHECK_REVOKE_TOKEN else None
+    cache.set(get_user_cache_key(user.pk), values, getattr(settings, 'SHOP_AUTH', {}).get('USER_CACHE_SECONDS', 300))
+
+
+def load_cached_user(values):
+    """A user instance with the cached fields, the deferred ones are fetched if something reads them."""
+    return get_user_model().from_db('default', CACHED_USER_FIELDS, [values[field] for field in CACHED_USER_FIELDS])
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that keeps the user of a token in the cache for a short while.
+
+    Saves the user query of every authenticated request. Only the fields the checks and the
+    views need are cached, not the password hash. The cached user is dropped when the user
+    is saved or deleted (see core/signals.py) and expires after
+    SHOP_AUTH['USER_CACHE_SECONDS'], which bounds how stale it gets after a queryset update().
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        values = cache.get(get_user_cache_key(user_id))
+        if values is None:
+            user = super().get_user(validated_token)
+            cache_user(user)
+            return user
+
+        # Same checks as JWTAuthentication.get_user, on the cached fields
+        if not values['is_active']:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != values['password_digest']:
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return load_cached_user(values)
@@ -1,3 +1,38 @@
+from django.core.cache import cache
 from django.test import TestCase
+from rest_framework_simplejwt.tokens import AccessToken
 
-# Create your tests here.
+from .authentication import get_user_cache_key
+from .models import CustomUser
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user('reader', 'reader@example.com', 'password', first_name='Reza')
+        self.auth = f'JWT {AccessToken.for_user(self.user)}'
+
+    def get_me(self):
+        return self.client.get('/auth/users/me/', HTTP_AUTHORIZATION=self.auth, HTTP_ACCEPT='application/json')
+
+    def test_password_hash_is_not_cached(self):
+        self.get_me()
+
+        cached = cache.get(get_user_cache_key(self.user.pk))
+        self.assertNotIn('password', cached)
+        self.assertNotIn(self.user.password, cached.values())
+
+    def test_cached_user_loads_the_other_fields_lazily(self):
+        self.get_me()
+        response = self.get_me()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['email'], 'reader@example.com')
+        self.assertEqual(response.json()['first_name'], 'Reza')
+
+    def test_deactivated_user_is_rejected(self):
+        self.get_me()
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertEqual(self.get_me().status_code, 401)
@@ -1,19 +1,41 @@
+from .bulk_updates import apply_discount, remove_discount, set_quantity, adjust_price
 from .models import *
+from .moderation import moderate_comments
+from .paginations import EstimatedCountPaginator
 
 from dal import autocomplete
 
 from datetime import timedelta
 
 from django import forms
-from django.contrib import admin
-from django.db.models import Count, Prefetch
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.html import format_html
 from django.utils.http import urlencode
 
 from typing import Any
 
 
+def count_related(model, field_name):
+    """
+    Number of `model` rows pointing at the outer row through `field_name`, as a correlated subquery.
+
+    Unlike Count() over joins it needs no GROUP BY or DISTINCT and is only
+    evaluated for the rows of the changelist page.
+    """
+    counts = model.objects\
+        .filter(**{field_name: OuterRef('pk')})\
+        .order_by()\
+        .values(field_name)\
+        .annotate(count=Count('pk'))\
+        .values('count')
+    return Coalesce(Subquery(counts), 0)
+
+
 class CommentStatusFilter(admin.SimpleListFilter):
     WAITING        = 'Waiting'
     APPROVED       = 'Approved'
@@ -131,8 +153,7 @@ class CategoryAdmin(admin.ModelAdmin):
 
     def get_queryset(self, request):
         return super().get_queryset(request) \
-                      .prefetch_related('products') \
-                      .annotate(num_of_products=Count('products'))
+                      .annotate(num_of_products=count_related(Product, 'category'))
     
     @admin.display(description='# products', ordering='num_of_products')
     def num_of_products(self, category: Category):
@@ -159,8 +180,7 @@ class SubCategoryAdmin(admin.ModelAdmin):
 
     def get_queryset(self, request):
         return super().get_queryset(request) \
-                      .prefetch_related('products') \
-                      .annotate(num_of_products=Count('products'))
+                      .annotate(num_of_products=count_related(Product, 'subcategory'))
     
     @admin.display(description='# products', ordering='num_of_products')
     def num_of_products(self, subcategory: SubCategory):
@@ -216,6 +236,9 @@ class ProductAdmin(admin.ModelAdmin):
     inlines       = [ImageInLine, ]
     form          = ProductAdminForm
     list_per_page = 20
+    list_select_related    = ['category', 'subcategory', ]
+    paginator              = EstimatedCountPaginator
+    show_full_result_count = False
 
     prepopulated_fields = {
         'slug': ['title', ]
@@ -260,11 +283,9 @@ class ProductAdmin(admin.ModelAdmin):
     
     def get_queryset(self, request):
         return super().get_queryset(request) \
-                      .prefetch_related(Prefetch("attributes", queryset=ProductAttribute.objects.select_related("variable", "discount"))) \
-                      .prefetch_related("comments") \
-                      .annotate(attributes_count=Count('attributes', distinct=True), 
-                                comments_count=Count('comments', distinct=True), 
-                                reviews_count=Count('reviews', distinct=True)) \
+                      .annotate(attributes_count=count_related(ProductAttribute, 'product'), 
+                                comments_count=count_related(Comment, 'product'), 
+                                reviews_count=count_related(ProductReview, 'product'))
 
     def save_model(self, request, obj: Product, form, change):
         subcategories = obj.subcategory.id
@@ -283,13 +304,91 @@ class ProductAttributeAdminForm(forms.ModelForm):
         fields = ["title", "product", "variable", "price", "quantity", "total_sold", "discount", "discount_active", ]
 
 
+class ProductAttributeActionForm(ActionForm):
+    discount = forms.ModelChoiceField(queryset=Discount.objects.all(), required=False)
+    value    = forms.IntegerField(required=False, help_text='Quantity, or price change in percent')
+
+
 @admin.register(ProductAttribute)
 class ProductAttributeAdmin(admin.ModelAdmin):
     form                = ProductAttributeAdminForm
-    list_display        = ["id", "title", "product", "variable", "price", "total_sold", "quantity", "discounted_price", "discount_amount", "discount_active", ]
+    list_display        = ["id", "title", "product", "variable", "price", "total_sold", "quantity", "discounted_price", "discount_amount", "discount_active", "discount_schedule", ]
     list_filter         = ['datetime_created', DiscountActiveFilter, QuantityFilter, ]
     autocomplete_fields = ["product", ]
     list_editable = ["price", "quantity", ]
+    list_select_related    = ["product", "variable", ]
+    paginator              = EstimatedCountPaginator
+    show_full_result_count = False
+    action_form            = ProductAttributeActionForm
+    actions                = ['apply_discount', 'remove_discount', 'set_quantity', 'adjust_price', ]
+
+    def report_action_form_errors(self, request, form):
+        for field, errors in form.errors.items():
+            self.message_user(request, f"{field.capitalize()}: {' '.join(errors)}", messages.ERROR)
+
+    def get_action_form(self, request):
+        form = self.action_form(request.POST, auto_id=None)
+        form.fields['action'].choices = self.get_action_choices(request)
+        return form
+
+    def response_action(self, request, queryset):
+        # The admin reports any invalid action form as "No action selected.", the errors of
+        # the discount and value fields are shown instead
+        form = self.get_action_form(request)
+        if not form.is_valid() and 'action' not in form.errors:
+            self.report_action_form_errors(request, form)
+            return None
+        return super().response_action(request, queryset)
+
+    def get_action_value(self, request, name, missing_message):
+        """The cleaned `name` field of the action form, or None after telling the admin what is wrong."""
+        form = self.get_action_form(request)
+        if not form.is_valid():
+            self.report_action_form_errors(request, form)
+            return None
+
+        value = form.cleaned_data.get(name)
+        if value is None:
+            self.message_user(request, missing_message, messages.ERROR)
+        return value
+
+    @admin.action(description='Apply the chosen discount to selected attributes')
+    def apply_discount(self, request, queryset):
+        discount = self.get_action_value(request, 'discount', 'Choose a discount to apply.')
+        if discount is None:
+            return
+        updated = apply_discount(queryset, discount)
+        if discount.is_running():
+            self.message_user(request, f'{discount}% discount was applied to {updated} attributes.')
+        else:
+            self.message_user(request, f'{discount}% discount was attached to {updated} attributes, it applies during its campaign.')
+
+    @admin.action(description='Remove discount of selected attributes')
+    def remove_discount(self, request, queryset):
+        updated = remove_discount(queryset)
+        self.message_user(request, f'Discount was removed from {updated} attributes.')
+
+    @admin.action(description='Set quantity of selected attributes to value')
+    def set_quantity(self, request, queryset):
+        quantity = self.get_action_value(request, 'value', 'Enter a quantity of 0 or more.')
+        if quantity is None:
+            return
+        if quantity < 0:
+            self.message_user(request, 'Enter a quantity of 0 or more.', messages.ERROR)
+            return
+        updated = set_quantity(queryset, quantity)
+        self.message_user(request, f'Quantity of {updated} attributes was set to {quantity}.')
+
+    @admin.action(description='Change price of selected attributes by value percent')
+    def adjust_price(self, request, queryset):
+        percent = self.get_action_value(request, 'value', 'Enter a percent greater than -100.')
+        if percent is None:
+            return
+        if percent <= -100:
+            self.message_user(request, 'Enter a percent greater than -100.', messages.ERROR)
+            return
+        updated = adjust_price(queryset, percent)
+        self.message_user(request, f'Price of {updated} attributes was changed by {percent}%.')
 
 
 @admin.register(Image)
@@ -301,20 +400,37 @@ class ImageAdmin(admin.ModelAdmin):
 
 @admin.register(Comment)
 class CommentAdmin(admin.ModelAdmin):
-    list_display        = ['id', 'user', 'product', 'body', 'status', 'datetime_created', 'datetime_modified', ]
-    list_filter         = [CommentStatusFilter, ]
-    autocomplete_fields = ['product', ]
+    list_display           = ['id', 'user', 'product', 'body', 'status', 'datetime_created', 'datetime_modified', ]
+    list_filter            = [CommentStatusFilter, ]
+    list_select_related    = ['user', 'product', ]
+    paginator              = EstimatedCountPaginator
+    show_full_result_count = False
+    autocomplete_fields    = ['product', ]
+    actions                = ['approve_comments', 'reject_comments', ]
+
+    @admin.action(description='Approve selected comments')
+    def approve_comments(self, request, queryset):
+        updated = moderate_comments(queryset, Comment.COMMENT_STATUS_APPROVED)
+        self.message_user(request, f'{updated} comments were approved.')
+
+    @admin.action(description='Reject selected comments')
+    def reject_comments(self, request, queryset):
+        updated = moderate_comments(queryset, Comment.COMMENT_STATUS_NOT_APPROVED)
+        self.message_user(request, f'{updated} comments were rejected.')
 
 
 @admin.register(ProductReview)
 class ProductReviewAdmin(admin.ModelAdmin):
-    list_display        = ["id", "user", "product", "review_rating", "datetime_created", "datetime_modified", ]
-    autocomplete_fields = ['product', ]
+    list_display           = ["id", "user", "product", "review_rating", "datetime_created", "datetime_modified", ]
+    list_select_related    = ['user', 'product', ]
+    autocomplete_fields    = ['product', ]
+    paginator              = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Discount)
 class DiscountAdmin(admin.ModelAdmin):
-    list_display = ['id', 'discount', 'description', 'datetime_created', 'datetime_modified', ]
+    list_display = ['id', 'discount', 'description', 'starts_at', 'ends_at', 'datetime_created', 'datetime_modified', ]
     
 
 @admin.register(Variable)
@@ -326,11 +442,13 @@ class VariableAdmin(admin.ModelAdmin):
 @admin.register(Wishlist)
 class WishlistAdmin(admin.ModelAdmin):
     list_display = ['id', 'user', 'datetime_created', 'datetime_modified', ]
+    list_select_related = ['user', ]
 
 
 @admin.register(WishlistItem)
 class WishlistItemAdmin(admin.ModelAdmin):
     list_display = ["id", "wish_list", "product", "datetime_created", "datetime_modified", ]
+    list_select_related = ["wish_list", "product", ]
 
 
 class ShippingMethodForm(forms.ModelForm):
@@ -386,6 +504,8 @@ class CartItemInLine(admin.TabularInline):
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
     list_display = ["id", "num_of_items", "datetime_created", "datetime_modified", ]
+    paginator              = EstimatedCountPaginator
+    show_full_result_count = False
 
     @admin.display(description='# items', ordering='items_count')
     def num_of_items(self, cart: Cart):
@@ -400,14 +520,15 @@ class CartAdmin(admin.ModelAdmin):
     
     def get_queryset(self, request):
         return super().get_queryset(request) \
-                      .prefetch_related('items') \
-                      .annotate(items_count=Count('items')) \
+                      .annotate(items_count=count_related(CartItem, 'cart'))
 
 
 @admin.register(CartItem)
 class CartItemAdmin(admin.ModelAdmin):
     list_display = ['id', 'cart', 'product', 'quantity', 'datetime_created', 'datetime_modified', ]
     list_editable = ['quantity', ]
+    paginator              = EstimatedCountPaginator
+    show_full_result_count = False
 
     def get_queryset(self, request):
         return super().get_queryset(request)\
@@ -441,6 +562,9 @@ class OrderAdmin(admin.ModelAdmin):
                     ]
     list_filter = [OrderPaidStatusFilter, OrderStatusFilter, ]
     search_fields = ["number", "receiver_name", "receiver_family", ]
+    list_select_related    = ["user", "shipping_method", ]
+    paginator              = EstimatedCountPaginator
+    show_full_result_count = False
 
     @admin.display(description='# items', ordering='items_count')
     def num_of_items(self, order: Order):
@@ -455,8 +579,7 @@ class OrderAdmin(admin.ModelAdmin):
     
     def get_queryset(self, request):
         return super().get_queryset(request) \
-                      .prefetch_related('items') \
-                      .annotate(items_count=Count('items')) \
+                      .annotate(items_count=count_related(OrderItem, 'order'))
 
 
 @admin.register(OrderItem)
@@ -473,3 +596,34 @@ class OrderItemAdmin(admin.ModelAdmin):
                     "discount_active", 
                     "datetime_created", 
                     "datetime_modified", ]
+    list_select_related    = ["order", "product", ]
+    paginator              = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(SlowQuery)
+class SlowQueryAdmin(admin.ModelAdmin):
+    list_display = ["id", "url_name", "call_site", "count", "total_duration", "max_duration", "normalized_sql", "datetime_modified", ]
+    list_filter = ["url_name", ]
+    search_fields = ["normalized_sql", "call_site", ]
+    readonly_fields = ["fingerprint", "url_name", "call_site", "normalized_sql", "sample_sql", "count", "total_duration", "max_duration", "explain", ]
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ["id", "topic", "object_id", "attempts", "available_at", "datetime_created", ]
+    list_filter = ["topic", ]
+    readonly_fields = ["topic", "object_id", "attempts", "last_error", "available_at", ]
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ["id", "name", "priority", "status", "attempts", "available_at", "datetime_created", ]
+    list_filter = ["status", "name", ]
+    readonly_fields = ["name", "kwargs", "attempts", "last_error", "available_at", ]
+    actions = ['retry_tasks', ]
+
+    @admin.action(description='Queue selected tasks again')
+    def retry_tasks(self, request, queryset):
+        updated = queryset.update(status=Task.STATUS_QUEUED, attempts=0, available_at=timezone.now())
+        self.message_user(request, f'{updated} tasks were queued again.')
@@ -0,0 +1,204 @@
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Least, Now
+
+from .caching import bump_catalog_cache_version
+from .models import CartItem, Order, OrderItem, Product, ProductAttribute, ProductVariant, ShippingMethod
+from .pricing import adjusted_price_expression, discounted_price_expression
+from .rankings import refresh_product_rankings
+
+
+def apply_discount(queryset, discount):
+    """
+    Puts `discount` on the attributes of `queryset`. Returns the number of attributes.
+
+    A scheduled discount before its window is only attached and marked pending,
+    run_discount_schedules activates it when the campaign starts.
+    """
+    if discount.is_running():
+        schedule = ProductAttribute.DISCOUNT_SCHEDULE_ACTIVATED if discount.is_scheduled else ProductAttribute.DISCOUNT_SCHEDULE_NONE
+        return activate_discount(queryset, discount, schedule)
+
+    schedule = ProductAttribute.DISCOUNT_SCHEDULE_NONE if discount.has_ended() else ProductAttribute.DISCOUNT_SCHEDULE_PENDING
+    return update_attributes(
+        queryset,
+        discount=discount,
+        discount_active=False,
+        discount_amount=None,
+        discounted_price=None,
+        discount_schedule=schedule,
+    )
+
+
+def activate_discount(queryset, discount, schedule=ProductAttribute.DISCOUNT_SCHEDULE_ACTIVATED):
+    return update_attributes(
+        queryset,
+        discount=discount,
+        discount_active=True,
+        discount_amount=discount.discount,
+        discounted_price=discounted_price_expression(F('price'), Value(discount.discount)),
+        discount_schedule=schedule,
+    )
+
+
+def remove_discount(queryset):
+    return update_attributes(
+        queryset,
+        discount=None,
+        discount_active=False,
+        discount_amount=None,
+        discounted_price=None,
+        discount_schedule=ProductAttribute.DISCOUNT_SCHEDULE_NONE,
+    )
+
+
+def end_discount(queryset):
+    """Deactivates the discount of the attributes but keeps it attached, for ended campaigns."""
+    return update_attributes(
+        queryset,
+        discount_active=False,
+        discount_amount=None,
+        discounted_price=None,
+        discount_schedule=ProductAttribute.DISCOUNT_SCHEDULE_NONE,
+    )
+
+
+def set_quantity(queryset, quantity):
+    return update_attributes(queryset, quantity=quantity)
+
+
+def adjust_price(queryset, percent):
+    """Changes prices by `percent` (-10 is 10% off), discounted prices follow the new price."""
+    def discounted_price(attributes):
+        attributes.filter(discount_active=True, discount_amount__isnull=False).update(
+            discounted_price=discounted_price_expression(F('price'), F('discount_amount')),
+        )
+
+    return update_attributes(queryset, after_update=discounted_price, price=adjusted_price_expression(F('price'), Value(percent)))
+
+
+def update_attributes(queryset, after_update=None, **changes):
+    """
+    Updates the attributes of `queryset` with one UPDATE instead of saving them one by one.
+
+    ProductAttribute.save() and its signals are skipped, so the product columns, cart items
+    and unpaid orders depending on the attributes are recomputed afterwards in batches,
+    see `refresh_attribute_dependents`.
+    """
+    with transaction.atomic():
+        # Fixed up front, the update may change the columns the changelist was filtered by
+        attribute_ids = list(queryset.values_list('pk', flat=True))
+        attributes = ProductAttribute.objects.filter(pk__in=attribute_ids)
+
+        updated = attributes.update(datetime_modified=Now(), **changes)
+        if after_update is not None:
+            after_update(attributes)
+
+        refresh_attribute_dependents(attribute_ids)
+
+    return updated
+
+
+def refresh_attribute_dependents(attribute_ids):
+    product_ids = set(ProductAttribute.objects.filter(pk__in=attribute_ids).values_list('product_id', flat=True))
+
+    recompute_products(product_ids)
+    sync_cart_items(attribute_ids)
+    sync_unpaid_order_items(attribute_ids)
+    refresh_product_rankings(product_ids)
+    bump_catalog_cache_version()
+
+
+def recompute_products(product_ids):
+    """Recomputes the price, discount, stock and total sold columns of the products with a few UPDATEs, plus their ProductVariant rows."""
+    attributes = ProductAttribute.objects.filter(product_id=OuterRef('pk')).order_by()
+    in_stock = attributes.filter(quantity__gt=0)
+    discounted = in_stock\
+        .filter(discount_active=True, discount_amount__isnull=False, discounted_price__isnull=False)\
+        .order_by('discounted_price', 'pk')
+    stock_quantity = attributes.values('product_id').annotate(total=Sum('quantity')).values('total')
+    total_sold = attributes.values('product_id').annotate(total=Sum('total_sold')).values('total')
+
+    Product.objects.filter(pk__in=product_ids).update(
+        price=Coalesce(Subquery(discounted.values('price')[:1]), Subquery(in_stock.order_by('price').values('price')[:1])),
+        discounted_price=Subquery(discounted.values('discounted_price')[:1]),
+        discount_amount=Subquery(discounted.values('discount_amount')[:1]),
+        has_discount=Exists(discounted),
+        stock_quantity=Coalesce(Subquery(stock_quantity), 0),
+        total_sold=Coalesce(Subquery(total_sold), 0),
+        in_stock=Exists(in_stock),
+    )
+
+    ProductVariant.objects.filter(product_id__in=product_ids).delete()
+    rows = ProductAttribute.objects\
+        .filter(product_id__in=product_ids, quantity__gt=0)\
+        .values_list('product_id', 'variable_id')\
+        .distinct()
+    ProductVariant.objects.bulk_create(
+        [ProductVariant(product_id=product_id, variable_id=variable_id) for product_id, variable_id in rows],
+        batch_size=1000,
+    )
+
+
+def sync_cart_items(attribute_ids):
+    """Drops cart items of sold out attributes and caps the others at the stock, like update_cart_items."""
+    cart_items = CartItem.objects.filter(product_id__in=attribute_ids)
+
+    cart_items.filter(product__quantity=0).delete()
+    cart_items.filter(quantity__gt=F('product__quantity')).update(
+        quantity=Subquery(ProductAttribute.objects.filter(pk=OuterRef('product_id')).values('quantity')[:1]),
+    )
+
+
+def sync_unpaid_order_items(attribute_ids):
+    """Copies stock, price and discount of the attributes into unpaid order items, like update_order_items."""
+    order_items = OrderItem.objects.filter(product_id__in=attribute_ids, order__is_paid=False)
+    order_ids = set(order_items.values_list('order_id', flat=True))
+    if not order_ids:
+        return
+
+    order_items.filter(product__quantity=0).delete()
+
+    attribute = ProductAttribute.objects.filter(pk=OuterRef('product_id'))
+    discounted = attribute.filter(discount_active=True, discount_amount__isnull=False)
+    order_items.update(
+        quantity=Least(F('quantity'), Subquery(attribute.values('quantity')[:1])),
+        price=Subquery(attribute.values('price')[:1]),
+        discounted_price=Subquery(discounted.values('discounted_price')[:1]),
+        discount=Subquery(discounted.values('discount_amount')[:1]),
+        discount_active=Exists(discounted),
+    )
+
+    recompute_order_totals(order_ids)
+
+
+def sync_unpaid_order_shipping(shipping_method_ids):
+    """Copies the price of the shipping methods into their unpaid orders, like update_order_shipping_price_field."""
+    orders = Order.objects.filter(is_paid=False, shipping_method_id__in=shipping_method_ids)
+    order_ids = set(orders.values_list('pk', flat=True))
+    if not order_ids:
+        return
+
+    orders.update(shipping_price=Subquery(ShippingMethod.objects.filter(pk=OuterRef('shipping_method_id')).values('price')[:1]))
+    recompute_order_totals(order_ids)
+
+
+def recompute_order_totals(order_ids):
+    """Order.calculate_totals for many orders with one grouped query and a bulk update."""
+    rows = OrderItem.objects\
+        .filter(order_id__in=order_ids)\
+        .order_by()\
+        .values('order_id')\
+        .annotate(**Order.totals_aggregates())
+    totals = {row['order_id']: row for row in rows}
+
+    orders = list(Order.objects.filter(pk__in=order_ids).only('id', 'shipping_price'))
+    for order in orders:
+        order_totals = totals.get(order.id, {})
+        order.set_totals(order_totals.get('products_total'), order_totals.get('total_discount'))
+
+    Order.objects.bulk_update(
+        orders,
+        ['products_total_price', 'order_total_discount', 'order_total_price', ],
+        batch_size=1000,
+    )
@@ -0,0 +1,145 @@
+import gzip
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from rest_framework.response import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+CATALOG_CACHE_VERSION_KEY = 'shop:catalog:version'
+# Bodies smaller than this are not worth compressing (same limit as GZipMiddleware)
+MIN_COMPRESS_LENGTH = 200
+
+
+def get_catalog_cache_version():
+    version = cache.get(CATALOG_CACHE_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_CACHE_VERSION_KEY, 1, timeout=None)
+        version = cache.get(CATALOG_CACHE_VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_cache_version():
+    """Invalidates every cached catalog response at once, old entries simply expire."""
+    try:
+        cache.incr(CATALOG_CACHE_VERSION_KEY)
+    except ValueError:
+        cache.add(CATALOG_CACHE_VERSION_KEY, 2, timeout=None)
+
+
+def compress_body(body):
+    """Returns the body in every encoding we can serve, compressed once when it is cached."""
+    variants = {'identity': body}
+
+    if len(body) < MIN_COMPRESS_LENGTH:
+        return variants
+
+    variants['gzip'] = gzip.compress(body, compresslevel=6)
+    if brotli is not None:
+        variants['br'] = brotli.compress(body, quality=5)
+
+    return variants
+
+
+def choose_encoding(accept_encoding, available):
+    """Picks the best encoding of `available` allowed by an Accept-Encoding header."""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    for coding in ('br', 'gzip', ):
+        if coding in available and accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+
+    return 'identity'
+
+
+class CachedResponseMixin:
+    """
+    Caches the rendered body of safe catalog responses together with its gzip/brotli variants.
+
+    Entries are keyed by the catalog cache version, the full path and the renderer,
+    so a cache hit skips the queries, the serializer and the compression entirely.
+    """
+    cache_actions = ['list', 'retrieve', ]
+    cache_timeout = 60 * 5
+
+    def get_response_cache_key(self, request):
+        return 'shop:response:{}:{}:{}{}'.format(
+            get_catalog_cache_version(),
+            request.accepted_renderer.format,
+            request.get_host(),
+            request.get_full_path(),
+        )
+
+    def should_cache_response(self, request):
+        # The browsable API renders per user forms, only plain JSON is shared
+        return request.method == 'GET' \
+            and self.action in self.cache_actions \
+            and getattr(request, 'accepted_renderer', None) is not None \
+            and request.accepted_renderer.format == 'json'
+
+    def build_cached_response(self, request, entry):
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''), entry['variants'])
+
+        response = HttpResponse(entry['variants'][encoding], content_type=entry['content_type'])
+        if encoding != 'identity':
+            response['Content-Encoding'] = encoding
+        if entry['vary']:
+            response['Vary'] = entry['vary']
+        return response
+
+    def list(self, request, *args, **kwargs):
+        response = self.get_cached_response(request)
+        if response is None:
+            response = super().list(request, *args, **kwargs)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        response = self.get_cached_response(request)
+        if response is None:
+            response = super().retrieve(request, *args, **kwargs)
+        return response
+
+    def get_cached_response(self, request):
+        if not self.should_cache_response(request):
+            return None
+
+        entry = cache.get(self.get_response_cache_key(request))
+        if entry is None:
+            return None
+
+        return self.build_cached_response(request, entry)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        if not self.should_cache_response(request) or response.status_code != 200:
+            return response
+
+        # Fresh responses are rendered and stored here, cache hits are already plain HttpResponses
+        if isinstance(response, Response):
+            response.render()
+            entry = {
+                'content_type': response['Content-Type'],
+                'vary': response.get('Vary'),
+                'variants': compress_body(response.content),
+            }
+            cache.set(self.get_response_cache_key(request), entry, self.cache_timeout)
+            response = self.build_cached_response(request, entry)
+
+        patch_vary_headers(response, ['Accept-Encoding', ])
+        return response
@@ -0,0 +1,96 @@
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from rest_framework.permissions import SAFE_METHODS
+
+
+# True while a viewset that allows it serves a safe request
+replica_reads = ContextVar('replica_reads', default=False)
+
+
+def get_replica_settings():
+    return getattr(settings, 'SHOP_REPLICAS', {})
+
+
+def get_replica_aliases():
+    return get_replica_settings().get('DATABASES', [])
+
+
+class ReplicaRouter:
+    """
+    Sends reads to a replica only when the current viewset allowed it for this request.
+
+    Everything else (writes, reads inside a transaction, admin, management commands)
+    goes to the primary "default" database.
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = get_replica_aliases()
+        if not replicas or not replica_reads.get():
+            return 'default'
+        if connections['default'].in_atomic_block:
+            return 'default'
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {'default', *get_replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return True
+
+
+class ReplicaRoutingMixin:
+    """
+    Per viewset read replica routing with read-your-writes stickiness.
+
+    Safe requests of viewsets with `read_from_replica = True` read from a replica,
+    unless the user (or cart, see `get_sticky_keys`) wrote something in the last
+    SHOP_REPLICAS['STICKY_SECONDS'] seconds.
+    """
+    read_from_replica = False
+
+    def get_sticky_keys(self):
+        user = getattr(self.request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return [f'shop:primary:user:{user.id}']
+        return []
+
+    def dispatch(self, request, *args, **kwargs):
+        token = replica_reads.set(False)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            replica_reads.reset(token)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        if request.method not in SAFE_METHODS or not self.read_from_replica or not get_replica_aliases():
+            return
+
+        sticky_keys = self.get_sticky_keys()
+        if sticky_keys and cache.get_many(sticky_keys):
+            return
+
+        replica_reads.set(True)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            sticky_keys = self.get_sticky_keys()
+            if sticky_keys:
+                sticky_seconds = get_replica_settings().get('STICKY_SECONDS', 10)
+                cache.set_many({key: True for key in sticky_keys}, sticky_seconds)
+
+        return response
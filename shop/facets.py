@@ -0,0 +1,62 @@
+from django.db.models import Count, Min, Max, Q
+
+from .filters import annotate_effective_price
+from .models import ProductAttribute, Variable
+
+
+RATING_THRESHOLDS = [4, 3, 2, 1, ]
+
+
+def get_product_facets(queryset):
+    """
+    Facet counts of a filtered product queryset in two grouped queries.
+
+    One conditional aggregate covers price range, discount, stock and rating
+    facets, one GROUP BY over the in stock attributes covers sizes and colors.
+    Counts are computed over the current result set.
+    """
+    # Ordering and deferred columns of the listing do not matter for counting
+    queryset = queryset.order_by()
+    rating_aggregates = {
+        f'rating_{threshold}': Count('id', filter=Q(rates_average__gte=threshold))
+        for threshold in RATING_THRESHOLDS
+    }
+    totals = annotate_effective_price(queryset).aggregate(
+        total=Count('id'),
+        min_price=Min('effective_price'),
+        max_price=Max('effective_price'),
+        has_discount=Count('id', filter=Q(has_discount=True)),
+        in_stock=Count('id', filter=Q(in_stock=True)),
+        **rating_aggregates,
+    )
+
+    variables = ProductAttribute.objects\
+        .filter(product__in=queryset.values('pk'), quantity__gt=0)\
+        .values('variable_id', 'variable__variable_type', 'variable__title', 'variable__color_code')\
+        .annotate(count=Count('product_id', distinct=True))\
+        .order_by('variable__variable_type', 'variable__title')
+
+    sizes, colors = [], []
+    for variable in variables:
+        facet = {'id': variable['variable_id'], 'title': variable['variable__title'], 'count': variable['count']}
+        if variable['variable__variable_type'] == Variable.SIZE_TYPE:
+            sizes.append(facet)
+        else:
+            facet['color_code'] = variable['variable__color_code']
+            colors.append(facet)
+
+    return {
+        'total': totals['total'],
+        'price': {
+            'min': int(totals['min_price']) if totals['min_price'] is not None else None,
+            'max': int(totals['max_price']) if totals['max_price'] is not None else None,
+        },
+        'has_discount': totals['has_discount'],
+        'in_stock': totals['in_stock'],
+        'rating': [
+            {'min_rating': threshold, 'count': totals[f'rating_{threshold}']}
+            for threshold in RATING_THRESHOLDS
+        ],
+        'size': sizes,
+        'color': colors,
+    }
@@ -1,7 +1,18 @@
-from django_filters.rest_framework import FilterSet, CharFilter
+from django_filters.rest_framework import FilterSet, CharFilter, NumberFilter, BooleanFilter, BaseInFilter
+from django.db.models import Q
+from django.db.models.functions import Coalesce
 from rest_framework.filters import OrderingFilter
 
-from .models import Product
+from .models import Product, ProductVariant, Variable
+
+
+class NumberInFilter(BaseInFilter, NumberFilter):
+    pass
+
+
+def annotate_effective_price(queryset):
+    """Price a customer pays: the discounted price if the product has a discount."""
+    return queryset.annotate(effective_price=Coalesce('discounted_price', 'price'))
 
 
 class ProductsFilter(FilterSet):
@@ -10,10 +21,39 @@ class ProductsFilter(FilterSet):
         lookup_expr='icontains',
         label=''
     )
+    min_price = NumberFilter(method='filter_min_price')
+    max_price = NumberFilter(method='filter_max_price')
+    has_discount = BooleanFilter(field_name='has_discount')
+    in_stock = BooleanFilter(field_name='in_stock')
+    min_rating = NumberFilter(field_name='rates_average', lookup_expr='gte')
+    size = NumberInFilter(method='filter_size')
+    color = NumberInFilter(method='filter_color')
 
     class Meta:
         model = Product
-        fields = ['title', ]
+        fields = ['title', 'min_price', 'max_price', 'has_discount', 'in_stock', 'min_rating', 'size', 'color', ]
+
+    # The effective price is compared per branch on the signal maintained columns,
+    # so the (has_discount, price) indexes are usable, unlike with a COALESCE.
+    def filter_min_price(self, queryset, name, value):
+        return queryset.filter(Q(has_discount=True, discounted_price__gte=value) | Q(has_discount=False, price__gte=value))
+
+    def filter_max_price(self, queryset, name, value):
+        return queryset.filter(Q(has_discount=True, discounted_price__lte=value) | Q(has_discount=False, price__lte=value))
+
+    def filter_variables(self, queryset, variable_ids, variable_type):
+        # ProductVariant holds the in stock variables, served by its (variable, product) index
+        product_ids = ProductVariant.objects.filter(
+            variable_id__in=[int(variable_id) for variable_id in variable_ids],
+            variable__variable_type=variable_type,
+        )
+        return queryset.filter(pk__in=product_ids.values('product_id'))
+
+    def filter_size(self, queryset, name, value):
+        return self.filter_variables(queryset, value, Variable.SIZE_TYPE)
+
+    def filter_color(self, queryset, name, value):
+        return self.filter_variables(queryset, value, Variable.COLOR_TYPE)
 
 
 class InStockOrderingFilter(OrderingFilter):
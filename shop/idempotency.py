@@ -0,0 +1,124 @@
+import hashlib
+import json
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.throttling import BaseThrottle
+
+from .models import IdempotencyKey
+
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+IDEMPOTENT_METHODS = ['POST', 'PATCH', ]
+
+
+def get_idempotency_settings():
+    return getattr(settings, 'SHOP_IDEMPOTENCY', {})
+
+
+def get_request_fingerprint(request):
+    """Hash of what the request asks for, a key reused for a different request is rejected."""
+    payload = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method} {request.path} {payload}'.encode()).hexdigest()
+
+
+class IdempotencyMixin:
+    """
+    Makes POST and PATCH requests safe to retry with an `Idempotency-Key` header.
+
+    The first successful (2xx) response is stored per scope (the user, else the cart of the
+    URL, else the client IP) and key, in the transaction of the write itself. A retry with
+    the same key gets the stored response back without running the view again. Failed
+    requests are not stored, so they can be retried with the same key.
+    """
+
+    def get_idempotency_scope(self, request):
+        if request.user and request.user.is_authenticated:
+            return f'user:{request.user.pk}'
+        if 'cart_pk' in self.kwargs:
+            return f"cart:{self.kwargs['cart_pk']}"
+        return f'ip:{BaseThrottle().get_ident(request)}'
+
+    def check_throttles(self, request):
+        # A retry answered with the stored response does no work, it does not use the write budget
+        if not self.has_stored_response(request):
+            super().check_throttles(request)
+
+    def has_stored_response(self, request):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if request.method not in IDEMPOTENT_METHODS or not key or len(key) > 255:
+            return False
+
+        return IdempotencyKey.objects.filter(
+            scope=self.get_idempotency_scope(request),
+            key=key,
+            fingerprint=get_request_fingerprint(request),
+            status_code__isnull=False,
+            expires_at__gt=timezone.now(),
+        ).exists()
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        if request.method in IDEMPOTENT_METHODS and request.headers.get(IDEMPOTENCY_HEADER):
+            # dispatch() looks the handler up after initial(), so the bound action is wrapped here
+            method = request.method.lower()
+            setattr(self, method, partial(self.run_idempotent, getattr(self, method)))
+
+    def run_idempotent(self, handler, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if len(key) > 255:
+            return Response({'detail': f'{IDEMPOTENCY_HEADER} is longer than 255 characters.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        idempotency_settings = get_idempotency_settings()
+        scope = self.get_idempotency_scope(request)
+        fingerprint = get_request_fingerprint(request)
+        now = timezone.now()
+
+        with transaction.atomic():
+            IdempotencyKey.objects.filter(scope=scope, key=key, expires_at__lte=now).delete()
+            try:
+                # A concurrent first request holding the key makes this wait for it, then fail
+                with transaction.atomic():
+                    record = IdempotencyKey.objects.create(
+                        scope=scope,
+                        key=key,
+                        fingerprint=fingerprint,
+                        expires_at=now + timedelta(seconds=idempotency_settings.get('TTL_SECONDS', 86400)),
+                    )
+            except IntegrityError:
+                return self.replay(IdempotencyKey.objects.filter(scope=scope, key=key).first(), fingerprint)
+
+            response = handler(request, *args, **kwargs)
+
+            data = getattr(response, 'data', None)
+            body = JSONRenderer().render(data) if data is not None else b''
+            if status.is_success(response.status_code) and len(body) <= idempotency_settings.get('MAX_BODY_BYTES', 65536):
+                record.status_code = response.status_code
+                record.body = body
+                record.save(update_fields=['status_code', 'body', ])
+            else:
+                record.delete()
+
+        return response
+
+    def replay(self, record, fingerprint):
+        if record is None or record.status_code is None:
+            return Response({'detail': 'A request with this Idempotency-Key is in progress.'}, status=status.HTTP_409_CONFLICT)
+        if record.fingerprint != fingerprint:
+            return Response(
+                {'detail': f'{IDEMPOTENCY_HEADER} was already used for a different request.'},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+
+        response = HttpResponse(bytes(record.body), status=record.status_code, content_type='application/json')
+        response[REPLAYED_HEADER] = 'true'
+        return response
@@ -0,0 +1,87 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from shop.models import Order, ShippingMethod
+
+
+CHANGELISTS = ['shop_order', 'shop_orderitem', 'shop_product', 'shop_cart', 'shop_category', ]
+
+
+class Command(BaseCommand):
+    help = "Times the admin changelists (first page, a later page and a filtered page). " \
+           "--seed-orders N first bulk inserts N orders, e.g. 1000000 for the large table benchmark."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed-orders', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--username', help="Superuser to browse the admin as, defaults to the first one.")
+
+    def handle(self, *args, **options):
+        if options['seed_orders']:
+            self.seed_orders(options['seed_orders'], options['batch_size'])
+
+        users = get_user_model().objects.filter(is_superuser=True)
+        if options['username']:
+            users = users.filter(username=options['username'])
+        user = users.order_by('pk').first()
+        if user is None:
+            raise CommandError("A superuser is needed to browse the admin.")
+
+        client = Client()
+        client.force_login(user)
+
+        self.stdout.write(f"{'changelist':<40} {'status':>6} {'queries':>7} {'ms':>9}")
+        with override_settings(ALLOWED_HOSTS=['testserver'], DEBUG=False):
+            for changelist in CHANGELISTS:
+                url = reverse(f'admin:{changelist}_changelist')
+                for path in [url, f'{url}?p=50', f'{url}?q=1', ]:
+                    self.time_changelist(client, path, options['repeat'])
+
+    def time_changelist(self, client, path, repeat):
+        client.get(path)
+
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                response = client.get(path)
+            elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            f"{path:<40} {response.status_code:>6} {len(queries) // repeat:>7} {elapsed * 1000 / repeat:>9.1f}"
+        )
+
+    def seed_orders(self, count, batch_size):
+        user = get_user_model().objects.order_by('pk').first()
+        shipping_method = ShippingMethod.objects.order_by('pk').first()
+        if user is None or shipping_method is None:
+            raise CommandError("Seeding orders needs at least one user and one shipping method.")
+
+        # bulk_create skips Order.save(), the numbers are made unique here instead
+        offset = (Order.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        for start in range(0, count, batch_size):
+            Order.objects.bulk_create([
+                Order(
+                    user=user,
+                    shipping_method=shipping_method,
+                    receiver_name='Bench',
+                    receiver_family=f'Shopper {number}',
+                    receiver_phone_number='09120000000',
+                    receiver_city='Tehran',
+                    receiver_address='Benchmark street',
+                    receiver_postal_code='1234567890',
+                    number=f'bench-{number}',
+                    is_paid=number % 3 == 0,
+                )
+                for number in range(offset + start, offset + min(start + batch_size, count))
+            ], batch_size=batch_size)
+            self.stdout.write(f"Seeded {min(start + batch_size, count)} / {count} orders", ending='\r')
+
+        self.stdout.write(self.style.SUCCESS(f"\nSeeded {count} orders."))
@@ -0,0 +1,67 @@
+import random
+import timeit
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from shop.pricing import discounted_price, price_lines
+
+
+def decimal_discounted_price(price, percent):
+    """The Decimal arithmetic ProductAttribute used before shop.pricing, stored with decimal_places=0."""
+    return int((price - price * (percent / 100)).quantize(Decimal(1)))
+
+
+def decimal_totals(lines):
+    """The Decimal arithmetic CartSerializer used before shop.pricing."""
+    total_price = sum(quantity * (discounted if discounted is not None else price) for price, discounted, quantity in lines)
+    total_discount = sum((price - discounted) * quantity for price, discounted, quantity in lines if discounted is not None)
+    return int(total_price), int(total_discount)
+
+
+class Command(BaseCommand):
+    help = "Times the integer arithmetic of shop.pricing against the old Decimal code. " \
+           "Its agreement with the SQL expressions is covered by shop.tests.PricingTests."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        prices = [rng.randrange(1000, 50000000) for _ in range(options['lines'])]
+        percents = [rng.randrange(0, 101) for _ in range(options['lines'])]
+
+        decimal_pairs = [(Decimal(price), Decimal(percent)) for price, percent in zip(prices, percents)]
+
+        changed = sum(
+            decimal_discounted_price(price, percent) != discounted_price(int(price), int(percent))
+            for price, percent in decimal_pairs
+        )
+        self.stdout.write(f"Decimal vs integer discounted prices: {changed} of {len(prices)} differ by rounding")
+
+        lines = []
+        for price, percent in zip(prices, percents):
+            discounted = discounted_price(price, percent) if percent else None
+            lines.append((price, discounted, rng.randrange(1, 5)))
+        decimal_lines = [
+            (Decimal(price), Decimal(discounted) if discounted is not None else None, quantity)
+            for price, discounted, quantity in lines
+        ]
+
+        repeat = options['repeat']
+        decimal_ms = timeit.timeit(lambda: decimal_totals(decimal_lines), number=repeat) * 1000 / repeat
+        integer_ms = timeit.timeit(lambda: price_lines(lines), number=repeat) * 1000 / repeat
+        discount_decimal_ms = timeit.timeit(
+            lambda: [decimal_discounted_price(price, percent) for price, percent in decimal_pairs],
+            number=repeat,
+        ) * 1000 / repeat
+        discount_integer_ms = timeit.timeit(
+            lambda: [discounted_price(price, percent) for price, percent in zip(prices, percents)],
+            number=repeat,
+        ) * 1000 / repeat
+
+        self.stdout.write(f"{'':<20} {'Decimal ms':>11} {'integer ms':>11}")
+        self.stdout.write(f"{'totals':<20} {decimal_ms:>11.2f} {integer_ms:>11.2f}")
+        self.stdout.write(f"{'discounted prices':<20} {discount_decimal_ms:>11.2f} {discount_integer_ms:>11.2f}")
+
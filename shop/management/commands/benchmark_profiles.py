@@ -0,0 +1,73 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+# Runs in a fresh interpreter so every profile pays its own import and setup cost
+PROFILE_SCRIPT = """
+import json, os, sys, time
+
+start = time.perf_counter()
+import django
+django.setup()
+startup = time.perf_counter() - start
+
+from django.test import Client
+
+path, requests = sys.argv[1], int(sys.argv[2])
+client = Client()
+status = client.get(path).status_code
+
+start = time.perf_counter()
+for _ in range(requests):
+    client.get(path)
+elapsed = time.perf_counter() - start
+
+from django.conf import settings
+print(json.dumps({
+    'status': status,
+    'startup_ms': startup * 1000,
+    'request_ms': elapsed * 1000 / requests,
+    'middleware': len(settings.MIDDLEWARE),
+    'apps': len(settings.INSTALLED_APPS),
+}))
+"""
+
+
+class Command(BaseCommand):
+    help = "Compares startup time and per request overhead of the dev, prod and bench settings profiles."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='+', default=['dev', 'prod', 'bench', ])
+        parser.add_argument('--path', default='/shop/categories/')
+        parser.add_argument('--requests', type=int, default=200)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'profile':<8} {'status':>6} {'startup ms':>11} {'request ms':>11} {'middleware':>10} {'apps':>5}")
+
+        for profile in options['profiles']:
+            env = dict(os.environ,
+                       SETTINGS_PROFILE=profile,
+                       DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'config.settings'),
+                       ALLOWED_HOSTS='testserver')
+            result = subprocess.run(
+                [sys.executable, '-c', PROFILE_SCRIPT, options['path'], str(options['requests'])],
+                cwd=settings.BASE_DIR,
+                env=env,
+                capture_output=True,
+                text=True,
+            )
+
+            if result.returncode != 0:
+                self.stderr.write(f"{profile}: failed\n{result.stderr}")
+                continue
+
+            stats = json.loads(result.stdout.strip().splitlines()[-1])
+            self.stdout.write(
+                f"{profile:<8} {stats['status']:>6} {stats['startup_ms']:>11.1f} "
+                f"{stats['request_ms']:>11.3f} {stats['middleware']:>10} {stats['apps']:>5}"
+            )
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.models import Task
+from shop.tasks import REGISTRY, get_task_settings
+
+
+class Command(BaseCommand):
+    help = "Queues the housekeeping tasks of SHOP_TASKS['PERIODIC'] for run_tasks. Run it from cron, e.g. hourly."
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help="Tasks to queue instead of SHOP_TASKS['PERIODIC'].")
+
+    def handle(self, *args, **options):
+        names = options['names'] or get_task_settings().get('PERIODIC', [])
+        unknown = [name for name in names if name not in REGISTRY]
+        if unknown:
+            raise CommandError(f"Unknown tasks: {', '.join(unknown)}")
+
+        # A task still waiting from the last run is not queued twice when the worker falls behind
+        waiting = set(Task.objects.filter(name__in=names, status=Task.STATUS_QUEUED).values_list('name', flat=True))
+        queued = [name for name in names if name not in waiting]
+        for name in queued:
+            REGISTRY[name].delay()
+
+        self.stdout.write(self.style.SUCCESS(f"Queued {len(queued)} tasks, {len(waiting)} were still waiting."))
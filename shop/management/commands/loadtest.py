@@ -0,0 +1,337 @@
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+
+from shop.bulk_updates import recompute_order_totals, recompute_products
+from shop.models import Category, Order, OrderItem, Product, ProductAttribute, ShippingMethod, SubCategory, Variable
+from shop.rankings import refresh_product_rankings
+
+
+# Share of the sessions running each shopper flow, overridable with --flows
+FLOW_WEIGHTS = {
+    'browse': 30,
+    'list': 30,
+    'detail': 20,
+    'cart': 15,
+    'orders': 5,
+}
+ORDERINGS = ['price', '-price', 'title', '-datetime_created', '-total_sold', ]
+SEED_PREFIX = 'loadtest'
+
+
+def percentile(sorted_values, percent):
+    """Nearest rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0
+    rank = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class Shopper:
+    """One simulated shopper, its own HTTP session (keep-alive, cookies) and recorder."""
+
+    def __init__(self, base_url, catalog, token, record, rng):
+        self.base_url = base_url
+        self.catalog = catalog
+        self.token = token
+        self.record = record
+        self.rng = rng
+        self.session = requests.Session()
+
+    def request(self, route, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=30, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 0
+        self.record(route, status, time.perf_counter() - start)
+        return response if status and status < 400 else None
+
+    def browse(self):
+        self.request('categories', 'GET', '/shop/categories/')
+        category = self.rng.choice(self.catalog['categories'])
+        self.request('category products', 'GET', f'/shop/categories/{category}/products/')
+
+    def list(self):
+        params = {'ordering': self.rng.choice(ORDERINGS)}
+        if self.rng.random() < 0.5:
+            params['in_stock'] = 'true'
+        if self.rng.random() < 0.3:
+            params['min_price'] = self.rng.choice([1000, 10000, 100000])
+        if self.rng.random() < 0.2:
+            params['has_discount'] = 'true'
+        if len(params) == 1:
+            # Only unfiltered listings surely have a few pages
+            params['page'] = self.rng.randint(1, 3)
+        self.request('products', 'GET', '/shop/products/', params=params)
+
+    def detail(self):
+        self.request('products', 'GET', '/shop/products/', params={'ordering': self.rng.choice(ORDERINGS)})
+        self.request('product detail', 'GET', f"/shop/products/{self.rng.choice(self.catalog['products'])}/")
+
+    def cart(self):
+        response = self.request('create cart', 'POST', '/shop/carts/', json={})
+        if response is None:
+            return
+        cart_id = response.json()['id']
+        for attribute_id in self.rng.sample(self.catalog['attributes'], k=min(self.rng.randint(1, 3), len(self.catalog['attributes']))):
+            self.request('add cart item', 'POST', f'/shop/carts/{cart_id}/items/', json={'product': attribute_id, 'quantity': 1})
+        self.request('cart detail', 'GET', f'/shop/carts/{cart_id}/')
+
+    def orders(self):
+        if self.token is None:
+            return
+        headers = {'Authorization': f'JWT {self.token}'}
+        response = self.request('order history', 'GET', '/shop/orders/', headers=headers)
+        if response is not None and response.json().get('results'):
+            order_id = response.json()['results'][0]['id']
+            self.request('order detail', 'GET', f'/shop/orders/{order_id}/', headers=headers)
+
+
+class Command(BaseCommand):
+    help = "Replays weighted shopper flows against the API with N concurrent shoppers and reports " \
+           "throughput and p50/p95/p99 latency per route. Starts a local server unless --url is given."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help="Server to load, e.g. a gunicorn started with the prod profile.")
+        parser.add_argument('--profile', default='bench', help="Settings profile of the local server.")
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--duration', type=float, default=30, help="Seconds to run for.")
+        parser.add_argument('--flows', default='', help="Weights overriding the defaults, e.g. browse=1,cart=3.")
+        parser.add_argument('--seed', action='store_true', help="Create the load test catalog and user first.")
+        parser.add_argument('--products', type=int, default=500, help="Products created by --seed.")
+        parser.add_argument('--orders', type=int, default=20, help="Orders of the load test user created by --seed.")
+        parser.add_argument('--password', default='loadtest-password')
+        parser.add_argument('--random-seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        flows = self.get_flow_weights(options['flows'])
+        if options['seed']:
+            self.seed(options['products'], options['orders'], options['password'])
+
+        catalog = self.get_catalog()
+        server = None
+        base_url = options['url']
+        if base_url is None:
+            server, base_url = self.start_server(options['profile'])
+
+        try:
+            token = self.get_token(base_url, options['password'])
+            records = self.run(base_url, catalog, token, flows, options)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+        self.report(records, options['duration'])
+
+    def get_flow_weights(self, value):
+        weights = dict(FLOW_WEIGHTS)
+        for item in filter(None, value.split(',')):
+            name, _, weight = item.partition('=')
+            if name not in FLOW_WEIGHTS:
+                raise CommandError(f"Unknown flow {name}, choose from {', '.join(FLOW_WEIGHTS)}.")
+            weights[name] = int(weight)
+        return {name: weight for name, weight in weights.items() if weight > 0}
+
+    def get_catalog(self):
+        catalog = {
+            'categories': list(Category.objects.values_list('slug', flat=True)[:100]),
+            'products': list(Product.objects.filter(in_stock=True).values_list('slug', flat=True)[:1000]),
+            'attributes': list(ProductAttribute.objects.filter(quantity__gt=0).values_list('pk', flat=True)[:1000]),
+        }
+        if not all(catalog.values()):
+            raise CommandError("The catalog is empty, run with --seed first.")
+        return catalog
+
+    def start_server(self, profile):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+
+        # Every shopper shares one IP, the write budgets would reject most of the cart flow
+        env = dict(os.environ, SETTINGS_PROFILE=profile, ALLOWED_HOSTS='127.0.0.1,localhost', THROTTLE_ENABLED='False')
+        server = subprocess.Popen(
+            [sys.executable, 'manage.py', 'runserver', f'127.0.0.1:{port}', '--noreload'],
+            cwd=settings.BASE_DIR,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        base_url = f'http://127.0.0.1:{port}'
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                requests.get(f'{base_url}/shop/categories/', timeout=1)
+                self.stdout.write(f"Started a {profile} server on {base_url}")
+                return server, base_url
+            except requests.RequestException:
+                if server.poll() is not None:
+                    break
+                time.sleep(0.2)
+
+        server.terminate()
+        raise CommandError("The local server did not start, check `manage.py runserver` with the same settings.")
+
+    def get_token(self, base_url, password):
+        user = get_user_model().objects.filter(username=SEED_PREFIX).first()
+        if user is None:
+            self.stderr.write("No load test user, the order history flow is skipped. Run with --seed.")
+            return None
+
+        response = requests.post(f'{base_url}/auth/jwt/create/', json={'username': user.username, 'password': password}, timeout=10)
+        if response.status_code != 200:
+            self.stderr.write(f"Could not log the load test user in ({response.status_code}), the order history flow is skipped.")
+            return None
+        return response.json()['access']
+
+    def run(self, base_url, catalog, token, flows, options):
+        records = defaultdict(list)
+        lock = threading.Lock()
+        deadline = time.monotonic() + options['duration']
+        names, weights = list(flows), list(flows.values())
+
+        def record(route, status, seconds):
+            with lock:
+                records[route].append((status, seconds))
+
+        def shop(number):
+            rng = random.Random(options['random_seed'] + number)
+            shopper = Shopper(base_url, catalog, token, record, rng)
+            while time.monotonic() < deadline:
+                getattr(shopper, rng.choices(names, weights)[0])()
+
+        self.stdout.write(f"Running {options['concurrency']} shoppers for {options['duration']:.0f} s ...")
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            list(executor.map(shop, range(options['concurrency'])))
+        return records
+
+    def report(self, records, duration):
+        self.stdout.write(f"\n{'route':<20} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+
+        everything = []
+        for route in sorted(records):
+            everything.extend(records[route])
+            self.write_row(route, records[route], duration)
+        self.write_row('total', everything, duration)
+
+    def write_row(self, route, rows, duration):
+        latencies = sorted(seconds * 1000 for status, seconds in rows)
+        errors = sum(1 for status, seconds in rows if not status or status >= 400)
+        self.stdout.write(
+            f"{route:<20} {len(rows):>8} {errors:>6} {len(rows) / duration:>8.1f} "
+            f"{percentile(latencies, 50):>8.1f} {percentile(latencies, 95):>8.1f} {percentile(latencies, 99):>8.1f}"
+        )
+
+    def seed(self, product_count, order_count, password):
+        with transaction.atomic():
+            category, _ = Category.objects.get_or_create(slug=f'{SEED_PREFIX}-category', defaults={'title': 'Load test'})
+            subcategory, _ = SubCategory.objects.get_or_create(
+                slug=f'{SEED_PREFIX}-subcategory', defaults={'title': 'Load test', 'category': category},
+            )
+            variables = list(Variable.objects.all()[:6]) or Variable.objects.bulk_create([
+                Variable(variable_type=Variable.SIZE_TYPE, title=size) for size in ['S', 'M', 'L', ]
+            ])
+
+            existing = Product.objects.filter(slug__startswith=f'{SEED_PREFIX}-product-').count()
+            Product.objects.bulk_create([
+                Product(
+                    title=f'Load test product {number}',
+                    description='Created by manage.py loadtest --seed.',
+                    slug=f'{SEED_PREFIX}-product-{number}',
+                    category=category,
+                    subcategory=subcategory,
+                )
+                for number in range(existing, product_count)
+            ], batch_size=1000)
+            # Fetched again, bulk_create does not set the primary keys on every database
+            products = list(Product.objects.filter(slug__startswith=f'{SEED_PREFIX}-product-', attributes__isnull=True))
+            product_ids = set(Product.objects.filter(slug__startswith=f'{SEED_PREFIX}-product-').values_list('pk', flat=True))
+
+            rng = random.Random(0)
+            ProductAttribute.objects.bulk_create([
+                ProductAttribute(
+                    title=f'{product.title} {variable}',
+                    product=product,
+                    variable=variable,
+                    price=rng.randrange(1000, 1000000, 1000),
+                    quantity=10000,
+                )
+                for product in products
+                for variable in rng.sample(variables, k=min(2, len(variables)))
+            ], batch_size=1000)
+            # bulk_create skips the outbox signals, the product columns and rankings are filled here
+            recompute_products(product_ids)
+            refresh_product_rankings(product_ids)
+
+            user = get_user_model().objects.filter(username=SEED_PREFIX).first()
+            if user is None:
+                user = get_user_model().objects.create_user(SEED_PREFIX, f'{SEED_PREFIX}@example.com', password)
+            self.seed_orders(user, order_count)
+
+        self.stdout.write(self.style.SUCCESS(f"Seeded {len(products)} products, catalog has {len(product_ids)}."))
+
+    def seed_orders(self, user, count):
+        count -= Order.objects.filter(user=user).count()
+        if count <= 0:
+            return
+
+        shipping_method = ShippingMethod.objects.order_by('pk').first() or ShippingMethod.objects.create(
+            shipping_method='Load test post', price=0, delivery_time=timedelta(days=3),
+        )
+        # Same as benchmark_admin, bulk_create skips Order.save() so the numbers are set here
+        offset = (Order.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        Order.objects.bulk_create([
+            Order(
+                user=user,
+                shipping_method=shipping_method,
+                receiver_name='Load',
+                receiver_family=f'Shopper {number}',
+                receiver_phone_number='09120000000',
+                receiver_city='Tehran',
+                receiver_address='Load test street',
+                receiver_postal_code='1234567890',
+                number=f'{SEED_PREFIX}-{number}',
+                is_paid=True,
+            )
+            for number in range(offset, offset + count)
+        ])
+
+        # The order pages join and count the items, orders without any would understate them
+        orders = list(Order.objects.filter(user=user, items__isnull=True).values_list('pk', flat=True))
+        attributes = list(
+            ProductAttribute.objects
+            .filter(product__slug__startswith=f'{SEED_PREFIX}-product-')
+            .select_related('variable')
+            .order_by('pk')[:1000]
+        )
+        rng = random.Random(1)
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order_id=order_id,
+                product=attribute,
+                price=attribute.price,
+                variable=attribute.variable.title,
+                color_code=attribute.variable.color_code,
+                quantity=rng.randrange(1, 4),
+            )
+            for order_id in orders
+            for attribute in rng.sample(attributes, k=min(rng.randrange(1, 4), len(attributes)))
+        ], batch_size=1000)
+        recompute_order_totals(orders)
@@ -0,0 +1,45 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from shop.models import Product, ProductRanking, OrderItem
+from shop.rankings import bayesian_rating, sale_weight
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the ProductRanking table from products, reviews and paid orders (backfill)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        trending_scores = defaultdict(float)
+        paid_items = OrderItem.objects\
+            .filter(order__is_paid=True)\
+            .values_list('product__product_id', 'quantity', 'order__datetime_modified')\
+            .iterator(chunk_size=options['batch_size'])
+        for product_id, quantity, paid_at in paid_items:
+            trending_scores[product_id] += sale_weight(quantity, paid_at)
+
+        products = Product.objects\
+            .only('category_id', 'subcategory_id', 'in_stock', 'total_sold', 'rates_average', 'number_of_reviews')\
+            .iterator(chunk_size=options['batch_size'])
+        rankings = [
+            ProductRanking(
+                product_id=product.id,
+                category_id=product.category_id,
+                subcategory_id=product.subcategory_id,
+                in_stock=product.in_stock,
+                total_sold=product.total_sold,
+                trending_score=trending_scores[product.id],
+                rating_score=bayesian_rating(product.rates_average, product.number_of_reviews),
+            )
+            for product in products
+        ]
+
+        with transaction.atomic():
+            ProductRanking.objects.all().delete()
+            ProductRanking.objects.bulk_create(rankings, batch_size=options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt rankings of {len(rankings)} products."))
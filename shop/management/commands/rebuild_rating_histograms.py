@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from shop.caching import bump_catalog_cache_version
+from shop.models import Product, ProductReview
+
+
+class Command(BaseCommand):
+    help = "Recomputes the rating histogram, number_of_reviews and rates_average of every product (backfill). " \
+           "Run rebuild_product_rankings afterwards to refresh the top rated scores."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        histograms = {}
+        rows = ProductReview.objects\
+            .order_by()\
+            .values('product_id', 'review_rating')\
+            .annotate(count=Count('id'))
+        for row in rows:
+            histograms.setdefault(row['product_id'], {})[int(row['review_rating'])] = row['count']
+
+        fields = ['number_of_reviews', 'rates_average', *Product.RATING_COUNT_FIELDS.values()]
+        products = []
+        for product in Product.objects.only('id').iterator(chunk_size=options['batch_size']):
+            product.set_rating_histogram(histograms.get(product.id, {}))
+            products.append(product)
+
+        Product.objects.bulk_update(products, fields, batch_size=options['batch_size'])
+        bump_catalog_cache_version()
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt rating histograms of {len(products)} products."))
@@ -0,0 +1,79 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from shop.bulk_updates import activate_discount, end_discount
+from shop.models import Discount, ProductAttribute
+
+
+class Command(BaseCommand):
+    help = "Switches scheduled discounts on when their campaign starts and off when it ends. " \
+           "Run it every minute (cron) with a lead of a minute: the campaigns starting or ending " \
+           "within the lead are staged up front and switched at their boundary, not up to a minute late."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0, help="Seconds to wait between chunks.")
+        parser.add_argument('--lead', type=float, default=60, help="Seconds ahead to stage upcoming campaign boundaries.")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        scheduled = Discount.objects.filter(Q(starts_at__isnull=False) | Q(ends_at__isnull=False))
+
+        # Boundaries already passed, e.g. while the command did not run
+        started = sum(self.start(discount, self.pending(discount), options) for discount in scheduled.filter(Discount.running_q(now)))
+        ended = sum(self.end(discount, options) for discount in scheduled.filter(ends_at__lte=now))
+
+        lead_end = now + timedelta(seconds=options['lead'])
+        boundaries = [
+            (discount.starts_at, discount, list(self.pending(discount).values_list('pk', flat=True)))
+            for discount in scheduled.filter(starts_at__gt=now, starts_at__lte=lead_end)
+        ] + [
+            (discount.ends_at, discount, None)
+            for discount in scheduled.filter(ends_at__gt=now, ends_at__lte=lead_end)
+        ]
+
+        for boundary, discount, attribute_ids in sorted(boundaries, key=lambda staged: staged[0]):
+            self.sleep_until(boundary)
+            discount.refresh_from_db()
+            if discount.is_running() and attribute_ids is not None:
+                # The staged ids are rechecked, attributes changed in the meantime are left alone
+                started += self.start(discount, self.pending(discount).filter(pk__in=attribute_ids), options)
+            elif discount.has_ended():
+                ended += self.end(discount, options)
+
+        self.stdout.write(self.style.SUCCESS(f"Activated {started} and deactivated {ended} discounted attributes."))
+
+    def pending(self, discount):
+        return ProductAttribute.objects.filter(discount=discount, discount_schedule=ProductAttribute.DISCOUNT_SCHEDULE_PENDING)
+
+    def start(self, discount, attributes, options):
+        return self.in_chunks(attributes, lambda chunk: activate_discount(chunk, discount), options)
+
+    def end(self, discount, options):
+        # Every attribute of an ended campaign is switched off, activated by the schedule or by hand
+        attributes = ProductAttribute.objects\
+                                     .filter(discount=discount)\
+                                     .filter(Q(discount_active=True) | ~Q(discount_schedule=ProductAttribute.DISCOUNT_SCHEDULE_NONE))
+        return self.in_chunks(attributes, end_discount, options)
+
+    def sleep_until(self, moment):
+        seconds = (moment - timezone.now()).total_seconds()
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def in_chunks(self, queryset, update, options):
+        updated, last_pk = 0, 0
+        while True:
+            chunk_ids = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:options['chunk_size']])
+            if not chunk_ids:
+                return updated
+
+            updated += update(ProductAttribute.objects.filter(pk__in=chunk_ids))
+            last_pk = chunk_ids[-1]
+
+            if options['pause']:
+                time.sleep(options['pause'])
@@ -0,0 +1,43 @@
+import time
+
+from django.utils import timezone
+
+from shop.outbox import acknowledge, claim_events, coalesce, get_outbox_settings, retry_later, run_job
+from shop.workers import WorkerCommand
+
+
+class Command(WorkerCommand):
+    help = "Applies the side effects of the outbox events (product, cart and order recomputation) in coalesced batches."
+    default_batch_size = 500
+    default_lease_seconds = 60
+    chunk_help = "Objects per job handed to a process."
+    once_help = "Drain the outbox and exit."
+
+    def get_worker_settings(self):
+        return get_outbox_settings()
+
+    def run_batch(self, pool, options):
+        events = claim_events(options['batch_size'], options['lease'])
+        if not events:
+            return 0
+
+        start = time.perf_counter()
+        lag = (timezone.now() - min(event[3] for event in events)).total_seconds()
+        jobs = coalesce(events, options['chunk_size'])
+        results = self.map_jobs(pool, run_job, jobs)
+
+        failed = 0
+        for event_ids, error in results:
+            if error is None:
+                acknowledge(event_ids)
+            else:
+                failed += len(event_ids)
+                retry_later(event_ids, error)
+                self.stderr.write(error)
+
+        objects = sum(len(object_ids) for topic, object_ids, event_ids in jobs)
+        self.stdout.write(
+            f"{len(events)} events -> {objects} objects in {len(jobs)} jobs, {failed} failed, "
+            f"{(time.perf_counter() - start) * 1000:.0f} ms, lag {lag:.1f} s"
+        )
+        return len(events)
@@ -0,0 +1,51 @@
+import time
+from collections import Counter
+
+from django.utils import timezone
+
+from shop.tasks import acknowledge, claim_tasks, get_task_settings, group_tasks, record_task_stats, retry_later,\
+    run_job
+from shop.workers import WorkerCommand
+
+
+class Command(WorkerCommand):
+    help = "Runs the queued shop tasks (see shop/tasks.py) by priority, in a pool of processes."
+    default_batch_size = 100
+    default_lease_seconds = 300
+    chunk_help = "Calls of a batch task handed over at once."
+    once_help = "Run the queued tasks and exit."
+
+    def get_worker_settings(self):
+        return get_task_settings()
+
+    def run_batch(self, pool, options):
+        tasks = claim_tasks(options['batch_size'], options['lease'])
+        if not tasks:
+            return 0
+
+        start = time.perf_counter()
+        lag = (timezone.now() - min(task[4] for task in tasks)).total_seconds()
+        jobs = group_tasks(tasks, options['chunk_size'])
+        # imap keeps the priority order of the jobs within the batch
+        results = self.map_jobs(pool, run_job, jobs, ordered=True)
+
+        succeeded, failed, runtime = Counter(), Counter(), Counter()
+        for name, task_ids, error, seconds in results:
+            runtime[name] += seconds
+            if error is None:
+                succeeded[name] += len(task_ids)
+                acknowledge(task_ids)
+            else:
+                failed[name] += len(task_ids)
+                retry_later(task_ids, error)
+                self.stderr.write(error)
+
+        for name in runtime:
+            record_task_stats(name, succeeded[name], failed[name], runtime[name])
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"{len(tasks)} tasks in {len(jobs)} jobs, {sum(failed.values())} failed, "
+            f"{elapsed * 1000:.0f} ms ({len(tasks) / elapsed:.0f} tasks/s), lag {lag:.1f} s"
+        )
+        return len(tasks)
@@ -0,0 +1,62 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from shop.models import SlowQuery
+
+
+class Command(BaseCommand):
+    help = "Reports slow queries aggregated per fingerprint with the endpoints and call sites that ran them."
+
+    ORDERINGS = {
+        'total': lambda stats: stats['total_duration'],
+        'max': lambda stats: stats['max_duration'],
+        'count': lambda stats: stats['count'],
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--order-by', choices=list(self.ORDERINGS), default='total')
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--explain', action='store_true', help="Show the captured EXPLAIN plans.")
+        parser.add_argument('--reset', action='store_true', help="Delete the collected slow queries.")
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            deleted, _ = SlowQuery.objects.all().delete()
+            self.stdout.write(f"Deleted {deleted} slow query records.")
+            return
+
+        fingerprints = defaultdict(lambda: {'count': 0, 'total_duration': 0, 'max_duration': 0, 'sites': []})
+
+        for row in SlowQuery.objects.all():
+            stats = fingerprints[row.fingerprint]
+            stats['normalized_sql'] = row.normalized_sql
+            stats['count'] += row.count
+            stats['total_duration'] += row.total_duration
+            stats['max_duration'] = max(stats['max_duration'], row.max_duration)
+            stats['explain'] = stats.get('explain') or row.explain
+            stats['sites'].append(row)
+
+        ordered = sorted(fingerprints.items(), key=lambda item: self.ORDERINGS[options['order_by']](item[1]), reverse=True)
+
+        for fingerprint, stats in ordered[:options['limit']]:
+            self.stdout.write(self.style.WARNING(
+                f"{fingerprint[:12]}  count={stats['count']}  "
+                f"total={stats['total_duration'] * 1000:.1f}ms  "
+                f"avg={stats['total_duration'] * 1000 / stats['count']:.1f}ms  "
+                f"max={stats['max_duration'] * 1000:.1f}ms"
+            ))
+            self.stdout.write(f"  {stats['normalized_sql'][:500]}")
+
+            for site in sorted(stats['sites'], key=lambda site: site.total_duration, reverse=True):
+                self.stdout.write(
+                    f"    {site.url_name or '-'} @ {site.call_site or '-'}: "
+                    f"{site.count} x, {site.total_duration * 1000:.1f}ms"
+                )
+
+            if options['explain'] and stats['explain']:
+                self.stdout.write("  plan:")
+                for line in stats['explain'].splitlines():
+                    self.stdout.write(f"    {line}")
+
+            self.stdout.write("")
@@ -0,0 +1,110 @@
+import threading
+from bisect import bisect_left
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, )
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, )
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, )
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus layout: per bucket counts, sum and count."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf', ), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class ViewMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.non_sql_time = Histogram(LATENCY_BUCKETS)
+        self.sql_time = Histogram(LATENCY_BUCKETS)
+        self.sql_queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.response_bytes = Histogram(BYTES_BUCKETS)
+        self.responses = {}
+
+
+class MetricsRegistry:
+    """
+    Process local store of per view metrics.
+
+    Each worker process exposes its own numbers, Prometheus sums them over the scraped targets.
+    """
+    HISTOGRAMS = [
+        ('shop_request_duration_seconds', 'latency', 'Request latency.'),
+        ('shop_request_non_sql_seconds', 'non_sql_time', 'Request time minus SQL time (views, serializers, rendering, middleware).'),
+        ('shop_request_sql_seconds', 'sql_time', 'Time spent in SQL queries.'),
+        ('shop_request_sql_queries', 'sql_queries', 'SQL queries per request.'),
+        ('shop_response_bytes', 'response_bytes', 'Response body size on the wire.'),
+    ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def record(self, view, method, status, duration, sql_time, sql_queries, response_bytes):
+        key = (view, method)
+        with self.lock:
+            metrics = self.views.get(key)
+            if metrics is None:
+                metrics = self.views[key] = ViewMetrics()
+
+            metrics.latency.observe(duration)
+            metrics.non_sql_time.observe(max(duration - sql_time, 0))
+            metrics.sql_time.observe(sql_time)
+            metrics.sql_queries.observe(sql_queries)
+            if response_bytes is not None:
+                metrics.response_bytes.observe(response_bytes)
+            metrics.responses[status] = metrics.responses.get(status, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+
+    def render(self, sample_rate):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = [
+            '# HELP shop_metrics_sample_rate Fraction of requests that are instrumented.',
+            '# TYPE shop_metrics_sample_rate gauge',
+            f'shop_metrics_sample_rate {sample_rate}',
+            '# HELP shop_responses_total Sampled responses by status code.',
+            '# TYPE shop_responses_total counter',
+        ]
+
+        with self.lock:
+            views = sorted(self.views.items())
+
+            for (view, method), metrics in views:
+                for status, count in sorted(metrics.responses.items()):
+                    lines.append(f'shop_responses_total{{view="{view}",method="{method}",status="{status}"}} {count}')
+
+            for name, attr, description in self.HISTOGRAMS:
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} histogram')
+                for (view, method), metrics in views:
+                    histogram = getattr(metrics, attr)
+                    if histogram.count:
+                        lines.extend(histogram.render(name, f'view="{view}",method="{method}"'))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,115 @@
+import random
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from .metrics import registry
+from .querylog import SlowQueryTracer, get_slow_query_settings, logger as slow_query_logger, record_slow_queries
+
+
+def get_metrics_settings():
+    return getattr(settings, 'SHOP_METRICS', {})
+
+
+def get_view_name(view_func):
+    """Names DRF actions like "ProductViewSet.list" and plain views by their function name."""
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return f"{view_func.__module__}.{getattr(view_func, '__name__', view_func.__class__.__name__)}"
+    return view_class.__name__
+
+
+class QueryTimer:
+    """execute_wrapper hook counting queries and summing their duration."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+
+class PerformanceMiddleware:
+    """
+    Records latency, SQL count and time and response size per DRF view and action.
+
+    Only a SHOP_METRICS['SAMPLE_RATE'] fraction of requests is instrumented,
+    the others pass through untouched.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample_rate = get_metrics_settings().get('SAMPLE_RATE', 1.0)
+        if sample_rate <= 0 or random.random() >= sample_rate:
+            return self.get_response(request)
+
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timer))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        view_name = getattr(request, '_metrics_view_name', None)
+        if view_name is None:
+            return response
+
+        response_bytes = None if response.streaming else len(response.content)
+        registry.record(view_name, request.method, response.status_code, duration, timer.duration, timer.count, response_bytes)
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_name = get_view_name(view_func)
+        actions = getattr(view_func, 'actions', None)
+        if actions:
+            action = actions.get(request.method.lower())
+            if action:
+                view_name = f"{view_name}.{action}"
+        request._metrics_view_name = view_name
+
+
+class SlowQueryMiddleware:
+    """
+    Logs queries slower than SHOP_SLOW_QUERIES['THRESHOLD_MS'] with the url name and shop/ call site.
+
+    The queries are stored once the response is ready, outside of the traced block,
+    so recording them never shows up as slow queries themselves.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        slow_query_settings = get_slow_query_settings()
+        if not slow_query_settings.get('ENABLED', True):
+            return self.get_response(request)
+
+        threshold = slow_query_settings.get('THRESHOLD_MS', 100) / 1000
+        tracers = [SlowQueryTracer(connection, threshold) for connection in connections.all()]
+
+        with ExitStack() as stack:
+            for tracer in tracers:
+                stack.enter_context(tracer.connection.execute_wrapper(tracer))
+            response = self.get_response(request)
+
+        if any(tracer.slow_queries for tracer in tracers):
+            resolver_match = getattr(request, 'resolver_match', None)
+            # Diagnostics only, a failure to store them must not fail the response
+            try:
+                record_slow_queries(tracers, resolver_match.url_name if resolver_match else '')
+            except Exception:
+                slow_query_logger.exception("Could not record the slow queries of %s", request.path)
+
+        return response
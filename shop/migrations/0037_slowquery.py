@@ -0,0 +1,34 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0036_cartitem_datetime_created_cartitem_datetime_modified_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowQuery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(db_index=True, max_length=40)),
+                ('url_name', models.CharField(blank=True, max_length=200)),
+                ('call_site', models.CharField(blank=True, max_length=500)),
+                ('normalized_sql', models.TextField()),
+                ('sample_sql', models.TextField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total_duration', models.FloatField(default=0)),
+                ('max_duration', models.FloatField(default=0)),
+                ('explain', models.TextField(blank=True)),
+                ('datetime_created', models.DateTimeField(auto_now_add=True)),
+                ('datetime_modified', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Slow Queries',
+                'unique_together': {('fingerprint', 'url_name', 'call_site')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0037_slowquery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductRanking',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ranking', serialize=False, to='shop.product')),
+                ('in_stock', models.BooleanField(default=True)),
+                ('total_sold', models.PositiveIntegerField(default=0)),
+                ('trending_score', models.FloatField(default=0)),
+                ('rating_score', models.FloatField(default=0)),
+                ('datetime_modified', models.DateTimeField(auto_now=True)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rankings', to='shop.category')),
+                ('subcategory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rankings', to='shop.subcategory')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['category', '-total_sold'], name='ranking_cat_sold_idx'), models.Index(fields=['subcategory', '-total_sold'], name='ranking_subcat_sold_idx'), models.Index(fields=['category', '-trending_score'], name='ranking_cat_trending_idx'), models.Index(fields=['subcategory', '-trending_score'], name='ranking_subcat_trending_idx'), models.Index(fields=['category', '-rating_score'], name='ranking_cat_rating_idx'), models.Index(fields=['subcategory', '-rating_score'], name='ranking_subcat_rating_idx')],
+            },
+        ),
+    ]
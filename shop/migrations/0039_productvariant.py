@@ -0,0 +1,46 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_product_variants(apps, schema_editor):
+    ProductAttribute = apps.get_model('shop', 'ProductAttribute')
+    ProductVariant = apps.get_model('shop', 'ProductVariant')
+
+    rows = ProductAttribute.objects.filter(quantity__gt=0).values_list('product_id', 'variable_id').distinct()
+    ProductVariant.objects.bulk_create(
+        [ProductVariant(product_id=product_id, variable_id=variable_id) for product_id, variable_id in rows],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0038_productranking'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['has_discount', 'discounted_price'], name='product_discounted_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['has_discount', 'price'], name='product_price_idx'),
+        ),
+        migrations.CreateModel(
+            name='ProductVariant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='shop.product')),
+                ('variable', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='product_variants', to='shop.variable')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='productvariant',
+            constraint=models.UniqueConstraint(fields=('variable', 'product'), name='unique_product_variant'),
+        ),
+        migrations.RunPython(fill_product_variants, migrations.RunPython.noop),
+    ]
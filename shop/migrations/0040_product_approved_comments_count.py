@@ -0,0 +1,42 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:49
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_approved_comments_count(apps, schema_editor):
+    Product = apps.get_model('shop', 'Product')
+    Comment = apps.get_model('shop', 'Comment')
+
+    approved = Comment.objects\
+        .filter(product_id=OuterRef('pk'), status='a')\
+        .order_by()\
+        .values('product_id')\
+        .annotate(count=Count('id'))\
+        .values('count')
+    Product.objects.update(approved_comments_count=Coalesce(Subquery(approved), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0039_productvariant'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='approved_comments_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['product', 'status', '-datetime_created'], name='comment_product_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['status', 'datetime_created'], name='comment_status_idx'),
+        ),
+        migrations.RunPython(fill_approved_comments_count, migrations.RunPython.noop),
+    ]
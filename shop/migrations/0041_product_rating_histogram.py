@@ -0,0 +1,61 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:50
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_rating_histograms(apps, schema_editor):
+    Product = apps.get_model('shop', 'Product')
+    ProductReview = apps.get_model('shop', 'ProductReview')
+
+    histograms = {}
+    for row in ProductReview.objects.order_by().values('product_id', 'review_rating').annotate(count=Count('id')):
+        histograms.setdefault(row['product_id'], {})[int(row['review_rating'])] = row['count']
+
+    products = []
+    for product in Product.objects.only('id').filter(pk__in=histograms):
+        for star in range(1, 6):
+            setattr(product, f'rating_{star}_count', histograms[product.id].get(star, 0))
+        products.append(product)
+    Product.objects.bulk_update(products, [f'rating_{star}_count' for star in range(1, 6)], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0040_product_approved_comments_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='productreview',
+            name='review_rating',
+            field=models.PositiveSmallIntegerField(choices=[(1, '1'), (2, '2'), (3, '3'), (4, '4'), (5, '5')]),
+        ),
+        migrations.RunPython(fill_rating_histograms, migrations.RunPython.noop),
+    ]
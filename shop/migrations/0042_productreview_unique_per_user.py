@@ -0,0 +1,87 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:51
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_reviews(apps, schema_editor):
+    """
+    Keeps the latest review of each user per product, the get-then-create race of
+    AddProductReviewSerializer could store several, then recomputes the rating
+    stats and the top rated score of the affected products.
+    """
+    Product = apps.get_model('shop', 'Product')
+    ProductRanking = apps.get_model('shop', 'ProductRanking')
+    ProductReview = apps.get_model('shop', 'ProductReview')
+
+    duplicates = ProductReview.objects\
+        .order_by()\
+        .values('product_id', 'user_id')\
+        .annotate(reviews=Count('id'), latest_id=Max('id'))\
+        .filter(reviews__gt=1)
+
+    product_ids = set()
+    for row in duplicates:
+        ProductReview.objects\
+            .filter(product_id=row['product_id'], user_id=row['user_id'])\
+            .exclude(pk=row['latest_id'])\
+            .delete()
+        product_ids.add(row['product_id'])
+
+    if not product_ids:
+        return
+
+    histograms = {product_id: {} for product_id in product_ids}
+    rows = ProductReview.objects\
+        .filter(product_id__in=product_ids)\
+        .order_by()\
+        .values('product_id', 'review_rating')\
+        .annotate(count=Count('id'))
+    for row in rows:
+        histograms[row['product_id']][int(row['review_rating'])] = row['count']
+
+    # Same as Product.set_rating_histogram and rankings.bayesian_rating
+    ranking_settings = getattr(settings, 'SHOP_RANKINGS', {})
+    prior_count = ranking_settings.get('RATING_PRIOR_COUNT', 10)
+    prior_mean = ranking_settings.get('RATING_PRIOR_MEAN', 3.0)
+
+    products = []
+    for product in Product.objects.only('id').filter(pk__in=product_ids):
+        histogram = histograms[product.id]
+        for star in range(1, 6):
+            setattr(product, f'rating_{star}_count', histogram.get(star, 0))
+        product.number_of_reviews = sum(histogram.values())
+        product.rates_average = sum(star * count for star, count in histogram.items()) / product.number_of_reviews \
+            if product.number_of_reviews else None
+        products.append(product)
+
+        ProductRanking.objects.filter(product_id=product.id).update(
+            rating_score=(prior_count * prior_mean + product.number_of_reviews * (product.rates_average or 0))
+            / (prior_count + product.number_of_reviews),
+        )
+
+    Product.objects.bulk_update(
+        products,
+        ['number_of_reviews', 'rates_average', *[f'rating_{star}_count' for star in range(1, 6)]],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0041_product_rating_histogram'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_reviews, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='productreview',
+            index=models.Index(fields=['product', '-datetime_created'], name='review_product_created_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='productreview',
+            constraint=models.UniqueConstraint(fields=('product', 'user'), name='unique_product_review_per_user'),
+        ),
+    ]
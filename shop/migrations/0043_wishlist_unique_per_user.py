@@ -0,0 +1,34 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:53
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_wishlists(apps, schema_editor):
+    """Keeps the oldest wish list of each user and moves the other lists' products into it."""
+    Wishlist = apps.get_model('shop', 'Wishlist')
+    WishlistItem = apps.get_model('shop', 'WishlistItem')
+
+    duplicated_users = Wishlist.objects.values('user_id').annotate(lists=Count('id')).filter(lists__gt=1)
+    for row in duplicated_users:
+        wish_list_ids = list(Wishlist.objects.filter(user_id=row['user_id']).order_by('id').values_list('id', flat=True))
+        kept_id, other_ids = wish_list_ids[0], wish_list_ids[1:]
+        for other_id in other_ids:
+            saved_product_ids = list(WishlistItem.objects.filter(wish_list_id=kept_id).values_list('product_id', flat=True))
+            WishlistItem.objects.filter(wish_list_id=other_id).exclude(product_id__in=saved_product_ids).update(wish_list_id=kept_id)
+        Wishlist.objects.filter(id__in=other_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0042_productreview_unique_per_user'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_wishlists, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='wishlist',
+            constraint=models.UniqueConstraint(fields=('user',), name='unique_wishlist_per_user'),
+        ),
+    ]
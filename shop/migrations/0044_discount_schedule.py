@@ -0,0 +1,28 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0043_wishlist_unique_per_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productattribute',
+            name='discount_schedule',
+            field=models.CharField(blank=True, choices=[('', 'Not scheduled'), ('p', 'Waiting for the campaign'), ('a', 'Activated by the campaign')], default='', help_text='Whether run_discount_schedules switches the discount on, or did', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='discount',
+            name='ends_at',
+            field=models.DateTimeField(blank=True, help_text='Campaign end, the discount never ends if empty', null=True),
+        ),
+        migrations.AddField(
+            model_name='discount',
+            name='starts_at',
+            field=models.DateTimeField(blank=True, help_text='Campaign start, the discount applies right away if empty', null=True),
+        ),
+    ]
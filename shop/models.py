@@ -1,13 +1,17 @@
 from core.models import CustomUser
 
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
-from django.db.models import Avg, Min, Count, Sum, F, Case, When, Value, IntegerField
+from django.db.models import Sum, F, Q, Case, When, Value, IntegerField
+from django.utils import timezone
 
 from uuid import uuid4
 import uuid
 
+from . import pricing
+
 
 class Category(models.Model):
     title = models.CharField(max_length=100)
@@ -39,6 +43,8 @@ class SubCategory(models.Model):
 class Discount(models.Model):
     discount = models.DecimalField(max_digits=3, decimal_places=0, validators=[MinValueValidator(0), MaxValueValidator(100)], verbose_name="discount_amount")
     description = models.CharField(max_length=255, blank=True)
+    starts_at = models.DateTimeField(blank=True, null=True, help_text="Campaign start, the discount applies right away if empty")
+    ends_at = models.DateTimeField(blank=True, null=True, help_text="Campaign end, the discount never ends if empty")
     datetime_created = models.DateTimeField(auto_now_add=True)
     datetime_modified = models.DateTimeField(auto_now=True)
 
@@ -48,6 +54,28 @@ class Discount(models.Model):
     def __str__(self):
         return f"{self.discount}"
 
+    @property
+    def is_scheduled(self):
+        return self.starts_at is not None or self.ends_at is not None
+
+    @staticmethod
+    def running_q(now=None):
+        """Discounts whose campaign window contains `now`."""
+        now = now or timezone.now()
+        return (Q(starts_at__isnull=True) | Q(starts_at__lte=now)) & (Q(ends_at__isnull=True) | Q(ends_at__gt=now))
+
+    def is_running(self, now=None):
+        now = now or timezone.now()
+        return (self.starts_at is None or self.starts_at <= now) and (self.ends_at is None or self.ends_at > now)
+
+    def has_ended(self, now=None):
+        now = now or timezone.now()
+        return self.ends_at is not None and self.ends_at <= now
+
+    def clean(self):
+        if self.starts_at and self.ends_at and self.ends_at <= self.starts_at:
+            raise ValidationError({'ends_at': 'The campaign must end after it starts.'})
+
 
 class Variable(models.Model):
     COLOR_TYPE = 'color'
@@ -83,9 +111,15 @@ class Product(models.Model):
     has_discount = models.BooleanField(default=False)
     rates_average = models.FloatField(null=True, blank=True)
     number_of_reviews = models.IntegerField(null=True, blank=True)
+    rating_1_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_5_count = models.PositiveIntegerField(default=0)
     in_stock = models.BooleanField(default=True)
     total_sold = models.PositiveIntegerField(default=0)
     stock_quantity = models.PositiveIntegerField(default=0)
+    approved_comments_count = models.PositiveIntegerField(default=0, editable=False)
     datetime_created = models.DateTimeField(auto_now_add=True)
     datetime_modified = models.DateTimeField(auto_now=True)
 
@@ -104,62 +138,42 @@ class Product(models.Model):
 
         return self._main_image
 
-    def calculate_stock_quantity(self, attributes=None):
-        """Returns total stock quantity for the product and sets in_stock."""
-        if attributes is None:
-            attributes = self.attributes.all()
-        total_quantity = attributes.aggregate(total_quantity=Sum('quantity'))['total_quantity']
-        self.stock_quantity = total_quantity or 0
-        self.in_stock = total_quantity > 0
-
-    def calculate_total_sold(self, attributes=None):
-        """Calculates total sold items for the product."""
-        if attributes is None:
-            attributes = self.attributes.all()
-        self.total_sold = attributes.aggregate(total_sold=Sum('total_sold'))['total_sold'] or 0
-
-    def update_review_stats(self, reviews=None):
-        """Update rates_average & number_of_reviews fields dynamicaly"""
-        review_stats = self.reviews.aggregate(
-            count=Count('id'),
-            avg_rating=Avg('review_rating')
-        )
-
-        self.number_of_reviews = review_stats['count']
-        self.rates_average = review_stats['avg_rating']
-
-    def update_dynamic_fields(self, attributes=None):
-        """Updates dynamic fields like price, discount, and review statistics."""
-        if attributes is None:
-            attributes = self.attributes.all()
-
-        discounted_attr = attributes.filter(
-            quantity__gt=0,
-            discount_active=True,
-            discount_amount__isnull=False,
-            discounted_price__isnull=False
-        ).order_by('discounted_price').only('price', 'discounted_price', 'discount_amount').first()
-
-        if discounted_attr:
-            self.price = discounted_attr.price
-            self.discounted_price = discounted_attr.discounted_price
-            self.discount_amount = discounted_attr.discount_amount
-            self.has_discount = True
-        else:
-            min_regular_price = attributes.filter(quantity__gt=0).aggregate(min_price=Min('price'))
-            self.price = min_regular_price['min_price'] if min_regular_price['min_price'] is not None else None
-            self.discounted_price = None
-            self.discount_amount = None
-            self.has_discount = False
+    RATING_COUNT_FIELDS = {1: 'rating_1_count', 2: 'rating_2_count', 3: 'rating_3_count', 4: 'rating_4_count', 5: 'rating_5_count'}
+
+    def rating_histogram(self):
+        return {star: getattr(self, field) for star, field in self.RATING_COUNT_FIELDS.items()}
+
+    def set_rating_histogram(self, counts):
+        """Sets the per star counts and derives number_of_reviews & rates_average from them."""
+        for star, field in self.RATING_COUNT_FIELDS.items():
+            setattr(self, field, counts.get(star, 0))
+
+        histogram = self.rating_histogram()
+        self.number_of_reviews = sum(histogram.values())
+        self.rates_average = sum(star * count for star, count in histogram.items()) / self.number_of_reviews \
+            if self.number_of_reviews else None
 
     class Meta:
         verbose_name_plural = '5. Products'
+        indexes = [
+            models.Index(fields=['has_discount', 'discounted_price'], name='product_discounted_price_idx'),
+            models.Index(fields=['has_discount', 'price'], name='product_price_idx'),
+        ]
 
     def __str__(self):
         return f"{self.title}"
 
 
 class ProductAttribute(models.Model):
+    DISCOUNT_SCHEDULE_NONE      = ''
+    DISCOUNT_SCHEDULE_PENDING   = 'p'
+    DISCOUNT_SCHEDULE_ACTIVATED = 'a'
+    DISCOUNT_SCHEDULE = [
+        (DISCOUNT_SCHEDULE_NONE     , 'Not scheduled'),
+        (DISCOUNT_SCHEDULE_PENDING  , 'Waiting for the campaign'),
+        (DISCOUNT_SCHEDULE_ACTIVATED, 'Activated by the campaign'),
+    ]
+
     title = models.CharField(max_length=300)
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="attributes")
     variable = models.ForeignKey(Variable, on_delete=models.CASCADE, related_name="products", blank=True)
@@ -170,6 +184,8 @@ class ProductAttribute(models.Model):
     discount = models.ForeignKey(Discount, on_delete=models.PROTECT, related_name="products", null=True, blank=True)
     discount_amount = models.DecimalField(max_digits=3, decimal_places=0, validators=[MinValueValidator(0), MaxValueValidator(100)], null=True, blank=True)
     discount_active = models.BooleanField(default=False)
+    discount_schedule = models.CharField(max_length=1, choices=DISCOUNT_SCHEDULE, default=DISCOUNT_SCHEDULE_NONE, blank=True,
+                                         help_text="Whether run_discount_schedules switches the discount on, or did")
     datetime_created = models.DateTimeField(auto_now_add=True)
     datetime_modified = models.DateTimeField(auto_now=True)
 
@@ -177,10 +193,19 @@ class ProductAttribute(models.Model):
         if not self.discount or not self.discount_active:
             return None
         
-        discount_value = (self.price) * (self.discount.discount / 100)
-        return self.price - discount_value
+        return pricing.discounted_price(self.price, self.discount.discount)
 
     def save(self, *args, **kwargs):
+        # Scheduled discounts are switched on and off by `manage.py run_discount_schedules`
+        if self.discount and not self.discount.is_running():
+            self.discount_active = False
+            if not self.discount.has_ended():
+                self.discount_schedule = self.DISCOUNT_SCHEDULE_PENDING
+
+        # A discount turned off by hand stays off, the schedule only activates pending attributes once
+        if not self.discount or (self.discount_schedule == self.DISCOUNT_SCHEDULE_ACTIVATED and not self.discount_active):
+            self.discount_schedule = self.DISCOUNT_SCHEDULE_NONE
+
         if self.discount_active and self.discount:
             self.discounted_price = self.calculate_discounted_price()
             self.discount_amount = self.discount.discount
@@ -197,6 +222,25 @@ class ProductAttribute(models.Model):
         return f"{self.title}"
 
 
+class ProductVariant(models.Model):
+    """
+    An in stock variable (size, color) of a product, maintained by bulk_updates.recompute_products.
+
+    The size and color filters look products up through the (variable, product) index
+    instead of joining and scanning ProductAttribute.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="variants")
+    variable = models.ForeignKey(Variable, on_delete=models.CASCADE, related_name="product_variants")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['variable', 'product'], name='unique_product_variant'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} {self.variable_id}"
+
+
 class Image(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="images")
     image = models.ImageField(upload_to='product_images/')
@@ -225,14 +269,18 @@ class Comment(models.Model):
 
     class Meta:
         verbose_name_plural='7. Comments'
+        indexes = [
+            models.Index(fields=['product', 'status', '-datetime_created'], name='comment_product_status_idx'),
+            models.Index(fields=['status', 'datetime_created'], name='comment_status_idx'),
+        ]
 
 
 class ProductReview(models.Model):
-    STAR_1 = '1'
-    STAR_2 = '2'
-    STAR_3 = '3'
-    STAR_4 = '4'
-    STAR_5 = '5'
+    STAR_1 = 1
+    STAR_2 = 2
+    STAR_3 = 3
+    STAR_4 = 4
+    STAR_5 = 5
     STAR = [
         (STAR_1, '1'),
         (STAR_2, '2'),
@@ -243,12 +291,18 @@ class ProductReview(models.Model):
 
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="reviews")
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="reviews")
-    review_rating = models.CharField(choices=STAR, max_length=2)
+    review_rating = models.PositiveSmallIntegerField(choices=STAR)
     datetime_created = models.DateTimeField(auto_now_add=True)
     datetime_modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name_plural='8. Reviews'
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'user'], name='unique_product_review_per_user'),
+        ]
+        indexes = [
+            models.Index(fields=['product', '-datetime_created'], name='review_product_created_idx'),
+        ]
 
 
 class Cart(models.Model):
@@ -273,6 +327,11 @@ class Wishlist(models.Model):
     datetime_created = models.DateTimeField(auto_now_add=True)
     datetime_modified = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user'], name='unique_wishlist_per_user'),
+        ]
+
 
 class WishlistItem(models.Model):
     wish_list = models.ForeignKey(Wishlist, on_delete=models.CASCADE, related_name="items")
@@ -363,11 +422,11 @@ class Order(models.Model):
             if not Order.objects.filter(tracking_code=code).exists():
                 return code
 
-    def calculate_totals(self):
-        """Calculate and update all total fields using database-level calculations"""
-        # Calculate products total price and total discount in a single query
-        totals = self.items.aggregate(
-            products_total=Sum(
+    @staticmethod
+    def totals_aggregates():
+        """Aggregates of OrderItem rows giving the products total and total discount of an order"""
+        return {
+            'products_total': Sum(
                 Case(
                     When(
                         discount_active=True,
@@ -378,7 +437,7 @@ class Order(models.Model):
                     output_field=IntegerField()
                 )
             ),
-            total_discount=Sum(
+            'total_discount': Sum(
                 Case(
                     When(
                         discount_active=True,
@@ -387,11 +446,19 @@ class Order(models.Model):
                     default=Value(0),
                     output_field=IntegerField()
                 )
-            )
-        )
+            ),
+        }
 
-        self.products_total_price = totals['products_total'] or 0
-        self.order_total_discount = totals['total_discount'] or 0
+    def calculate_totals(self):
+        """Calculate and update all total fields using database-level calculations"""
+        # Calculate products total price and total discount in a single query
+        totals = self.items.aggregate(**self.totals_aggregates())
+
+        self.set_totals(totals['products_total'], totals['total_discount'])
+
+    def set_totals(self, products_total, total_discount):
+        self.products_total_price = products_total or 0
+        self.order_total_discount = total_discount or 0
         
         # Calculate total price including shipping
         if self.shipping_price is None:
@@ -430,28 +497,164 @@ class OrderItem(models.Model):
 
     def get_item_total_price(self):
         if self.discount_active and self.discount:
-            return self.discounted_price * self.quantity
-        return self.price * self.quantity
+            return pricing.line_total(self.price, self.quantity, self.discounted_price)
+        return pricing.line_total(self.price, self.quantity)
 
     def calculate_discounted_price(self):
         if not self.discount or not self.discount_active:
             return None
 
-        discount_value = (self.price) * (self.discount / 100)
-        return int(self.price - discount_value)
+        return pricing.discounted_price(self.price, self.discount)
 
     def save(self, *args, **kwargs):
         self.title = self.product.title
-        super().save(*args, **kwargs)
 
         if self.discount_active and self.discount:
             self.discounted_price = self.calculate_discounted_price()
         else:
             self.discounted_price = None
 
+        super().save(*args, **kwargs)
+
     class Meta:
         unique_together = [['order', 'product']]
         verbose_name_plural='OrderItems'
 
     def __str__(self):
         return f"OrderItem {self.id}: {self.product}({self.variable}) X {self.quantity}."
+
+
+class SlowQuery(models.Model):
+    """Queries over SHOP_SLOW_QUERIES['THRESHOLD_MS'], aggregated per fingerprint, endpoint and call site."""
+    fingerprint = models.CharField(max_length=40, db_index=True)
+    url_name = models.CharField(max_length=200, blank=True)
+    call_site = models.CharField(max_length=500, blank=True)
+    normalized_sql = models.TextField()
+    sample_sql = models.TextField()
+    count = models.PositiveIntegerField(default=0)
+    total_duration = models.FloatField(default=0)
+    max_duration = models.FloatField(default=0)
+    explain = models.TextField(blank=True)
+    datetime_created = models.DateTimeField(auto_now_add=True)
+    datetime_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [['fingerprint', 'url_name', 'call_site']]
+        verbose_name_plural = 'Slow Queries'
+
+    def __str__(self):
+        return f"{self.fingerprint[:12]} x {self.count}"
+
+
+class ProductRanking(models.Model):
+    """
+    Precomputed ranking scores of a product, one row per product.
+
+    The (category|subcategory, score) indexes let the best seller, top rated and
+    trending listings read a bounded top-N without ordering the whole catalog.
+    """
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name="ranking")
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="rankings")
+    subcategory = models.ForeignKey(SubCategory, on_delete=models.CASCADE, related_name="rankings")
+    in_stock = models.BooleanField(default=True)
+    total_sold = models.PositiveIntegerField(default=0)
+    trending_score = models.FloatField(default=0)
+    rating_score = models.FloatField(default=0)
+    datetime_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['category', '-total_sold'], name='ranking_cat_sold_idx'),
+            models.Index(fields=['subcategory', '-total_sold'], name='ranking_subcat_sold_idx'),
+            models.Index(fields=['category', '-trending_score'], name='ranking_cat_trending_idx'),
+            models.Index(fields=['subcategory', '-trending_score'], name='ranking_subcat_trending_idx'),
+            models.Index(fields=['category', '-rating_score'], name='ranking_cat_rating_idx'),
+            models.Index(fields=['subcategory', '-rating_score'], name='ranking_subcat_rating_idx'),
+        ]
+
+    def __str__(self):
+        return f"Ranking of product {self.product_id}"
+
+
+class OutboxEvent(models.Model):
+    """
+    A change whose side effects are applied by `manage.py run_outbox`, see shop/outbox.py.
+
+    Written by the signal receivers in the transaction of the change itself and
+    deleted once handled. `available_at` is pushed forward while a worker holds
+    the event and after a failure (retry backoff).
+    """
+    topic = models.CharField(max_length=50)
+    object_id = models.BigIntegerField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    datetime_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['available_at', 'id'], name='outbox_available_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.topic} {self.object_id}"
+
+
+class Task(models.Model):
+    """
+    A deferred call of a function registered with `shop.tasks.task`, run by `manage.py run_tasks`.
+
+    Deleted once it ran, kept with status FAILED after its last attempt. Like OutboxEvent,
+    `available_at` is pushed forward while a worker holds the task and after a failure.
+    """
+    STATUS_QUEUED = 'q'
+    STATUS_FAILED = 'f'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    kwargs = models.JSONField(default=dict, blank=True)
+    priority = models.SmallIntegerField(default=0, help_text="Higher runs first.")
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    last_error = models.TextField(blank=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    datetime_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-priority', 'available_at', 'id'], name='task_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} {self.kwargs}"
+
+
+class IdempotencyKey(models.Model):
+    """
+    The first response to a write sent with an `Idempotency-Key` header, see shop/idempotency.py.
+
+    Replayed for retries of the same request until `expires_at`, expired rows are removed by
+    the purge_idempotency_keys task.
+    """
+    scope = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    body = models.BinaryField(blank=True)
+    expires_at = models.DateTimeField()
+    datetime_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='unique_idempotency_key_per_scope'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at'], name='idempotency_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key}"
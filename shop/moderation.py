@@ -0,0 +1,49 @@
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .caching import bump_catalog_cache_version
+from .models import Comment, Product
+
+
+# Products per UPDATE, keeps the id lists under the bound parameter limits
+PRODUCT_CHUNK_SIZE = 500
+
+
+def moderate_comments(queryset, status):
+    """
+    Sets the status of all comments of `queryset` with one UPDATE.
+
+    Product.approved_comments_count is then recounted for the affected products. Their
+    rows are locked first, so concurrent moderation of the same products runs one after
+    the other and every recount sees the comments the other one changed. Returns the
+    number of comments whose status changed.
+    """
+    with transaction.atomic():
+        changing = queryset.exclude(status=status)
+        product_ids = sorted(set(changing.order_by().values_list('product_id', flat=True)))
+
+        for start in range(0, len(product_ids), PRODUCT_CHUNK_SIZE):
+            list(Product.objects.select_for_update().filter(pk__in=product_ids[start:start + PRODUCT_CHUNK_SIZE]).order_by('pk').values_list('pk', flat=True))
+
+        updated = Comment.objects.filter(pk__in=changing.values('pk')).update(status=status)
+
+        if product_ids:
+            refresh_approved_comments_count(product_ids)
+            bump_catalog_cache_version()
+
+    return updated
+
+
+def refresh_approved_comments_count(product_ids):
+    approved = Comment.objects\
+        .filter(product_id=OuterRef('pk'), status=Comment.COMMENT_STATUS_APPROVED)\
+        .order_by()\
+        .values('product_id')\
+        .annotate(total=Count('id'))\
+        .values('total')
+
+    for start in range(0, len(product_ids), PRODUCT_CHUNK_SIZE):
+        Product.objects.filter(pk__in=product_ids[start:start + PRODUCT_CHUNK_SIZE]).update(
+            approved_comments_count=Coalesce(Subquery(approved), 0),
+        )
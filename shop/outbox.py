@@ -0,0 +1,125 @@
+import traceback
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from . import workers
+from .bulk_updates import recompute_order_totals, recompute_products, refresh_attribute_dependents,\
+    sync_unpaid_order_shipping
+from .caching import bump_catalog_cache_version
+from .models import OutboxEvent, Product
+from .rankings import refresh_product_rankings
+
+
+def get_outbox_settings():
+    return getattr(settings, 'SHOP_OUTBOX', {})
+
+
+def publish(topic, object_id):
+    """
+    Records that `object_id` of `topic` changed, in the current transaction.
+
+    With SHOP_OUTBOX['INLINE'] the handler runs right after the commit instead.
+    """
+    if get_outbox_settings().get('INLINE', False):
+        transaction.on_commit(lambda: dispatch(topic, {object_id}))
+    else:
+        OutboxEvent.objects.create(topic=topic, object_id=object_id)
+
+
+def handle_attributes(attribute_ids):
+    refresh_attribute_dependents(attribute_ids)
+
+
+def handle_products(product_ids):
+    existing_ids = set(Product.objects.filter(pk__in=product_ids).values_list('pk', flat=True))
+    recompute_products(existing_ids)
+    refresh_product_rankings(existing_ids)
+    bump_catalog_cache_version()
+
+
+# Every handler takes a set of ids and is idempotent, so events can be merged and replayed
+HANDLERS = {
+    'attribute': handle_attributes,
+    'product': handle_products,
+    'order': recompute_order_totals,
+    'shipping_method': sync_unpaid_order_shipping,
+}
+
+
+def dispatch(topic, object_ids):
+    with transaction.atomic():
+        HANDLERS[topic](object_ids)
+
+
+def claim_events(batch_size, lease_seconds):
+    """Leases the next `batch_size` available events to this worker, see workers.claim."""
+    event_ids = workers.claim(OutboxEvent.objects.all(), batch_size, lease_seconds)
+    return list(OutboxEvent.objects.filter(id__in=event_ids).values_list('id', 'topic', 'object_id', 'datetime_created'))
+
+
+def coalesce(events, chunk_size):
+    """
+    Merges the events of a batch into (topic, object ids, event ids) jobs.
+
+    Repeated events for the same object are handled once, the objects of a topic are
+    split into chunks of `chunk_size` so the jobs can be spread over worker processes.
+    """
+    objects = defaultdict(lambda: defaultdict(list))
+    for event_id, topic, object_id, datetime_created in events:
+        objects[topic][object_id].append(event_id)
+
+    jobs = []
+    for topic, event_ids in objects.items():
+        object_ids = sorted(event_ids)
+        for start in range(0, len(object_ids), chunk_size):
+            chunk = object_ids[start:start + chunk_size]
+            jobs.append((topic, chunk, [event_id for object_id in chunk for event_id in event_ids[object_id]]))
+    return jobs
+
+
+def run_job(job):
+    """Handles one coalesced job, returns its event ids and the error, if any."""
+    topic, object_ids, event_ids = job
+    try:
+        dispatch(topic, set(object_ids))
+    except Exception:
+        return event_ids, traceback.format_exc()
+    return event_ids, None
+
+
+def acknowledge(event_ids):
+    OutboxEvent.objects.filter(id__in=event_ids).delete()
+
+
+def retry_later(event_ids, error):
+    """Makes the events available again after an exponential backoff."""
+    max_backoff = get_outbox_settings().get('MAX_BACKOFF_SECONDS', 600)
+    workers.retry_later(OutboxEvent.objects.filter(id__in=event_ids), error, max_backoff)
+
+
+def get_outbox_stats():
+    """Pending events and the age of the oldest one, the lag of the side effects behind the changes."""
+    stats = OutboxEvent.objects.aggregate(oldest=Min('datetime_created'))
+    pending = OutboxEvent.objects.count()
+    failing = OutboxEvent.objects.filter(attempts__gt=0).count()
+    lag = (timezone.now() - stats['oldest']).total_seconds() if stats['oldest'] else 0
+    return {'pending': pending, 'failing': failing, 'lag_seconds': lag}
+
+
+def render_outbox_metrics():
+    stats = get_outbox_stats()
+    return '\n'.join([
+        '# HELP shop_outbox_pending_events Outbox events not handled yet.',
+        '# TYPE shop_outbox_pending_events gauge',
+        f"shop_outbox_pending_events {stats['pending']}",
+        '# HELP shop_outbox_failing_events Outbox events waiting for a retry.',
+        '# TYPE shop_outbox_failing_events gauge',
+        f"shop_outbox_failing_events {stats['failing']}",
+        '# HELP shop_outbox_lag_seconds Age of the oldest pending outbox event.',
+        '# TYPE shop_outbox_lag_seconds gauge',
+        f"shop_outbox_lag_seconds {stats['lag_seconds']}",
+    ]) + '\n'
@@ -1,5 +1,66 @@
-from rest_framework.pagination import PageNumberPagination
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+
+from rest_framework.pagination import PageNumberPagination, CursorPagination
 
 
 class CustomPagination(PageNumberPagination):
     page_size = 10
+
+
+class OrderCursorPagination(CursorPagination):
+    page_size = 10
+    ordering = ('-datetime_created', '-id', )
+
+
+class CommentCursorPagination(CursorPagination):
+    page_size = 20
+    ordering = ('-datetime_created', '-id', )
+
+
+class ModerationCursorPagination(CursorPagination):
+    page_size = 100
+    ordering = ('datetime_created', 'id', )
+
+
+class ReviewCursorPagination(CursorPagination):
+    page_size = 20
+    ordering = ('-datetime_created', '-id', )
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Admin paginator that reads the planner's row estimate of unfiltered tables instead of COUNT(*).
+
+    The estimate is only used above `estimate_threshold` rows, on PostgreSQL and MySQL;
+    filtered changelists, small tables and other databases get an exact count.
+    """
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        estimate = self.get_estimate()
+        if estimate is not None and estimate >= self.estimate_threshold:
+            return estimate
+        return super().count
+
+    def get_estimate(self):
+        queryset = self.object_list
+        if not isinstance(queryset, QuerySet) or queryset.query.where or queryset.query.distinct:
+            return None
+
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+        if connection.vendor == 'postgresql':
+            sql = "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)"
+        elif connection.vendor == 'mysql':
+            sql = "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+        else:
+            return None
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            row = cursor.fetchone()
+        return int(row[0]) if row and row[0] is not None else None
@@ -0,0 +1,86 @@
+from decimal import Decimal, ROUND_HALF_UP
+from typing import NamedTuple
+
+from django.db.models import BigIntegerField, ExpressionWrapper, Value
+from django.db.models.functions import Cast, Floor
+
+
+# Prices are stored as DecimalField(decimal_places=0), whole units of the currency, so the
+# unit is also the minor unit and prices are handled as ints. Percentages are applied with
+# integer arithmetic rounded half away from zero, in Python and in the *_expression
+# versions used in set based updates alike, so both give the same numbers.
+
+
+def to_minor(value):
+    """Stored price (Decimal, int or None) to an int number of minor units."""
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value
+    return int(Decimal(value).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def divide_rounded(numerator, denominator):
+    quotient, remainder = divmod(abs(numerator), denominator)
+    if remainder * 2 >= denominator:
+        quotient += 1
+    return quotient if numerator >= 0 else -quotient
+
+
+def discounted_price(price, percent):
+    """`price` with `percent` off, e.g. discounted_price(1005, 15) == 854."""
+    return divide_rounded(to_minor(price) * (100 - to_minor(percent)), 100)
+
+
+def adjusted_price(price, percent):
+    """`price` changed by `percent`, adjusted_price(1000, -10) == 900."""
+    return divide_rounded(to_minor(price) * (100 + to_minor(percent)), 100)
+
+
+def divide_rounded_expression(numerator, denominator):
+    """SQL version of `divide_rounded` for a numerator of 0 or more, exact on every backend (no float division)."""
+    return Floor(ExpressionWrapper((numerator + Value(denominator // 2)) / Value(denominator), output_field=BigIntegerField()))
+
+
+def discounted_price_expression(price, percent):
+    """SQL version of `discounted_price` for set based updates, `price` and `percent` are expressions."""
+    return divide_rounded_expression(Cast(price, BigIntegerField()) * (Value(100) - percent), 100)
+
+
+def adjusted_price_expression(price, percent):
+    return divide_rounded_expression(Cast(price, BigIntegerField()) * (Value(100) + percent), 100)
+
+
+class Totals(NamedTuple):
+    line_totals: list
+    total_price: int
+    total_discount: int
+
+
+def line_total(price, quantity, discounted=None):
+    """What `quantity` units cost, at the discounted price when there is one."""
+    unit_price = to_minor(price) if discounted is None else to_minor(discounted)
+    return unit_price * quantity
+
+
+def price_lines(lines):
+    """
+    Prices many (price, discounted_price or None, quantity) lines in one pass.
+
+    Returns the line totals in order, their sum and the total discount, the same
+    numbers as Order.totals_aggregates computes in SQL.
+    """
+    line_totals = []
+    total_price = total_discount = 0
+
+    for price, discounted, quantity in lines:
+        price = to_minor(price)
+        if discounted is None:
+            total = price * quantity
+        else:
+            total = to_minor(discounted) * quantity
+            total_discount += price * quantity - total
+        line_totals.append(total)
+        total_price += total
+
+    return Totals(line_totals, total_price, total_discount)
@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import os
+import re
+import time
+import traceback
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+
+logger = logging.getLogger('shop.slow_queries')
+
+SHOP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Frames of the tracing machinery itself are never reported as the call site
+IGNORED_FILES = {
+    os.path.join(SHOP_DIR, 'querylog.py'),
+    os.path.join(SHOP_DIR, 'middleware.py'),
+}
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+STRING_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+IN_LIST_RE = re.compile(r'\bIN\s*\((?:\s*\?\s*,?)+\)', re.IGNORECASE)
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def get_slow_query_settings():
+    return getattr(settings, 'SHOP_SLOW_QUERIES', {})
+
+
+def normalize_sql(sql):
+    """Replaces literals and placeholders by "?" so queries that differ by values share a fingerprint."""
+    sql = STRING_LITERAL_RE.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = NUMBER_RE.sub('?', sql)
+    sql = IN_LIST_RE.sub('IN (...)', sql)
+    return WHITESPACE_RE.sub(' ', sql).strip()
+
+
+def fingerprint_sql(normalized_sql):
+    return hashlib.sha1(normalized_sql.encode()).hexdigest()
+
+
+def get_call_site():
+    """Returns "path:line in function" of the innermost shop/ frame that issued the query."""
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(SHOP_DIR) and filename not in IGNORED_FILES:
+            return f"{os.path.relpath(filename, os.path.dirname(SHOP_DIR))}:{frame.lineno} in {frame.name}"
+    return ''
+
+
+class SlowQueryTracer:
+    """execute_wrapper hook that keeps the queries slower than the threshold of one request."""
+
+    def __init__(self, connection, threshold):
+        self.connection = connection
+        self.threshold = threshold
+        self.slow_queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            if duration >= self.threshold:
+                self.slow_queries.append({
+                    'sql': sql,
+                    'params': None if many else params,
+                    'duration': duration,
+                    'call_site': get_call_site(),
+                })
+
+
+def explain(connection, sql, params):
+    prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+    if prefix is None or not sql.lstrip().upper().startswith('SELECT'):
+        return ''
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+    except Exception as error:
+        return f"EXPLAIN failed: {error}"
+
+
+def record_slow_queries(tracers, url_name):
+    """Aggregates the slow queries of one request into SlowQuery rows, one per fingerprint and call site."""
+    from .models import SlowQuery
+
+    capture_explain = get_slow_query_settings().get('EXPLAIN', False)
+    groups = defaultdict(list)
+
+    for tracer in tracers:
+        for query in tracer.slow_queries:
+            normalized = normalize_sql(query['sql'])
+            groups[(fingerprint_sql(normalized), query['call_site'])].append((tracer.connection, normalized, query))
+
+    for (fingerprint, call_site), queries in groups.items():
+        connection, normalized, slowest = max(queries, key=lambda item: item[2]['duration'])
+        total = sum(item[2]['duration'] for item in queries)
+
+        logger.warning(
+            "Slow query %.1f ms on %s at %s: %s",
+            slowest['duration'] * 1000, url_name or '-', call_site or '-', normalized,
+        )
+
+        lookup = SlowQuery.objects.filter(fingerprint=fingerprint, url_name=url_name, call_site=call_site)
+        increments = {
+            'count': F('count') + len(queries),
+            'total_duration': F('total_duration') + total,
+            'max_duration': Greatest(F('max_duration'), slowest['duration']),
+        }
+        if lookup.update(**increments):
+            continue
+
+        plan = explain(connection, slowest['sql'], slowest['params']) if capture_explain else ''
+        try:
+            with transaction.atomic():
+                SlowQuery.objects.create(
+                    fingerprint=fingerprint,
+                    url_name=url_name,
+                    call_site=call_site,
+                    normalized_sql=normalized,
+                    sample_sql=slowest['sql'],
+                    count=len(queries),
+                    total_duration=total,
+                    max_duration=slowest['duration'],
+                    explain=plan,
+                )
+        except IntegrityError:
+            # Another worker created the row in the meantime
+            lookup.update(**increments)
@@ -0,0 +1,106 @@
+import math
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from .models import Product, ProductRanking
+
+
+# Trending scores are stored relative to this fixed point in time, see `sale_weight`
+TRENDING_EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+RANKINGS = {
+    'best_sellers': 'total_sold',
+    'top_rated': 'rating_score',
+    'trending': 'trending_score',
+}
+
+
+def get_ranking_settings():
+    return getattr(settings, 'SHOP_RANKINGS', {})
+
+
+def sale_weight(quantity, when=None):
+    """
+    Weight of `quantity` units sold at `when` for the time decayed trending score.
+
+    Instead of decaying every score as time passes, each sale is weighted by
+    2 ** (age of the epoch / half life). Ordering by the sum of the weights equals
+    ordering by the decayed sales at any moment, so a sale is a single increment.
+    Floats overflow after about 1000 half lives, move TRENDING_EPOCH forward and run
+    `manage.py rebuild_product_rankings` well before that.
+    """
+    when = when or timezone.now()
+    half_life = get_ranking_settings().get('TRENDING_HALF_LIFE_DAYS', 7) * 86400
+    return quantity * math.pow(2, (when - TRENDING_EPOCH).total_seconds() / half_life)
+
+
+def bayesian_rating(rates_average, number_of_reviews):
+    """Shrinks the average of products with few reviews towards RATING_PRIOR_MEAN."""
+    ranking_settings = get_ranking_settings()
+    prior_count = ranking_settings.get('RATING_PRIOR_COUNT', 10)
+    prior_mean = ranking_settings.get('RATING_PRIOR_MEAN', 3.0)
+    count = number_of_reviews or 0
+    average = rates_average or 0
+    return (prior_count * prior_mean + count * average) / (prior_count + count)
+
+
+def refresh_product_ranking(product_id):
+    """Copies the catalog columns of a product into its ranking row, creating it if needed."""
+    product = Product.objects\
+        .only('category_id', 'subcategory_id', 'in_stock', 'total_sold', 'rates_average', 'number_of_reviews')\
+        .filter(pk=product_id)\
+        .first()
+
+    # The product is being deleted, its ranking row goes with it
+    if product is None:
+        return
+
+    ProductRanking.objects.update_or_create(
+        product_id=product.id,
+        defaults={
+            'category_id': product.category_id,
+            'subcategory_id': product.subcategory_id,
+            'in_stock': product.in_stock,
+            'total_sold': product.total_sold,
+            'rating_score': bayesian_rating(product.rates_average, product.number_of_reviews),
+        },
+    )
+
+
+def refresh_product_rankings(product_ids):
+    """Batch refresh_product_ranking for stock and sales changes, one UPDATE for the existing rows."""
+    product_ids = set(product_ids)
+    products = Product.objects.filter(pk=OuterRef('product_id'))
+    ProductRanking.objects.filter(product_id__in=product_ids).update(
+        in_stock=Subquery(products.values('in_stock')[:1]),
+        total_sold=Subquery(products.values('total_sold')[:1]),
+    )
+
+    ranked_ids = set(ProductRanking.objects.filter(product_id__in=product_ids).values_list('product_id', flat=True))
+    for product_id in product_ids - ranked_ids:
+        refresh_product_ranking(product_id)
+
+
+def add_sales(quantities, when=None):
+    """Adds paid quantities, {product_id: quantity}, to the trending scores."""
+    for product_id, quantity in quantities.items():
+        updated = ProductRanking.objects.filter(product_id=product_id)\
+            .update(trending_score=F('trending_score') + sale_weight(quantity, when))
+        if not updated:
+            refresh_product_ranking(product_id)
+            ProductRanking.objects.filter(product_id=product_id)\
+                .update(trending_score=F('trending_score') + sale_weight(quantity, when))
+
+
+def get_ranked_product_ids(ranking, limit, category_slug=None, subcategory_slug=None):
+    queryset = ProductRanking.objects.filter(in_stock=True)
+
+    if category_slug:
+        queryset = queryset.filter(category__slug=category_slug)
+    if subcategory_slug:
+        queryset = queryset.filter(subcategory__slug=subcategory_slug)
+
+    return list(queryset.order_by(f'-{RANKINGS[ranking]}').values_list('product_id', flat=True)[:limit])
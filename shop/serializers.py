@@ -4,7 +4,8 @@ import re
 
 from config import settings
 
-from core.models import CustomUser
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
 
 from .models import Product,\
     ProductAttribute,\
@@ -21,14 +22,133 @@ from .models import Product,\
     Wishlist,\
     WishlistItem,\
     Image
+from .pricing import line_total, price_lines
+
+
+def split_query_param(value):
+    """Turns a comma separated query param like "id,slug,title" into a list of names."""
+    if not value:
+        return []
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+class DynamicFieldsMixin:
+    """
+    Sparse fieldsets for ModelSerializers.
+
+    `?fields=id,slug` keeps only the listed fields and `?expand=attributes` turns on
+    the fields listed in `expandable_fields`, which are left out by default.
+    The selection is read from the context ("fields"/"expand") or from the request,
+    so only the top level serializer of a response is pruned.
+    `get_model_columns` tells the view which columns to load with QuerySet.only().
+    """
+    expandable_fields = []
+    # Model columns read by SerializerMethodFields, keyed by the serializer field name.
+    method_field_columns = {}
+    # Model columns read in to_representation no matter which fields are selected.
+    required_columns = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        requested, expand = self.get_field_selection()
+
+        for name in self.expandable_fields:
+            if name not in expand and name not in requested:
+                self.fields.pop(name, None)
+
+        if requested:
+            for name in set(self.fields) - set(requested):
+                self.fields.pop(name)
+
+    def get_field_selection(self):
+        context = getattr(self, '_context', {})
+        request = context.get('request')
+        query_params = getattr(request, 'query_params', {})
+
+        requested = context.get('fields', split_query_param(query_params.get('fields')))
+        expand = context.get('expand', split_query_param(query_params.get('expand')))
+        return requested, expand
+
+    def get_model_columns(self):
+        model_meta = self.Meta.model._meta
+        concrete_fields = {field.name for field in model_meta.concrete_fields}
+        columns = {model_meta.pk.name, *self.required_columns}
+
+        for name, field in self.fields.items():
+            if name in self.method_field_columns:
+                columns.update(self.method_field_columns[name])
+            elif field.source in concrete_fields:
+                columns.add(field.source)
+
+        return sorted(columns)
+
+
+# checked
+class ProductAttributeInProductDetailSerializer(serializers.ModelSerializer):
+    price = serializers.IntegerField()
+    discounted_price = serializers.SerializerMethodField()
+    discount_amount = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ProductAttribute
+        fields = ['id', 'price', 'discounted_price', 'discount_amount', 'quantity', 'discount_active', ]
+
+    def get_discounted_price(self, obj):
+        return int(obj.discounted_price) if obj.discount_active and obj.quantity > 0 else None
+
+    def get_discount_amount(self, obj):
+        return int(obj.discount_amount) if obj.discount_active and obj.quantity > 0 else None
+
+    def to_representation(self, instance):
+        representation = super().to_representation(instance)
+
+        if instance.quantity == 0:
+            representation['price'] = 'This product is not in stock'
+
+        if instance.discount_active == False:
+            representation.pop('discounted_price')
+            representation.pop('discount_amount')
+
+        if instance.variable.variable_type == 'size':
+            representation['size'] = instance.variable.title
+        else:
+            representation['color'] = instance.variable.title
+            representation['color_code'] = instance.variable.color_code
+
+        return {key: val for key, val in representation.items() if val is not None}
+
+
+class ImageInProductDetailSerializer(serializers.ModelSerializer):
+    image = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = Image
+        fields = ["id", "image", ]
+
+    def get_image(self, obj:Image):
+        base_url = getattr(settings, 'SITE_URL')
+        if obj.image:
+            return base_url + obj.image.url
+        return None
 
 
 # checked
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     image = serializers.SerializerMethodField()
     price = serializers.IntegerField()
     discounted_price = serializers.IntegerField()
     discount_amount = serializers.IntegerField()
+    images = ImageInProductDetailSerializer(many=True)
+    attributes = ProductAttributeInProductDetailSerializer(many=True)
+    # Per shopper annotations, see ProductViewSet.annotate_shopper_state
+    in_wishlist = serializers.BooleanField(read_only=True)
+    in_cart_quantity = serializers.IntegerField(read_only=True)
+
+    expandable_fields = ['images', 'attributes', 'in_wishlist', 'in_cart_quantity', ]
+    method_field_columns = {'image': ['image', ]}
+    required_columns = ['price', 'rates_average', 'has_discount', ]
+
     class Meta:
         model = Product
         fields = ['id', 
@@ -42,21 +162,25 @@ class ProductSerializer(serializers.ModelSerializer):
                   'in_stock', 
                   'rates_average', 
                   'number_of_reviews', 
-                  'has_discount', ]
+                  'has_discount', 
+                  'images', 
+                  'attributes', 
+                  'in_wishlist', 
+                  'in_cart_quantity', ]
 
     def get_image(self, obj:Product):
         base_url = getattr(settings, 'SITE_URL')
-        if obj.image.url:
+        if obj.image:
             return base_url + obj.image.url
         return None
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
 
-        if instance.price == None:
+        if instance.price == None and 'price' in representation:
             representation["price"] = "This product is not in stock"
 
-        if instance.rates_average == None:
+        if instance.rates_average == None and 'number_of_reviews' in representation:
             representation["number_of_reviews"] = "No reviews have been recorded for this product"
 
         if instance.has_discount == False:
@@ -74,6 +198,26 @@ class CommentSerializer(serializers.ModelSerializer):
         fields = ["id", "user_name", "body", ]
 
 
+class ModerationCommentSerializer(serializers.ModelSerializer):
+    user_name = serializers.CharField(source="user.username")
+    product_title = serializers.CharField(source="product.title")
+    class Meta:
+        model = Comment
+        fields = ["id", "user_name", "product", "product_title", "body", "status", "datetime_created", ]
+
+
+class CommentModerationSerializer(serializers.Serializer):
+    status = serializers.ChoiceField(choices=[Comment.COMMENT_STATUS_APPROVED, Comment.COMMENT_STATUS_NOT_APPROVED, ])
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, max_length=10000)
+    all_waiting = serializers.BooleanField(default=False)
+    product = serializers.IntegerField(required=False)
+
+    def validate(self, data):
+        if not data.get('ids') and not data['all_waiting']:
+            raise serializers.ValidationError("Send the comment ids or set all_waiting to moderate every waiting comment.")
+        return data
+
+
 # checked
 class AddCommentSerializer(serializers.ModelSerializer):
     class Meta:
@@ -96,111 +240,64 @@ class AddCommentSerializer(serializers.ModelSerializer):
 
 
 # checked
-class ProductAttributeInProductDetailSerializer(serializers.ModelSerializer):
-    price = serializers.IntegerField()
-    discounted_price = serializers.SerializerMethodField()
-    discount_amount = serializers.SerializerMethodField()
-
-    class Meta:
-        model = ProductAttribute
-        fields = ['id', 'price', 'discounted_price', 'discount_amount', 'quantity', 'discount_active', ]
-
-    def get_discounted_price(self, obj):
-        return int(obj.discounted_price) if obj.discount_active and obj.quantity > 0 else None
-
-    def get_discount_amount(self, obj):
-        return int(obj.discount_amount) if obj.discount_active and obj.quantity > 0 else None
-
-    def to_representation(self, instance):
-        representation = super().to_representation(instance)
-
-        if instance.quantity == 0:
-            representation['price'] = 'This product is not in stock'
-
-        if instance.discount_active == False:
-            representation.pop('discounted_price')
-            representation.pop('discount_amount')
-
-        if instance.variable.variable_type == 'size':
-            representation['size'] = instance.variable.title
-        else:
-            representation['color'] = instance.variable.title
-            representation['color_code'] = instance.variable.color_code
-
-        return {key: val for key, val in representation.items() if val is not None}
-
-
-class ImageInProductDetailSerializer(serializers.ModelSerializer):
-    image = serializers.SerializerMethodField()
-    
-    class Meta:
-        model = Image
-        fields = ["id", "image", ]
-
-    def get_image(self, obj:Image):
-        base_url = getattr(settings, 'SITE_URL')
-        if obj.image.url:
-            return base_url + obj.image.url
-        return None
-
-
-# checked
-class ProductDetailSerializer(serializers.ModelSerializer):
+class ProductDetailSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     main_image = serializers.SerializerMethodField()
     images = ImageInProductDetailSerializer(many=True)
     attributes = ProductAttributeInProductDetailSerializer(many=True)
     default_attribute = serializers.SerializerMethodField()
-    
+
+    method_field_columns = {'main_image': ['image', ], 'default_attribute': []}
+    required_columns = ['rates_average', ]
+
     class Meta:
         model = Product
-        fields = ['id', 'title', 'description', 'in_stock', 'main_image', 'images', 'rates_average', 'number_of_reviews', 'default_attribute', 'attributes', ]
+        fields = ['id', 'title', 'description', 'in_stock', 'main_image', 'images', 'rates_average', 'number_of_reviews', 'approved_comments_count', 'default_attribute', 'attributes', ]
 
     def get_main_image(self, obj:Product):
         base_url = getattr(settings, 'SITE_URL')
-        if obj.image.url:
+        if obj.image:
             return base_url + obj.image.url
         return None
     
     def get_default_attribute(self, obj):
+        # Picked from the prefetched attributes to avoid extra queries
+        in_stock_attrs = [attr for attr in obj.attributes.all() if attr.quantity > 0]
+
         # First try to get discounted attributes with stock
-        discounted_attr = obj.attributes.filter(
-            quantity__gt=0,
-            discount_active=True,
-            discount_amount__isnull=False,
-            discounted_price__isnull=False
-        ).order_by('discounted_price').first()
-        
-        if discounted_attr:
+        discounted_attrs = [
+            attr for attr in in_stock_attrs
+            if attr.discount_active and attr.discount_amount is not None and attr.discounted_price is not None
+        ]
+
+        if discounted_attrs:
+            discounted_attr = min(discounted_attrs, key=lambda attr: attr.discounted_price)
             return ProductAttributeInProductDetailSerializer(discounted_attr).data
-            
+
         # If no discounted attributes, get regular attributes with stock
-        regular_attr = obj.attributes.filter(
-            quantity__gt=0
-        ).order_by('price').first()
-        
-        if regular_attr:
+        if in_stock_attrs:
+            regular_attr = min(in_stock_attrs, key=lambda attr: attr.price)
             return ProductAttributeInProductDetailSerializer(regular_attr).data
-            
+
         return None
     
     def to_representation(self, instance):
         representation = super().to_representation(instance)
 
-        if instance.rates_average == None:
+        if instance.rates_average == None and 'number_of_reviews' in representation:
             representation["number_of_reviews"] = "No reviews have been recorded for this product"
 
         return {key: val for key, val in representation.items() if val is not None}
 
 
 # checked
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = ['id', 'slug', 'title', ]
 
 
 # checked
-class SubCategorySerializer(serializers.ModelSerializer):
+class SubCategorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = SubCategory
         fields = ['id', 'slug', 'title', 'category', ]
@@ -280,7 +377,7 @@ class CartProductSerializer(serializers.ModelSerializer):
     def get_image(self, obj:ProductAttribute):
         base_url = getattr(settings, 'SITE_URL')
         product = obj.product
-        if product.image.url:
+        if product.image:
             return base_url + product.image.url
         return None
 
@@ -315,9 +412,8 @@ class CartItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'quantity', 'item_total_price', ]
 
     def get_item_total_price(self, obj: CartItem):
-        if obj.product.discount_active:
-            return int(obj.product.discounted_price * obj.quantity)
-        return int(obj.product.price * obj.quantity)
+        product = obj.product
+        return line_total(product.price, obj.quantity, product.discounted_price if product.discount_active else None)
 
 
 # checked
@@ -332,26 +428,22 @@ class CartSerializer(serializers.ModelSerializer):
         read_only_fields = ["id", ]
 
     def get_total_items(self, obj):
-        count = 0
-        for i in obj.items.all():
-            count += 1
-
-        return count
-
-    def get_total_discount(self, obj):
-        cart_total_dicount = []
+        return len(obj.items.all())
 
-        for item in obj.items.all():
-            if item.product.discount_active:
-                cart_total_dicount.append((item.product.price - item.product.discounted_price) * item.quantity)
+    def get_totals(self, cart: Cart):
+        """Prices all the items of the cart once for total_price and total_discount."""
+        if getattr(cart, '_totals', None) is None:
+            cart._totals = price_lines(
+                (item.product.price, item.product.discounted_price if item.product.discount_active else None, item.quantity)
+                for item in cart.items.all()
+            )
+        return cart._totals
 
-        return int(sum(cart_total_dicount))
+    def get_total_discount(self, cart: Cart):
+        return self.get_totals(cart).total_discount
 
     def get_total_price(self, cart: Cart):
-        return int(sum([item.quantity * item.product.discounted_price\
-                    if item.product.discount_active\
-                    else item.quantity * item.product.price\
-                    for item in cart.items.all()]))
+        return self.get_totals(cart).total_price
 
 
 # checked
@@ -390,7 +482,7 @@ class OrderItemProductSerializer(serializers.ModelSerializer):
     def get_image(self, obj:ProductAttribute):
         base_url = getattr(settings, 'SITE_URL')
         product = obj.product
-        if product.image.url:
+        if product.image:
             return base_url + product.image.url
         return None
 
@@ -469,6 +561,37 @@ class OrderSerializer(serializers.ModelSerializer):
         return obj.get_status_display()
 
 
+class OrderListSerializer(serializers.ModelSerializer):
+    """Compact order summary used by the order list, relies on the annotations of OrderViewSet."""
+    products_total_price = serializers.IntegerField()
+    order_total_discount = serializers.IntegerField()
+    order_total_price = serializers.IntegerField()
+    items_count = serializers.IntegerField()
+    image = serializers.SerializerMethodField()
+    status = serializers.SerializerMethodField()
+    class Meta:
+        model = Order
+        fields = ['id',
+                  'number',
+                  'status',
+                  'is_paid',
+                  'items_count',
+                  'image',
+                  'products_total_price',
+                  'order_total_discount',
+                  'order_total_price',
+                  'datetime_created', ]
+
+    def get_status(self, obj):
+        return obj.get_status_display()
+
+    def get_image(self, obj):
+        base_url = getattr(settings, 'SITE_URL')
+        if obj.first_item_image:
+            return base_url + default_storage.url(obj.first_item_image)
+        return None
+
+
 # checked
 class ProductReviewSerializer(serializers.ModelSerializer):
     user_name = serializers.CharField(source="user.username")
@@ -487,38 +610,54 @@ class AddProductReviewSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         user_id = self.context["user_id"]
         slug = self.context["slug"]
-        user = CustomUser.objects.get(id=user_id)
-        orders = Order.objects.filter(user=user).all()
-        titles = []
-        for order in orders:
-            product_titles = OrderItem.objects\
-                .select_related("product")\
-                .filter(order=order)\
-                .values_list('product__title', flat=True).distinct()
-            for title in product_titles:
-                titles.append(title)
 
         try:
-            product = Product.objects.get(slug=slug)
+            product = Product.objects.only("id").get(slug=slug)
         except Product.DoesNotExist:
             raise serializers.ValidationError("There is no product with this id.")
 
-        if product.title not in list(set(titles)):
+        if not OrderItem.objects.filter(order__user_id=user_id, product__product=product).exists():
             raise serializers.ValidationError("You must first purchase this product")
 
+        # The (product, user) unique constraint rejects a second review
         try:
-            review = ProductReview.objects.get(product=product, user_id=user_id)
+            with transaction.atomic():
+                review = ProductReview.objects.create(product=product, user_id=user_id, **validated_data)
+        except IntegrityError:
             raise serializers.ValidationError("You have already rated this product")
-        except ProductReview.DoesNotExist:
-            review = ProductReview.objects.create(product=product, user_id=user_id, **validated_data)
 
         self.instance = review
         return review
 
 
+class ProductCardSerializer(serializers.ModelSerializer):
+    """Just enough of a product to draw a card, used where products are nested in other resources."""
+    image = serializers.SerializerMethodField()
+    price = serializers.IntegerField()
+    discounted_price = serializers.IntegerField()
+
+    class Meta:
+        model = Product
+        fields = ['id', 'slug', 'title', 'image', 'price', 'discounted_price', 'has_discount', 'in_stock', ]
+
+    def get_image(self, obj:Product):
+        base_url = getattr(settings, 'SITE_URL')
+        if obj.image:
+            return base_url + obj.image.url
+        return None
+
+    def to_representation(self, instance):
+        representation = super().to_representation(instance)
+
+        if instance.has_discount == False:
+            representation.pop('discounted_price', None)
+
+        return representation
+
+
 # checked
 class WishlistItemSerializer(serializers.ModelSerializer):
-    product = ProductSerializer()
+    product = ProductCardSerializer()
     class Meta:
         model = WishlistItem
         fields = ["id", "product", ]
@@ -541,11 +680,12 @@ class WishlistCreateSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         user_id = self.context["user_id"]
 
+        # Idempotent: the unique constraint on user returns the existing wish list on a retry
         try:
+            with transaction.atomic():
+                wish_list = Wishlist.objects.create(user_id=user_id, **validated_data)
+        except IntegrityError:
             wish_list = Wishlist.objects.get(user_id=user_id)
-            raise serializers.ValidationError('You already have a wish list.')
-        except Wishlist.DoesNotExist:
-            wish_list = Wishlist.objects.create(user_id=user_id, **validated_data)
 
         self.instance = wish_list
         return wish_list
@@ -561,11 +701,20 @@ class AddWishlistItemSerializer(serializers.ModelSerializer):
         wishlist_id = self.context["wishlist_pk"]
         product = validated_data.get('product')
 
+        # Idempotent: adding a product twice returns the existing item
         try:
+            with transaction.atomic():
+                wishlist_item = WishlistItem.objects.create(wish_list_id=wishlist_id, **validated_data)
+        except IntegrityError:
             wishlist_item = WishlistItem.objects.get(wish_list_id=wishlist_id, product_id=product.id)
-            raise serializers.ValidationError("This Product is in your wish list.")
-        except WishlistItem.DoesNotExist:
-            wishlist_item = WishlistItem.objects.create(wish_list_id=wishlist_id, **validated_data)
 
         self.instance = wishlist_item
         return wishlist_item
+
+
+class WishlistMembershipSerializer(serializers.Serializer):
+    products = serializers.ListField(child=serializers.IntegerField(), max_length=200)
+
+
+class RemoveWishlistItemSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
@@ -1,27 +1,35 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models import F, Value, FloatField
+from django.db.models.functions import Cast, NullIf
 from django.dispatch import receiver
 
-from .models import ProductAttribute, CartItem, Order, OrderItem, Image, ShippingMethod, ProductReview
+from .caching import bump_catalog_cache_version
+from .outbox import publish
+from .rankings import refresh_product_ranking, add_sales
+from .tasks import send_email
+from .models import ProductAttribute, Order, OrderItem, Image, ShippingMethod, ProductReview,\
+    Product, Category, SubCategory, Comment
+
+@receiver(pre_save, sender=ProductAttribute)
+def remember_attribute_product(sender, instance, **kwargs):
+    instance._old_product_id = ProductAttribute.objects.filter(pk=instance.pk).values_list('product_id', flat=True).first() \
+        if instance.pk else None
 
 @receiver([post_save, post_delete], sender=ProductAttribute)
 def update_product_dynamic_fields(sender, instance, **kwargs):
-    product = instance.product  # Adjust this if your FK is named differently
-
-    attributes = product.attributes.all()
-    product.update_dynamic_fields(attributes=attributes)
-    product.calculate_total_sold(attributes=attributes)
-    product.calculate_stock_quantity(attributes=attributes)
-
-    # Use update to avoid triggering save()
-    product.__class__.objects.filter(pk=product.pk).update(
-        price=product.price,
-        discounted_price=product.discounted_price,
-        discount_amount=product.discount_amount,
-        has_discount=product.has_discount,
-        total_sold=product.total_sold,
-        in_stock=product.in_stock,
-        stock_quantity=product.stock_quantity,
-    )
+    """
+    Product columns, cart items, unpaid order items and rankings follow the attribute,
+    through the outbox (see shop/outbox.py) instead of inside the saving request.
+    """
+    if kwargs['signal'] is post_delete:
+        publish('product', instance.product_id)
+        return
+
+    publish('attribute', instance.pk)
+    # An attribute moved to another product leaves the columns of its old product behind
+    old_product_id = getattr(instance, '_old_product_id', None)
+    if old_product_id is not None and old_product_id != instance.product_id:
+        publish('product', old_product_id)
 
 @receiver([post_save, post_delete], sender=Image)
 def update_product_main_image(sender, instance, **kwargs):
@@ -33,158 +41,125 @@ def update_product_main_image(sender, instance, **kwargs):
     # Trigger main_image update
     product.main_image()
 
-@receiver(post_save, sender=ProductAttribute)
-def update_cart_items(sender, instance, **kwargs):
-    """
-    Update the CartItem instances when a Product is saved.
-    """
-    cart_items = CartItem.objects.filter(product=instance)
-
-    if instance.quantity == 0:
-        cart_items.delete()
-
-    items_to_update = []
+@receiver(post_save, sender=ShippingMethod)
+def update_order_shipping_price_field(sender, instance, **kwargs):
+    """Unpaid orders get the new shipping price through the outbox."""
+    publish('shipping_method', instance.pk)
 
-    for cart_item in cart_items:
-        if instance.quantity < cart_item.quantity:
-            cart_item.quantity = instance.quantity
-            items_to_update.append(cart_item)
+@receiver(post_save, sender=OrderItem)
+def update_order_when_order_item_save(sender, instance, **kwargs):
+    """Order totals are recomputed through the outbox."""
+    publish('order', instance.order_id)
 
-    if items_to_update:
-        CartItem.objects.bulk_update(
-            items_to_update,
-            fields=["quantity", ]
-        )
+@receiver(pre_save, sender=ProductReview)
+def remember_review_rating(sender, instance, **kwargs):
+    instance._old_rating = ProductReview.objects.filter(pk=instance.pk).values_list('review_rating', flat=True).first() \
+        if instance.pk else None
 
-@receiver(post_save, sender=ProductAttribute)
-def update_order_items(sender, instance, **kwargs):
+@receiver([post_save, post_delete], sender=ProductReview)
+def update_product_rates_average_and_number_of_reviews_fields(sender, instance, **kwargs):
     """
-    Update the OrderItem instances when a Product is saved.
-    Uses bulk operations for better performance.
+    Moves the review between the rating histogram buckets of its product in one UPDATE,
+    number_of_reviews and rates_average are derived from the new counts in the same statement.
     """
-    # Get all unpaid order items for this product in a single query
-    order_items = OrderItem.objects.filter(
-        product=instance,
-        order__is_paid=False
-    ).select_related('order')
+    if kwargs['signal'] is post_delete:
+        added, removed = None, int(instance.review_rating)
+    else:
+        added, removed = int(instance.review_rating), getattr(instance, '_old_rating', None)
 
-    if not order_items.exists():
+    if added == removed:
         return
 
-    # Handle zero quantity case - delete all related order items
-    if instance.quantity == 0:
-        order_items.delete()
-        return
+    counts = {}
+    for star, field in Product.RATING_COUNT_FIELDS.items():
+        counts[star] = F(field) + (1 if star == added else 0) - (1 if star == removed else 0)
 
-    # Prepare bulk update data
-    items_to_update = []
-
-    # Update quantity
-    for order_item in order_items:
-        if instance.quantity < order_item.quantity:
-            order_item.quantity = instance.quantity
-            items_to_update.append(order_item)
-        else:
-            items_to_update.append(order_item)
-
-    # Update prices and discounts for all items
-    for order_item in items_to_update:
-        order_item.price = instance.price
-        if instance.discount_active and instance.discount_amount:
-            order_item.discounted_price = instance.discounted_price
-            order_item.discount = instance.discount.discount
-            order_item.discount_active = True
-        else:
-            order_item.discounted_price = None
-            order_item.discount = None
-            order_item.discount_active = False
-
-    if items_to_update:
-        OrderItem.objects.bulk_update(
-            items_to_update,
-            fields=['quantity', 'price', 'discounted_price', 'discount', 'discount_active', ]
-        )
+    number_of_reviews = sum(counts.values(), Value(0))
+    rating_sum = sum((star * count for star, count in counts.items()), Value(0))
 
-@receiver(post_save, sender=ShippingMethod)
-def update_order_shipping_price_field(sender, instance, **kwargs):
+    Product.objects.filter(pk=instance.product_id).update(
+        number_of_reviews=number_of_reviews,
+        rates_average=Cast(rating_sum, FloatField()) / NullIf(number_of_reviews, Value(0)),
+        **{Product.RATING_COUNT_FIELDS[star]: count for star, count in counts.items()},
+    )
 
-    orders = Order.objects.filter(
-        is_paid=False,
-        shipping_method=instance,
-    ).all()
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductAttribute)
+@receiver([post_save, post_delete], sender=Image)
+@receiver([post_save, post_delete], sender=ProductReview)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=SubCategory)
+def invalidate_catalog_response_cache(sender, instance, **kwargs):
+    """Any catalog change moves cached product/category responses to a new cache version."""
+    bump_catalog_cache_version()
 
-    orders_to_update = []
+@receiver(post_save, sender=Product)
+def update_product_ranking_on_product_save(sender, instance, **kwargs):
+    refresh_product_ranking(instance.pk)
 
-    for order in orders:
-        order.shipping_price = instance.price
-        order.calculate_totals()
-        orders_to_update.append(order)
+@receiver([post_save, post_delete], sender=ProductReview)
+def update_product_ranking(sender, instance, **kwargs):
+    """Runs after rates_average was recalculated, attribute changes refresh rankings through the outbox."""
+    refresh_product_ranking(instance.product_id)
+
+@receiver(pre_save, sender=Order)
+def remember_order_paid_status(sender, instance, **kwargs):
+    old = Order.objects.filter(pk=instance.pk).values_list('is_paid', 'status').first() if instance.pk else None
+    instance._was_paid = bool(old and old[0])
+    instance._old_status = old[1] if old else None
+
+@receiver(post_save, sender=Order)
+def add_paid_order_to_trending_scores(sender, instance, **kwargs):
+    """Counts the items of an order towards the trending ranking once, when it gets paid."""
+    if not instance.is_paid or getattr(instance, '_was_paid', True):
+        return
 
-    if orders_to_update:
-        Order.objects.bulk_update(
-            orders_to_update,
-            fields=["shipping_price", "products_total_price", "order_total_discount", "order_total_price", ]
-        )
+    quantities = {}
+    for product_id, quantity in instance.items.values_list('product__product_id', 'quantity'):
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
 
-@receiver(post_save, sender=ProductAttribute)
-def update_order_totals(sender, instance, **kwargs):
-    """
-    Signal handler to update order totals when a ProductAttribute is updated.
-    Only updates unpaid orders.
-    """
-    # Get all unpaid orders that contain this product in a single query
-    orders = Order.objects.filter(
-        is_paid=False,
-        items__product=instance
-    ).prefetch_related('items').distinct()
+    add_sales(quantities)
 
-    if not orders.exists():
+@receiver(post_save, sender=Order)
+def email_order_status(sender, instance, **kwargs):
+    """The customer is emailed through the task queue when the order gets paid, delivered or canceled."""
+    # The first save of a new order has no number yet, Order.save() sets it with a second save
+    if not instance.number:
         return
 
-    orders_to_update = []
-    for order in orders:
-        # Calculate totals using prefetched items
-        order.calculate_totals()
-        orders_to_update.append(order)
-
-    # Bulk update all orders at once
-    if orders_to_update:
-        Order.objects.bulk_update(
-            orders_to_update,
-            fields=["products_total_price", "order_total_discount", "order_total_price"]
-        )
-
-@receiver(post_save, sender=OrderItem)
-def update_order_when_order_item_save(sender, instance, **kwargs):
-    """
-    Signal handler to update order totals when an OrderItem is saved.
-    Uses bulk operations and optimized queries for better performance.
-    """
-    # Get the order with prefetched items to avoid additional queries
-    order = Order.objects.select_related(
-        'shipping_method'
-    ).prefetch_related(
-        'items__product'
-    ).get(pk=instance.order.pk)
-    
-    # Calculate totals
-    order.calculate_totals()
-    
-    # Update order fields directly in database
-    order.__class__.objects.filter(pk=order.pk).update(
-        products_total_price=order.products_total_price,
-        order_total_discount=order.order_total_discount,
-        order_total_price=order.order_total_price
-    )
+    if instance.is_paid and not getattr(instance, '_was_paid', True):
+        subject = f"Order {instance.number} was paid"
+    elif instance.status != getattr(instance, '_old_status', instance.status) \
+            and instance.status != Order.ORDER_STATUS_NOT_DELIVERED:
+        subject = f"Order {instance.number} was {instance.get_status_display().lower()}"
+    else:
+        return
 
-@receiver([post_save, post_delete], sender=ProductReview)
-def update_product_rates_average_and_number_of_reviews_fields(sender, instance, **kwargs):
-    product = instance.product
+    email = instance.user.email
+    if email:
+        send_email.delay(
+            subject=subject,
+            message=f"Hello {instance.receiver_name},\n\n{subject}. Tracking code: {instance.tracking_code or '-'}",
+            recipient_list=[email],
+        )
 
-    reviews = product.reviews.all()
-    product.update_review_stats(reviews=reviews)
+@receiver(pre_save, sender=Comment)
+def remember_comment_status(sender, instance, **kwargs):
+    instance._old_status = Comment.objects.filter(pk=instance.pk).values_list('status', flat=True).first() if instance.pk else None
+
+@receiver([post_save, post_delete], sender=Comment)
+def update_product_approved_comments_count(sender, instance, **kwargs):
+    """Adjusts the denormalized count by +1/-1, bulk moderation adjusts it in moderate_comments."""
+    if kwargs['signal'] is post_delete:
+        was_approved = instance.status == Comment.COMMENT_STATUS_APPROVED
+        is_approved = False
+    else:
+        was_approved = getattr(instance, '_old_status', None) == Comment.COMMENT_STATUS_APPROVED
+        is_approved = instance.status == Comment.COMMENT_STATUS_APPROVED
+
+    if was_approved == is_approved:
+        return
 
-    product.__class__.objects.filter(pk=product.pk).update(
-        number_of_reviews=product.number_of_reviews,
-        rates_average=product.rates_average,
-    )
+    delta = 1 if is_approved else -1
+    Product.objects.filter(pk=instance.product_id).update(approved_comments_count=F('approved_comments_count') + delta)
+    bump_catalog_cache_version()
@@ -0,0 +1,266 @@
+import json
+import logging
+import time
+import traceback
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import send_mass_mail
+from django.db import transaction
+from django.db.models import Count, Exists, F, Min, OuterRef, Q
+from django.utils import timezone
+
+from . import workers
+from .models import Cart, CartItem, IdempotencyKey, Task
+
+
+logger = logging.getLogger('shop.tasks')
+
+STATS_KEY = 'shop:tasks:{name}:{field}'
+STATS_FIELDS = ['succeeded', 'failed', 'runtime_ms', ]
+
+REGISTRY = {}
+
+
+def get_task_settings():
+    return getattr(settings, 'SHOP_TASKS', {})
+
+
+class TaskFunction:
+    """
+    A function that can be queued with `delay` and run later by `manage.py run_tasks`.
+
+    The keyword arguments are stored as JSON, so they have to be JSON serializable. A
+    `batch` task receives the list of keyword arguments of many queued tasks at once.
+    """
+
+    def __init__(self, func, name, priority, max_attempts, batch):
+        self.func = func
+        self.name = name
+        self.priority = priority
+        self.max_attempts = max_attempts
+        self.batch = batch
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def delay(self, **kwargs):
+        return self.enqueue(kwargs)
+
+    def enqueue(self, kwargs, priority=None):
+        """
+        Queues the task in the current transaction, so it only runs if the transaction commits.
+
+        With SHOP_TASKS['EAGER'] it runs right after the commit in this process instead.
+        """
+        if get_task_settings().get('EAGER', False):
+            transaction.on_commit(lambda: self.run_eagerly(kwargs))
+            return None
+
+        return Task.objects.create(
+            name=self.name,
+            kwargs=kwargs,
+            priority=self.priority if priority is None else priority,
+            max_attempts=self.max_attempts,
+        )
+
+    def run_eagerly(self, kwargs):
+        try:
+            if self.batch:
+                self.func([kwargs])
+            else:
+                self.func(**kwargs)
+        except Exception:
+            logger.exception("Task %s failed", self.name)
+
+
+def task(name=None, priority=0, max_attempts=5, batch=False):
+    def decorator(func):
+        task_function = TaskFunction(func, name or func.__name__, priority, max_attempts, batch)
+        REGISTRY[task_function.name] = task_function
+        return task_function
+    return decorator
+
+
+def claim_tasks(batch_size, lease_seconds):
+    """Leases the next `batch_size` available tasks to this worker, highest priority first, see workers.claim."""
+    task_ids = workers.claim(
+        Task.objects.filter(status=Task.STATUS_QUEUED),
+        batch_size,
+        lease_seconds,
+        order_by=('-priority', 'available_at', 'id'),
+    )
+    return list(
+        Task.objects
+        .filter(id__in=task_ids)
+        .order_by('-priority', 'id')
+        .values_list('id', 'name', 'kwargs', 'priority', 'datetime_created')
+    )
+
+
+def group_tasks(tasks, chunk_size):
+    """
+    Turns the claimed tasks into (name, kwargs list, task ids) jobs, highest priority first.
+
+    Identical tasks, same name and arguments, run once. The distinct arguments of a batch
+    task are handed over together in chunks of `chunk_size`, other tasks get a job each.
+    """
+    calls = defaultdict(dict)
+    priorities = {}
+    for task_id, name, kwargs, priority, datetime_created in tasks:
+        key = json.dumps(kwargs, sort_keys=True)
+        calls[name].setdefault(key, (kwargs, []))[1].append(task_id)
+        priorities[name] = max(priority, priorities.get(name, priority))
+
+    jobs = []
+    for name in sorted(calls, key=lambda name: -priorities[name]):
+        task_function = REGISTRY.get(name)
+        distinct_calls = list(calls[name].values())
+
+        if task_function is not None and task_function.batch:
+            for start in range(0, len(distinct_calls), chunk_size):
+                chunk = distinct_calls[start:start + chunk_size]
+                jobs.append((name, [kwargs for kwargs, task_ids in chunk], [i for kwargs, task_ids in chunk for i in task_ids]))
+        else:
+            jobs.extend((name, [kwargs], task_ids) for kwargs, task_ids in distinct_calls)
+    return jobs
+
+
+def run_job(job):
+    """Runs one job, returns its name, task ids, the error, if any, and the run time in seconds."""
+    name, kwargs_list, task_ids = job
+    start = time.perf_counter()
+    try:
+        task_function = REGISTRY[name]
+        if task_function.batch:
+            task_function.func(kwargs_list)
+        else:
+            task_function.func(**kwargs_list[0])
+    except Exception:
+        return name, task_ids, traceback.format_exc(), time.perf_counter() - start
+    return name, task_ids, None, time.perf_counter() - start
+
+
+def acknowledge(task_ids):
+    Task.objects.filter(id__in=task_ids).delete()
+
+
+def retry_later(task_ids, error):
+    """Makes the tasks available again after an exponential backoff, or marks them failed after their last attempt."""
+    max_backoff = get_task_settings().get('MAX_BACKOFF_SECONDS', 3600)
+    tasks = Task.objects.filter(id__in=task_ids)
+
+    tasks.filter(attempts__gte=F('max_attempts') - 1).update(
+        status=Task.STATUS_FAILED,
+        attempts=F('attempts') + 1,
+        last_error=error[-2000:],
+    )
+
+    workers.retry_later(tasks.filter(status=Task.STATUS_QUEUED), error, max_backoff)
+
+
+def record_task_stats(name, succeeded=0, failed=0, runtime=0):
+    """Adds to the throughput counters of `name`, kept in the cache so every worker adds to the same numbers."""
+    values = {'succeeded': succeeded, 'failed': failed, 'runtime_ms': int(runtime * 1000)}
+    for field, value in values.items():
+        if not value:
+            continue
+        key = STATS_KEY.format(name=name, field=field)
+        cache.add(key, 0, timeout=None)
+        try:
+            cache.incr(key, value)
+        except ValueError:
+            cache.set(key, value, timeout=None)
+
+
+def get_task_stats():
+    """Per task name: queued and failed rows, lag of the oldest queued task and the throughput counters."""
+    now = timezone.now()
+    rows = Task.objects\
+        .order_by()\
+        .values('name')\
+        .annotate(
+            queued=Count('id', filter=Q(status=Task.STATUS_QUEUED)),
+            failed_tasks=Count('id', filter=Q(status=Task.STATUS_FAILED)),
+            oldest=Min('datetime_created', filter=Q(status=Task.STATUS_QUEUED)),
+        )
+    stats = {
+        row['name']: {
+            'queued': row['queued'],
+            'failed_tasks': row['failed_tasks'],
+            'lag_seconds': (now - row['oldest']).total_seconds() if row['oldest'] else 0,
+        }
+        for row in rows
+    }
+
+    names = sorted(set(REGISTRY) | set(stats))
+    keys = [STATS_KEY.format(name=name, field=field) for name in names for field in STATS_FIELDS]
+    counters = cache.get_many(keys)
+    for name in names:
+        name_stats = stats.setdefault(name, {'queued': 0, 'failed_tasks': 0, 'lag_seconds': 0})
+        for field in STATS_FIELDS:
+            name_stats[field] = counters.get(STATS_KEY.format(name=name, field=field), 0)
+    return stats
+
+
+def render_task_metrics():
+    stats = get_task_stats()
+    metrics = [
+        ('shop_tasks_queued', 'gauge', 'queued', 'Tasks waiting to run.'),
+        ('shop_tasks_failed', 'gauge', 'failed_tasks', 'Tasks that failed their last attempt.'),
+        ('shop_tasks_lag_seconds', 'gauge', 'lag_seconds', 'Age of the oldest queued task.'),
+        ('shop_tasks_succeeded_total', 'counter', 'succeeded', 'Tasks run successfully.'),
+        ('shop_tasks_runs_failed_total', 'counter', 'failed', 'Failed task runs, retried or not.'),
+        ('shop_tasks_runtime_seconds_total', 'counter', 'runtime_ms', 'Time spent running tasks.'),
+    ]
+
+    lines = []
+    for metric, kind, field, help_text in metrics:
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} {kind}')
+        for name, name_stats in stats.items():
+            value = name_stats[field] / 1000 if field == 'runtime_ms' else name_stats[field]
+            lines.append(f'{metric}{{task="{name}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+@task(priority=-10)
+def purge_stale_carts(days=None, chunk_size=1000):
+    """
+    Deletes the carts without activity for `days` (SHOP_TASKS['CART_MAX_AGE_DAYS']), in chunks.
+
+    Adding or changing items does not touch the Cart row, so a cart is stale when it is
+    older than the cutoff and none of its items was modified since.
+    """
+    if days is None:
+        days = get_task_settings().get('CART_MAX_AGE_DAYS', 30)
+    cutoff = timezone.now() - timedelta(days=days)
+    recent_items = CartItem.objects.filter(cart_id=OuterRef('pk'), datetime_modified__gte=cutoff)
+    stale_carts = Cart.objects.filter(datetime_created__lt=cutoff).exclude(Exists(recent_items))
+
+    while True:
+        cart_ids = list(stale_carts.values_list('pk', flat=True)[:chunk_size])
+        if not cart_ids:
+            return
+        Cart.objects.filter(pk__in=cart_ids).delete()
+
+
+@task(priority=-10)
+def purge_idempotency_keys(chunk_size=1000):
+    """Deletes the expired stored responses of shop.idempotency, in chunks."""
+    while True:
+        key_ids = list(IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).values_list('pk', flat=True)[:chunk_size])
+        if not key_ids:
+            return
+        IdempotencyKey.objects.filter(pk__in=key_ids).delete()
+
+
+@task(priority=10, batch=True)
+def send_email(messages):
+    """Sends the queued emails, each {'subject', 'message', 'recipient_list'}, over one SMTP connection."""
+    send_mass_mail(
+        [(message['subject'], message['message'], None, message['recipient_list']) for message in messages],
+        fail_silently=False,
+    )
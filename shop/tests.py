@@ -1,3 +1,867 @@
-from django.test import TestCase
+from contextvars import ContextVar
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import ANY, MagicMock, Mock, call, patch
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.models import Count, F, QuerySet, Value
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .admin import ProductAttributeAdminForm
+from .db_routers import ReplicaRouter, replica_reads
+from .bulk_updates import apply_discount, recompute_products
+from .management.commands.loadtest import Command as LoadtestCommand
+from .moderation import moderate_comments
+from .outbox import claim_events, coalesce, retry_later
+from .rankings import add_sales, bayesian_rating, get_ranked_product_ids, refresh_product_ranking, refresh_product_rankings
+from .paginations import EstimatedCountPaginator
+from .querylog import record_slow_queries
+from .pricing import adjusted_price, adjusted_price_expression, discounted_price, discounted_price_expression, price_lines
+from .tasks import purge_stale_carts
+from .throttling import CacheWindowStore, LocalBucketStore, local_store
+from .models import Cart, CartItem, Category, Comment, Discount, IdempotencyKey, Order, OutboxEvent, Product,\
+    ProductAttribute, ProductReview, ShippingMethod, SlowQuery, SubCategory, Task, Variable, Wishlist, WishlistItem
+
+
+def create_product(slug='shirt', price=1000, quantity=5):
+    category, _ = Category.objects.get_or_create(slug='clothes', defaults={'title': 'Clothes'})
+    subcategory, _ = SubCategory.objects.get_or_create(slug='shirts', defaults={'title': 'Shirts', 'category': category})
+    variable, _ = Variable.objects.get_or_create(variable_type=Variable.SIZE_TYPE, title='M')
+
+    product = Product.objects.create(
+        title=slug.title(), description='', slug=slug, category=category, subcategory=subcategory,
+    )
+    attribute = ProductAttribute.objects.create(
+        title=f'{slug} M', product=product, variable=variable, price=price, quantity=quantity,
+    )
+    return product, attribute
+
+
+def create_user(username='shopper'):
+    return get_user_model().objects.create_user(username, f'{username}@example.com', 'password')
+
+
+def auth_headers(user):
+    return {'HTTP_AUTHORIZATION': f'JWT {AccessToken.for_user(user)}', 'HTTP_ACCEPT': 'application/json'}
+
+
+class ProductDetailCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product, _ = create_product()
+
+    def test_second_detail_request_is_served_from_the_cache(self):
+        url = f'/shop/products/{self.product.slug}/'
+        first = self.client.get(url, HTTP_ACCEPT='application/json')
+
+        with self.assertNumQueries(0):
+            second = self.client.get(url, HTTP_ACCEPT='application/json')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(first.content, second.content)
+
+
+class SlowQueryMiddlewareTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_failing_to_record_slow_queries_keeps_the_response(self):
+        slow_query_settings = {'ENABLED': True, 'THRESHOLD_MS': 0, 'EXPLAIN': False}
+
+        with override_settings(SHOP_SLOW_QUERIES=slow_query_settings), \
+                patch('shop.middleware.record_slow_queries', side_effect=DatabaseError('read only')), \
+                self.assertLogs('shop.slow_queries', level='ERROR'):
+            response = self.client.get('/shop/categories/', HTTP_ACCEPT='application/json')
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_row_created_by_another_worker_keeps_the_slowest_duration(self):
+        def tracer(duration):
+            query = {'sql': 'SELECT 1', 'params': (), 'duration': duration, 'call_site': 'shop/views.py:1'}
+            return Mock(connection=connection, slow_queries=[query])
+
+        # The first UPDATE misses the row, as if another worker created it right after
+        update = QuerySet.update
+        missed = []
+
+        def update_after_a_miss(queryset, **kwargs):
+            if not missed:
+                missed.append(True)
+                return 0
+            return update(queryset, **kwargs)
+
+        with self.assertLogs('shop.slow_queries', level='WARNING'):
+            record_slow_queries([tracer(0.2)], 'product-list')
+            with patch.object(QuerySet, 'update', autospec=True, side_effect=update_after_a_miss):
+                record_slow_queries([tracer(0.5)], 'product-list')
+
+        slow_query = SlowQuery.objects.get()
+        self.assertEqual((slow_query.count, slow_query.max_duration), (2, 0.5))
+
+
+class VariantFilterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_size_filter_only_matches_in_stock_variants(self):
+        in_stock, attribute = create_product('in-stock')
+        sold_out, _ = create_product('sold-out', quantity=0)
+        recompute_products({in_stock.pk, sold_out.pk})
+
+        response = self.client.get(f'/shop/products/?size={attribute.variable_id}', HTTP_ACCEPT='application/json')
+
+        slugs = [product['slug'] for product in response.json()['results']]
+        self.assertEqual(slugs, ['in-stock'])
+
+    def test_size_filter_ignores_color_ids(self):
+        product, attribute = create_product('red-shirt')
+        red = Variable.objects.create(variable_type=Variable.COLOR_TYPE, title='Red', color_code='#f00')
+        ProductAttribute.objects.filter(pk=attribute.pk).update(variable=red)
+        recompute_products({product.pk})
+
+        by_size = self.client.get(f'/shop/products/?size={red.pk}', HTTP_ACCEPT='application/json')
+        by_color = self.client.get(f'/shop/products/?color={red.pk}', HTTP_ACCEPT='application/json')
+
+        self.assertEqual(by_size.json()['results'], [])
+        self.assertEqual([product['slug'] for product in by_color.json()['results']], ['red-shirt'])
+
+
+class ModerateCommentsTests(TestCase):
+    def test_approved_comments_count_is_recounted(self):
+        user = get_user_model().objects.create_user('reader', 'reader@example.com', 'password')
+        first, _ = create_product('first')
+        second, _ = create_product('second')
+        comments = [
+            Comment.objects.create(user=user, product=product, body='Nice')
+            for product in [first, first, second, ]
+        ]
+
+        moderate_comments(Comment.objects.all(), Comment.COMMENT_STATUS_APPROVED)
+        moderate_comments(Comment.objects.filter(pk=comments[0].pk), Comment.COMMENT_STATUS_NOT_APPROVED)
+
+        counts = dict(Product.objects.values_list('slug', 'approved_comments_count'))
+        self.assertEqual(counts, {'first': 1, 'second': 1})
+
+
+class ProductAttributeAdminActionTests(TestCase):
+    def setUp(self):
+        admin_user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        _, self.attribute = create_product()
+
+    def test_invalid_value_is_reported_and_nothing_changes(self):
+        response = self.client.post('/admin/shop/productattribute/', {
+            'action': 'set_quantity',
+            '_selected_action': [self.attribute.pk],
+            'value': 'many',
+        }, follow=True)
+
+        messages = [str(message) for message in response.context['messages']]
+        self.assertEqual(messages, ['Value: Enter a whole number.'])
+        self.attribute.refresh_from_db()
+        self.assertEqual(self.attribute.quantity, 5)
+
+    def test_valid_value_is_applied(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/admin/shop/productattribute/', {
+                'action': 'set_quantity',
+                '_selected_action': [self.attribute.pk],
+                'value': '3',
+            }, follow=True)
+
+        messages = [str(message) for message in response.context['messages']]
+        self.assertEqual(messages, ['Quantity of 1 attributes was set to 3.'])
+        self.attribute.refresh_from_db()
+        self.assertEqual(self.attribute.quantity, 3)
+
+
+class DiscountScheduleTests(TestCase):
+    def setUp(self):
+        _, self.attribute = create_product()
+
+    def run_schedules(self, *args):
+        call_command('run_discount_schedules', *args, stdout=StringIO())
+        self.attribute.refresh_from_db()
+
+    def test_campaign_starting_within_the_lead_is_switched_on_at_its_start(self):
+        starts_at = timezone.now() + timedelta(seconds=0.5)
+        discount = Discount.objects.create(discount=10, starts_at=starts_at)
+        apply_discount(ProductAttribute.objects.filter(pk=self.attribute.pk), discount)
+
+        self.run_schedules('--lead', '5')
+
+        self.assertTrue(self.attribute.discount_active)
+        self.assertEqual(self.attribute.discounted_price, 900)
+        self.assertGreaterEqual(self.attribute.datetime_modified, starts_at)
+
+    def test_discount_attached_through_the_admin_form_starts_with_its_campaign(self):
+        discount = Discount.objects.create(discount=10, starts_at=timezone.now() + timedelta(days=1))
+        form = ProductAttributeAdminForm(instance=self.attribute, data={
+            'title': self.attribute.title, 'product': self.attribute.product_id, 'variable': self.attribute.variable_id,
+            'price': 1000, 'quantity': 5, 'total_sold': 0, 'discount': discount.pk, 'discount_active': 'on',
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.attribute.refresh_from_db()
+        self.assertFalse(self.attribute.discount_active)
+
+        Discount.objects.filter(pk=discount.pk).update(starts_at=timezone.now() - timedelta(minutes=1))
+        self.run_schedules('--lead', '0')
+
+        self.assertTrue(self.attribute.discount_active)
+        self.assertEqual(self.attribute.discounted_price, 900)
+
+    def test_discount_turned_off_by_hand_stays_off(self):
+        discount = Discount.objects.create(discount=10, starts_at=timezone.now() + timedelta(days=1))
+        apply_discount(ProductAttribute.objects.filter(pk=self.attribute.pk), discount)
+        Discount.objects.filter(pk=discount.pk).update(starts_at=timezone.now() - timedelta(minutes=1))
+        self.run_schedules('--lead', '0')
+        self.assertTrue(self.attribute.discount_active)
+
+        self.attribute.discount_active = False
+        self.attribute.save()
+        self.run_schedules('--lead', '0')
+
+        self.assertFalse(self.attribute.discount_active)
+        self.assertEqual(self.attribute.discount_schedule, ProductAttribute.DISCOUNT_SCHEDULE_NONE)
+
+    def test_ended_campaign_is_switched_off(self):
+        discount = Discount.objects.create(discount=10, starts_at=timezone.now() - timedelta(days=1),
+                                           ends_at=timezone.now() + timedelta(days=1))
+        apply_discount(ProductAttribute.objects.filter(pk=self.attribute.pk), discount)
+        Discount.objects.filter(pk=discount.pk).update(ends_at=timezone.now() - timedelta(minutes=1))
+
+        self.run_schedules('--lead', '0')
+
+        self.assertFalse(self.attribute.discount_active)
+        self.assertIsNone(self.attribute.discounted_price)
+
+
+class PricingTests(TestCase):
+    PRICES = [0, 1, 49, 50, 99, 999, 1005, 1010, 123457, 49999999, ]
+
+    def setUp(self):
+        product, _ = create_product()
+        variable = Variable.objects.get()
+        ProductAttribute.objects.bulk_create([
+            ProductAttribute(title=f'{price}', product=product, variable=variable, price=price)
+            for price in self.PRICES
+        ])
+
+    def sql_prices(self, expression):
+        return dict(ProductAttribute.objects.filter(title__in=[str(price) for price in self.PRICES])
+                                            .annotate(sql_price=expression)
+                                            .values_list('price', 'sql_price'))
+
+    def test_percentages_round_half_up(self):
+        self.assertEqual(discounted_price(1005, 15), 854)
+        self.assertEqual(discounted_price(1010, 15), 859)
+        self.assertEqual(adjusted_price(1010, -15), 859)
+        self.assertEqual(adjusted_price(1000, 10), 1100)
+
+    def test_discounted_price_expression_matches_python(self):
+        for percent in range(0, 101):
+            sql_prices = self.sql_prices(discounted_price_expression(F('price'), Value(percent)))
+            for price, sql_price in sql_prices.items():
+                self.assertEqual(sql_price, discounted_price(price, percent), (price, percent))
+
+    def test_adjusted_price_expression_matches_python(self):
+        for percent in range(-99, 101):
+            sql_prices = self.sql_prices(adjusted_price_expression(F('price'), Value(percent)))
+            for price, sql_price in sql_prices.items():
+                self.assertEqual(sql_price, adjusted_price(price, percent), (price, percent))
+
+    def test_price_lines_totals(self):
+        totals = price_lines([(1000, None, 2), (1005, 854, 3), ])
+
+        self.assertEqual(totals.line_totals, [2000, 2562])
+        self.assertEqual(totals.total_price, 4562)
+        self.assertEqual(totals.total_discount, 453)
+
+
+class TaskWorkerTests(TestCase):
+    def test_tasks_are_run_or_retried_after_a_backoff(self):
+        Task.objects.create(name='purge_idempotency_keys')
+        unknown = Task.objects.create(name='unknown_task')
+
+        call_command('run_tasks', '--once', stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(list(Task.objects.values_list('pk', flat=True)), [unknown.pk])
+        unknown.refresh_from_db()
+        self.assertEqual(unknown.attempts, 1)
+        self.assertIn('KeyError', unknown.last_error)
+        self.assertGreater(unknown.available_at, timezone.now())
+
+
+class PurgeStaleCartsTests(TestCase):
+    def test_carts_with_recently_modified_items_are_kept(self):
+        _, attribute = create_product()
+        old = timezone.now() - timedelta(days=40)
+        active, stale = Cart.objects.create(), Cart.objects.create()
+        # A cart without items goes too
+        Cart.objects.create()
+        CartItem.objects.create(cart=active, product=attribute, quantity=1)
+        CartItem.objects.create(cart=stale, product=attribute, quantity=1)
+        Cart.objects.update(datetime_created=old, datetime_modified=old)
+        CartItem.objects.filter(cart=stale).update(datetime_modified=old)
+
+        purge_stale_carts(days=30)
+
+        self.assertEqual(list(Cart.objects.values_list('pk', flat=True)), [active.pk])
+
+
+class OrderStatusEmailTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user('buyer', 'buyer@example.com', 'password')
+        shipping_method = ShippingMethod.objects.create(shipping_method='Post', price=100, delivery_time=timedelta(days=3))
+        self.order = Order.objects.create(
+            user=user, receiver_name='Sara', receiver_family='Ahmadi', receiver_phone_number='09123456789',
+            receiver_city='Tehran', receiver_address='Street 1', receiver_postal_code='12345',
+            shipping_method=shipping_method,
+        )
+
+    @override_settings(SHOP_TASKS={'EAGER': True})
+    def test_customer_is_emailed_when_the_order_is_delivered(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.status = Order.ORDER_STATUS_DELIVERED
+            self.order.save()
+
+        self.assertEqual([message.subject for message in mail.outbox], [f'Order {self.order.number} was delivered'])
+        self.assertEqual(mail.outbox[0].to, ['buyer@example.com'])
+
+    @override_settings(SHOP_TASKS={'EAGER': False})
+    def test_email_is_queued_for_the_worker(self):
+        self.order.is_paid = True
+        self.order.save()
+        self.order.save()
+
+        self.assertEqual(list(Task.objects.values_list('name', flat=True)), ['send_email'])
+
+
+@override_settings(SHOP_TASKS={'EAGER': False, 'PERIODIC': ['purge_stale_carts', ]})
+class EnqueuePeriodicTasksTests(TestCase):
+    def test_periodic_tasks_are_queued_once(self):
+        call_command('enqueue_periodic_tasks', stdout=StringIO())
+        call_command('enqueue_periodic_tasks', stdout=StringIO())
+
+        self.assertEqual(list(Task.objects.values_list('name', flat=True)), ['purge_stale_carts'])
+
+
+@override_settings(SHOP_TASKS={'EAGER': False, 'PERIODIC': ['purge_idempotency_keys', ]})
+class PurgeIdempotencyKeysTests(TestCase):
+    def test_expired_keys_are_purged_by_the_periodic_task(self):
+        now = timezone.now()
+        IdempotencyKey.objects.create(scope='user:1', key='expired', fingerprint='a', expires_at=now - timedelta(seconds=1))
+        IdempotencyKey.objects.create(scope='user:1', key='fresh', fingerprint='b', expires_at=now + timedelta(hours=1))
+
+        call_command('enqueue_periodic_tasks', stdout=StringIO())
+        call_command('run_tasks', '--once', stdout=StringIO())
+
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['fresh'])
+        self.assertFalse(Task.objects.exists())
+
+
+class LoadtestSeedTests(TestCase):
+    def test_seeded_orders_have_items_and_totals(self):
+        LoadtestCommand(stdout=StringIO()).seed(product_count=5, order_count=3, password='password')
+
+        orders = Order.objects.annotate(items_count=Count('items'))
+        self.assertEqual(orders.count(), 3)
+        for order in orders:
+            self.assertGreater(order.items_count, 0)
+            self.assertGreater(order.order_total_price, 0)
+
+
+@override_settings(SHOP_OUTBOX={'INLINE': False, 'MAX_BACKOFF_SECONDS': 4})
+class OutboxTests(TestCase):
+    def test_events_of_the_same_object_are_coalesced_into_chunks(self):
+        events = [
+            (1, 'product', 10, None),
+            (2, 'product', 10, None),
+            (3, 'product', 11, None),
+            (4, 'product', 12, None),
+            (5, 'order', 7, None),
+        ]
+
+        jobs = coalesce(events, chunk_size=2)
+
+        self.assertEqual(jobs, [('product', [10, 11], [1, 2, 3]), ('product', [12], [4]), ('order', [7], [5])])
+
+    def test_claimed_events_are_leased_until_the_lease_ends(self):
+        event = OutboxEvent.objects.create(topic='product', object_id=1)
+
+        self.assertEqual([row[0] for row in claim_events(10, lease_seconds=60)], [event.pk])
+        self.assertEqual(claim_events(10, lease_seconds=60), [])
+
+        OutboxEvent.objects.update(available_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual([row[0] for row in claim_events(10, lease_seconds=60)], [event.pk])
+
+    def test_failed_events_back_off_exponentially_up_to_the_maximum(self):
+        event = OutboxEvent.objects.create(topic='product', object_id=1)
+
+        delays = []
+        for _ in range(3):
+            before = timezone.now()
+            retry_later([event.pk], 'Traceback: boom')
+            event.refresh_from_db()
+            delays.append(round((event.available_at - before).total_seconds()))
+
+        self.assertEqual(delays, [2, 4, 4])
+        self.assertEqual(event.attempts, 3)
+        self.assertEqual(event.last_error, 'Traceback: boom')
+
+    def test_worker_recomputes_the_products_of_changed_attributes(self):
+        product, attribute = create_product(price=1000)
+        other, _ = create_product('other', price=500)
+        call_command('run_outbox', '--once', stdout=StringIO())
+
+        attribute.price = 2000
+        attribute.save()
+        self.assertEqual(Product.objects.get(pk=product.pk).price, 1000)
+        call_command('run_outbox', '--once', stdout=StringIO())
+        self.assertEqual(Product.objects.get(pk=product.pk).price, 2000)
+
+        attribute.product = other
+        attribute.save()
+        call_command('run_outbox', '--once', stdout=StringIO())
+
+        moved_from = Product.objects.get(pk=product.pk)
+        self.assertIsNone(moved_from.price)
+        self.assertEqual(moved_from.stock_quantity, 0)
+        self.assertEqual(Product.objects.get(pk=other.pk).price, 500)
+        self.assertFalse(OutboxEvent.objects.exists())
+
+
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_store.clear()
+
+    @override_settings(SHOP_REPLICAS={'DATABASES': ['replica', ]})
+    def test_only_allowed_reads_outside_transactions_go_to_a_replica(self):
+        router = ReplicaRouter()
+
+        with patch('shop.db_routers.connections', {'default': Mock(in_atomic_block=False)}):
+            self.assertEqual(router.db_for_read(Product), 'default')
+            token = replica_reads.set(True)
+            try:
+                self.assertEqual(router.db_for_read(Product), 'replica')
+                self.assertEqual(router.db_for_write(Product), 'default')
+            finally:
+                replica_reads.reset(token)
+
+        token = replica_reads.set(True)
+        try:
+            # TestCase runs in a transaction
+            self.assertEqual(router.db_for_read(Product), 'default')
+        finally:
+            replica_reads.reset(token)
+
+    # No router, the test database has no replica, only the routing decision is checked
+    @override_settings(SHOP_REPLICAS={'DATABASES': ['replica', ], 'STICKY_SECONDS': 10}, DATABASE_ROUTERS=[])
+    def test_user_reads_from_the_primary_after_a_write(self):
+        product, _ = create_product()
+        headers = auth_headers(create_user())
+        url = f'/shop/products/{product.slug}/comments/'
+        tracked = Mock(wraps=ContextVar('tracked_replica_reads', default=False))
+
+        with patch('shop.db_routers.replica_reads', tracked):
+            self.client.get(url, **headers)
+            self.assertIn(call(True), tracked.set.call_args_list)
+
+            tracked.reset_mock()
+            self.assertEqual(self.client.post(url, {'body': 'Nice'}, **headers).status_code, 201)
+            self.client.get(url, **headers)
+            self.assertNotIn(call(True), tracked.set.call_args_list)
+
+            # Anonymous readers are not affected by the user's write
+            self.client.get(url, HTTP_ACCEPT='application/json')
+            self.assertIn(call(True), tracked.set.call_args_list)
+
+
+class ProductRankingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_store.clear()
+
+    def stock(self, *products):
+        product_ids = [product.pk for product in products]
+        recompute_products(product_ids)
+        refresh_product_rankings(product_ids)
+
+    def test_best_sellers_skip_sold_out_products(self):
+        shirt, shirt_attribute = create_product('shirt')
+        hat, hat_attribute = create_product('hat', quantity=0)
+        cap, cap_attribute = create_product('cap')
+        for attribute, total_sold in ((shirt_attribute, 3), (hat_attribute, 9), (cap_attribute, 5)):
+            ProductAttribute.objects.filter(pk=attribute.pk).update(total_sold=total_sold)
+        self.stock(shirt, hat, cap)
+
+        response = self.client.get('/shop/products/best-sellers/', HTTP_ACCEPT='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([product['slug'] for product in response.json()], ['cap', 'shirt'])
+
+    def test_trending_favours_recent_sales(self):
+        old, _ = create_product('old')
+        new, _ = create_product('new')
+        self.stock(old, new)
+
+        # Three half lives ago, 10 units weigh as much as 1.25 units today
+        add_sales({old.pk: 10}, when=timezone.now() - timedelta(days=21))
+        add_sales({new.pk: 2})
+
+        self.assertEqual(get_ranked_product_ids('trending', 10), [new.pk, old.pk])
+
+    def test_top_rated_shrinks_averages_with_few_reviews(self):
+        lucky, _ = create_product('lucky')
+        proven, _ = create_product('proven')
+        self.stock(lucky, proven)
+        Product.objects.filter(pk=lucky.pk).update(rates_average=5, number_of_reviews=1)
+        Product.objects.filter(pk=proven.pk).update(rates_average=4.5, number_of_reviews=50)
+        refresh_product_ranking(lucky.pk)
+        refresh_product_ranking(proven.pk)
+
+        self.assertEqual(bayesian_rating(None, None), 3.0)
+        self.assertEqual(get_ranked_product_ids('top_rated', 10), [proven.pk, lucky.pk])
+
+
+class ProductFacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        shirt, self.size = create_product('shirt', price=1000)
+        dress, _ = create_product('dress', price=3000)
+        hat, _ = create_product('hat', quantity=0)
+        self.red = Variable.objects.create(variable_type=Variable.COLOR_TYPE, title='Red', color_code='#f00')
+        ProductAttribute.objects.create(title='dress red', product=dress, variable=self.red, price=3000, quantity=2)
+        recompute_products({shirt.pk, dress.pk, hat.pk})
+
+        Product.objects.filter(pk=shirt.pk).update(rates_average=4.5)
+        Product.objects.filter(pk=dress.pk).update(rates_average=3.2, has_discount=True, discounted_price=2500)
+
+    def get_facets(self, query=''):
+        response = self.client.get(f'/shop/products/?facets=true{query}', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['facets']
+
+    def test_counts_cover_the_whole_listing(self):
+        facets = self.get_facets()
+
+        self.assertEqual(facets['total'], 3)
+        self.assertEqual(facets['price'], {'min': 1000, 'max': 2500})
+        self.assertEqual(facets['has_discount'], 1)
+        self.assertEqual(facets['in_stock'], 2)
+        self.assertEqual(
+            facets['rating'],
+            [{'min_rating': 4, 'count': 1}, {'min_rating': 3, 'count': 2}, {'min_rating': 2, 'count': 2}, {'min_rating': 1, 'count': 2}],
+        )
+        # The sold out hat does not count towards its size
+        self.assertEqual(facets['size'], [{'id': self.size.variable_id, 'title': 'M', 'count': 2}])
+        self.assertEqual(facets['color'], [{'id': self.red.pk, 'title': 'Red', 'count': 1, 'color_code': '#f00'}])
+
+    def test_counts_follow_the_filters(self):
+        facets = self.get_facets('&min_price=2000')
+
+        self.assertEqual(facets['total'], 1)
+        self.assertEqual(facets['price'], {'min': 2500, 'max': 2500})
+        self.assertEqual(facets['size'], [{'id': self.size.variable_id, 'title': 'M', 'count': 1}])
+        self.assertEqual(facets['color'][0]['count'], 1)
+
+
+class RatingHistogramTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product, _ = create_product()
+
+    def get_histogram(self):
+        response = self.client.get(f'/shop/products/{self.product.slug}/rating-histogram/', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_reviews_move_between_buckets(self):
+        first = ProductReview.objects.create(user=create_user('first'), product=self.product, review_rating=5)
+        second = ProductReview.objects.create(user=create_user('second'), product=self.product, review_rating=3)
+
+        data = self.get_histogram()
+        self.assertEqual(data['histogram'], {'1': 0, '2': 0, '3': 1, '4': 0, '5': 1})
+        self.assertEqual((data['rates_average'], data['number_of_reviews']), (4, 2))
+
+        second.review_rating = 4
+        second.save()
+        first.delete()
+
+        data = self.get_histogram()
+        self.assertEqual(data['histogram'], {'1': 0, '2': 0, '3': 0, '4': 1, '5': 0})
+        self.assertEqual((data['rates_average'], data['number_of_reviews']), (4, 1))
+
+    def test_last_review_deleted_clears_the_average(self):
+        review = ProductReview.objects.create(user=create_user(), product=self.product, review_rating=2)
+        review.delete()
+
+        data = self.get_histogram()
+        self.assertEqual(sum(data['histogram'].values()), 0)
+        self.assertEqual((data['rates_average'], data['number_of_reviews']), (None, 0))
+
+
+class ProductReviewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_store.clear()
+        self.product, _ = create_product()
+        self.url = f'/shop/products/{self.product.slug}/reviews/'
+
+    def test_mine_returns_the_users_own_review(self):
+        user = create_user()
+        ProductReview.objects.create(user=create_user('other'), product=self.product, review_rating=2)
+
+        self.assertEqual(self.client.get(f'{self.url}mine/', **auth_headers(user)).status_code, 404)
+        self.assertEqual(self.client.get(f'{self.url}mine/', HTTP_ACCEPT='application/json').status_code, 401)
+
+        review = ProductReview.objects.create(user=user, product=self.product, review_rating=4)
+        response = self.client.get(f'{self.url}mine/', **auth_headers(user))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'id': review.pk, 'user_name': 'shopper', 'review_rating': 4})
+
+    def test_reviews_are_paginated_newest_first(self):
+        reviews = [
+            ProductReview.objects.create(user=create_user(f'reviewer{index}'), product=self.product, review_rating=5)
+            for index in range(21)
+        ]
+
+        first = self.client.get(self.url, HTTP_ACCEPT='application/json').json()
+        second = self.client.get(first['next'], HTTP_ACCEPT='application/json').json()
+
+        self.assertEqual([review['id'] for review in first['results']], [review.pk for review in reviews[:0:-1]])
+        self.assertEqual([review['id'] for review in second['results']], [reviews[0].pk])
+        self.assertIsNone(second['next'])
+
+    def test_cached_first_page_shows_a_new_review(self):
+        self.client.get(self.url, HTTP_ACCEPT='application/json')
+        review = ProductReview.objects.create(user=create_user(), product=self.product, review_rating=3)
+
+        results = self.client.get(self.url, HTTP_ACCEPT='application/json').json()['results']
+        self.assertEqual([result['id'] for result in results], [review.pk])
+
+
+class WishlistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_store.clear()
+        self.headers = auth_headers(create_user())
+        self.product, _ = create_product()
+
+    def test_creating_a_wishlist_twice_returns_the_same_one(self):
+        first = self.client.post('/shop/wishlists/', {}, **self.headers)
+        second = self.client.post('/shop/wishlists/', {}, **self.headers)
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(first.json()['id'], second.json()['id'])
+        self.assertEqual(Wishlist.objects.count(), 1)
+
+    def test_items_are_added_and_removed_idempotently(self):
+        wishlist_id = self.client.post('/shop/wishlists/', {}, **self.headers).json()['id']
+        items_url = f'/shop/wishlists/{wishlist_id}/items/'
+
+        first = self.client.post(items_url, {'product': self.product.pk}, **self.headers)
+        second = self.client.post(items_url, {'product': self.product.pk}, **self.headers)
+        self.assertEqual(first.json()['id'], second.json()['id'])
+        self.assertEqual(WishlistItem.objects.count(), 1)
+
+        contains = self.client.get(f'/shop/wishlists/contains/?products={self.product.pk},0', **self.headers)
+        self.assertEqual(contains.json(), {str(self.product.pk): True, '0': False})
+
+        for _ in range(2):
+            removed = self.client.post(f'{items_url}remove/', {'product': self.product.pk}, **self.headers)
+            self.assertEqual(removed.status_code, 204)
+        self.assertFalse(WishlistItem.objects.exists())
+
+    def test_items_of_another_users_wishlist_are_not_found(self):
+        wishlist_id = self.client.post('/shop/wishlists/', {}, **self.headers).json()['id']
+
+        response = self.client.post(
+            f'/shop/wishlists/{wishlist_id}/items/', {'product': self.product.pk}, **auth_headers(create_user('other')),
+        )
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(WishlistItem.objects.exists())
+
+
+class ShopperStateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_store.clear()
+        self.user = create_user()
+        self.shirt, medium = create_product('shirt')
+        self.hat, _ = create_product('hat')
+        large = ProductAttribute.objects.create(
+            title='shirt L', product=self.shirt, variable=Variable.objects.create(variable_type=Variable.SIZE_TYPE, title='L'),
+            price=1000, quantity=5,
+        )
+
+        wishlist = Wishlist.objects.create(user=self.user)
+        WishlistItem.objects.create(wish_list=wishlist, product=self.hat)
+        self.cart = Cart.objects.create()
+        CartItem.objects.create(cart=self.cart, product=medium, quantity=1)
+        CartItem.objects.create(cart=self.cart, product=large, quantity=2)
+
+    def get_state(self, headers):
+        response = self.client.get(f'/shop/products/?expand=in_wishlist,in_cart_quantity&cart={self.cart.pk}', **headers)
+        self.assertEqual(response.status_code, 200)
+        return {product['slug']: (product['in_wishlist'], product['in_cart_quantity']) for product in response.json()['results']}
+
+    def test_products_are_marked_for_the_user_and_cart(self):
+        self.assertEqual(self.get_state(auth_headers(self.user)), {'shirt': (False, 3), 'hat': (True, 0)})
+
+    def test_anonymous_and_other_users_do_not_see_the_wishlist(self):
+        self.get_state(auth_headers(self.user))
+
+        self.assertEqual(self.get_state({'HTTP_ACCEPT': 'application/json'}), {'shirt': (False, 3), 'hat': (False, 0)})
+        self.assertEqual(self.get_state(auth_headers(create_user('other'))), {'shirt': (False, 3), 'hat': (False, 0)})
+
+    def test_invalid_cart_id_is_rejected(self):
+        response = self.client.get('/shop/products/?expand=in_cart_quantity&cart=nope', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    def setUp(self):
+        product, _ = create_product()
+        for index in range(3):
+            Comment.objects.create(user=create_user(f'commenter{index}'), product=product, body='Nice')
+        # Changelists are ordered
+        self.comments = Comment.objects.order_by('-pk')
+
+    def test_large_estimates_replace_the_count(self):
+        paginator = EstimatedCountPaginator(self.comments, 20)
+
+        with patch.object(EstimatedCountPaginator, 'get_estimate', return_value=250000), self.assertNumQueries(0):
+            self.assertEqual(paginator.count, 250000)
+
+    def test_small_estimates_fall_back_to_an_exact_count(self):
+        paginator = EstimatedCountPaginator(self.comments, 20)
+
+        with patch.object(EstimatedCountPaginator, 'get_estimate', return_value=50):
+            self.assertEqual(paginator.count, 3)
+
+    def test_estimate_is_read_from_the_planner_statistics(self):
+        connection = MagicMock(vendor='postgresql')
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (250000, )
+
+        with patch('shop.paginations.connections', {'default': connection}):
+            self.assertEqual(EstimatedCountPaginator(self.comments, 20).get_estimate(), 250000)
+            # A filtered changelist needs the exact count
+            self.assertIsNone(EstimatedCountPaginator(self.comments.filter(body='Nice'), 20).get_estimate())
+
+        cursor.execute.assert_called_once_with(ANY, [Comment._meta.db_table])
+        # SQLite has no cheap estimate
+        self.assertIsNone(EstimatedCountPaginator(self.comments, 20).get_estimate())
+
+
+class WriteBudgetThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_store.clear()
+
+    def test_local_bucket_refills_over_time(self):
+        store = LocalBucketStore()
+
+        self.assertEqual([store.take('key', 2, 1, 0)[0] for _ in range(3)], [True, True, False])
+        self.assertEqual(store.take('key', 2, 1, 0.5), (False, 0.5))
+        self.assertEqual(store.take('key', 2, 1, 1.5), (True, 0))
+        # The bucket does not fill beyond its capacity while idle
+        self.assertEqual([store.take('key', 2, 1, 100)[0] for _ in range(3)], [True, True, False])
+
+    def test_cache_window_weights_the_previous_window(self):
+        store = CacheWindowStore()
+
+        self.assertEqual([store.take('key', 2, 2, 10.0)[0] for _ in range(3)], [True, True, False])
+        # Half of the full previous window still counts
+        self.assertEqual([store.take('key', 2, 2, 11.5)[0] for _ in range(2)], [True, False])
+
+    @override_settings(SHOP_THROTTLE={'BUDGETS': {'comments': {'capacity': 1, 'rate': '1/hour'}}})
+    def test_writes_over_budget_are_rejected_but_replays_are_not(self):
+        product, _ = create_product()
+        headers = auth_headers(create_user())
+        url = f'/shop/products/{product.slug}/comments/'
+
+        first = self.client.post(url, {'body': 'Nice'}, HTTP_IDEMPOTENCY_KEY='first', **headers)
+        replayed = self.client.post(url, {'body': 'Nice'}, HTTP_IDEMPOTENCY_KEY='first', **headers)
+        rejected = self.client.post(url, {'body': 'Again'}, **headers)
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(replayed.status_code, 201)
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+        self.assertEqual(rejected.status_code, 429)
+        self.assertEqual(rejected['Retry-After'], '3600')
+        # Reads are never throttled
+        self.assertEqual(self.client.get(url, **headers).status_code, 200)
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_store.clear()
+        self.user = create_user()
+        self.headers = auth_headers(self.user)
+        self.product, _ = create_product()
+        self.url = f'/shop/products/{self.product.slug}/comments/'
+
+    def post(self, body, key='retry-1'):
+        return self.client.post(self.url, {'body': body}, HTTP_IDEMPOTENCY_KEY=key, **self.headers)
+
+    def test_retry_replays_the_stored_response(self):
+        first = self.post('Nice')
+        retried = self.post('Nice')
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual((retried.status_code, retried.json()), (201, first.json()))
+        self.assertEqual(retried['Idempotent-Replayed'], 'true')
+        self.assertEqual(Comment.objects.count(), 1)
+
+    def test_key_reused_for_a_different_request_is_rejected(self):
+        self.post('Nice')
+
+        self.assertEqual(self.post('Something else').status_code, 422)
+        self.assertEqual(Comment.objects.count(), 1)
+
+    def test_retry_while_the_first_request_runs_is_a_conflict(self):
+        IdempotencyKey.objects.create(
+            scope=f'user:{self.user.pk}', key='retry-1', fingerprint='', expires_at=timezone.now() + timedelta(hours=1),
+        )
+
+        self.assertEqual(self.post('Nice').status_code, 409)
+        self.assertFalse(Comment.objects.exists())
+
+    def test_failed_requests_are_not_stored(self):
+        self.assertEqual(self.post('').status_code, 400)
+
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.post('Nice').status_code, 201)
+
+
+class MetricsEndpointTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    @override_settings(SHOP_METRICS={'ALLOWED_IPS': [], 'TOKEN': 'scraper-token'})
+    def test_scrapers_need_an_allowed_address_or_the_token(self):
+        self.assertEqual(self.client.get('/shop/metrics/').status_code, 403)
+        self.assertEqual(self.client.get('/shop/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+        response = self.client.get('/shop/metrics/', HTTP_AUTHORIZATION='Bearer scraper-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'shop_request_non_sql_seconds', response.content)
+
+    @override_settings(SHOP_METRICS={'ALLOWED_IPS': ['127.0.0.1', ], 'TOKEN': ''})
+    def test_allowed_address_needs_no_token(self):
+        self.assertEqual(self.client.get('/shop/metrics/').status_code, 200)
+        self.assertEqual(self.client.get('/shop/metrics/', REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
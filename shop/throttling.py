@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import BaseThrottle
+
+
+DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """'30/hour' -> tokens refilled per second, like DRF's SimpleRateThrottle.parse_rate."""
+    count, period = rate.split('/')
+    return int(count) / DURATIONS[period[0]]
+
+
+class LocalBucketStore:
+    """
+    Token buckets in the memory of this process, for a single node.
+
+    Each check is one dict lookup under a lock. The least recently used buckets are dropped
+    past `max_keys`, a dropped bucket simply starts full again.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.max_keys = max_keys
+
+    def take(self, key, capacity, refill_rate, now):
+        """Takes one token, returns (allowed, seconds until a token is available)."""
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * refill_rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+
+        return allowed, 0 if allowed else (1 - tokens) / refill_rate
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class CacheWindowStore:
+    """
+    Sliding window counters shared by every node through the cache, with its atomic incr().
+
+    Not a token bucket: the cache has no compare-and-set to update a token count, so a budget
+    allows `capacity` requests per window of `capacity / refill_rate` seconds (the time a
+    bucket takes to refill), the previous window weighted by how much of it overlaps.
+    """
+
+    def take(self, key, capacity, refill_rate, now):
+        window = capacity / refill_rate
+        index, offset = divmod(now, window)
+        current_key = f'shop:throttle:{key}:{int(index)}'
+        previous_key = f'shop:throttle:{key}:{int(index) - 1}'
+        timeout = int(window * 2) + 1
+
+        try:
+            current = cache.incr(current_key)
+        except ValueError:
+            current = 1 if cache.add(current_key, 1, timeout=timeout) else cache.incr(current_key)
+        previous = cache.get(previous_key, 0)
+
+        overlap = 1 - offset / window
+        if previous * overlap + current <= capacity:
+            return True, 0
+
+        # Rejected requests do not use the budget
+        cache.decr(current_key)
+        if current > capacity or not previous:
+            return False, window - offset
+        # The weight of the previous window has to drop by the excess
+        return False, min((previous * overlap + current - capacity) / previous * window, window - offset)
+
+
+local_store = LocalBucketStore()
+cache_store = CacheWindowStore()
+
+
+def get_throttle_settings():
+    return getattr(settings, 'SHOP_THROTTLE', {})
+
+
+class WriteBudgetThrottle(BaseThrottle):
+    """
+    Per user (or per IP for anonymous requests) budget on the writes of a view.
+
+    Views opt in with `throttle_scope`, the budget of each scope is set in
+    SHOP_THROTTLE['BUDGETS'] as a `capacity` (the burst) and a refill `rate`. It is a token
+    bucket with the 'local_bucket' backend and a sliding window with 'cache_window', see
+    the stores above. Safe methods are never throttled.
+    """
+
+    def allow_request(self, request, view):
+        self.wait_seconds = None
+        throttle_settings = get_throttle_settings()
+        scope = getattr(view, 'throttle_scope', None)
+        budget = throttle_settings.get('BUDGETS', {}).get(scope)
+
+        if not throttle_settings.get('ENABLED', True) or budget is None or request.method in SAFE_METHODS:
+            return True
+
+        if request.user and request.user.is_authenticated:
+            ident = f'user:{request.user.pk}'
+        else:
+            ident = f'ip:{self.get_ident(request)}'
+
+        store = cache_store if throttle_settings.get('BACKEND') == 'cache_window' else local_store
+        allowed, self.wait_seconds = store.take(
+            f'{scope}:{ident}', budget['capacity'], parse_rate(budget['rate']), time.time(),
+        )
+        return allowed
+
+    def wait(self):
+        return self.wait_seconds
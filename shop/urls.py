@@ -12,6 +12,7 @@ router.register('carts', views.CartViewSet, basename="cart")
 router.register('orders', views.OrderViewSet, basename='order')
 router.register('addresses', views.AddressViewSet, basename='address')
 router.register('wishlists', views.WishlistViewSet, basename='wishlist')
+router.register('moderation/comments', views.CommentModerationViewSet, basename='comment-moderation')
 
 product_router = routers.NestedDefaultRouter(router, "products", lookup="product")
 product_router.register("comments", views.CommentViewSet, basename="product-comments")
@@ -37,6 +38,7 @@ wishlist_router = routers.NestedDefaultRouter(router, 'wishlists', lookup="wishl
 wishlist_router.register("items", views.WishlistItemViewSet, basename="wishlist-items")
 
 urlpatterns = [
+    path('metrics/', views.metrics, name='metrics'),
     path('', include(router.urls)),
     path('', include(product_router.urls)),
     path('', include(category_router.urls)),
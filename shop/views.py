@@ -1,15 +1,33 @@
-from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, DestroyModelMixin
-from rest_framework.permissions import IsAuthenticated
+from hmac import compare_digest
+from uuid import UUID
+
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, ListModelMixin
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet, GenericViewSet, ModelViewSet
 
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Q, Prefetch
-from django.http import Http404
-
+from django.db.models import Q, Prefetch, OuterRef, Subquery, Count, Exists, Sum, Value
+from django.db.models.functions import Coalesce
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+
+from .caching import CachedResponseMixin
+from .db_routers import ReplicaRoutingMixin
+from .facets import get_product_facets
 from .filters import InStockOrderingFilter
+from .metrics import registry
 from .filters import ProductsFilter
-from .paginations import CustomPagination
+from .idempotency import IdempotencyMixin
+from .rankings import get_ranked_product_ids
+from .moderation import moderate_comments
+from .outbox import render_outbox_metrics
+from .tasks import render_task_metrics
+from .paginations import CustomPagination, OrderCursorPagination, CommentCursorPagination, ModerationCursorPagination,\
+    ReviewCursorPagination
 from .permissions import IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly
 from .models import Product,\
     ProductAttribute,\
@@ -24,6 +42,7 @@ from .models import Product,\
     OrderItem,\
     Wishlist,\
     WishlistItem
+from .serializers import split_query_param
 from .serializers import\
     ProductSerializer,\
     ProductDetailSerializer,\
@@ -35,29 +54,53 @@ from .serializers import\
     ChangeCartItemSerializer,\
     CommentSerializer,\
     AddCommentSerializer,\
+    ModerationCommentSerializer,\
+    CommentModerationSerializer,\
     ProductReviewSerializer,\
     AddProductReviewSerializer,\
     AddressSerializer,\
     OrderSerializer,\
+    OrderListSerializer,\
     OrderItemSerializer,\
     WishlistSerializer,\
     WishlistCreateSerializer,\
     WishlistItemSerializer,\
-    AddWishlistItemSerializer
+    AddWishlistItemSerializer,\
+    WishlistMembershipSerializer,\
+    RemoveWishlistItemSerializer,\
+    ProductCardSerializer
+
+
+class SparseFieldsetMixin:
+    """
+    Loads only the columns needed by the fields the client asked for with ?fields=/?expand=.
+    The serializer class must use DynamicFieldsMixin.
+    """
+    def get_selected_serializer(self):
+        if not hasattr(self, '_selected_serializer'):
+            self._selected_serializer = self.get_serializer()
+        return self._selected_serializer
+
+    def get_selected_fields(self):
+        return self.get_selected_serializer().fields
+
+    def prune_queryset(self, queryset):
+        return queryset.only(*self.get_selected_serializer().get_model_columns())
 
 
 # checked
-class ProductViewSet(ReadOnlyModelViewSet):
-    serializer_class = ProductSerializer
+class ProductViewSet(ReplicaRoutingMixin, CachedResponseMixin, SparseFieldsetMixin, ReadOnlyModelViewSet):
     pagination_class = CustomPagination
+    read_from_replica = True
+    # Fields that depend on the user or cart, responses with them are never shared through the cache
+    shopper_fields = {'in_wishlist', 'in_cart_quantity', }
     filter_backends  = [DjangoFilterBackend, InStockOrderingFilter, ] 
     filterset_class  = ProductsFilter
     ordering_fields  = ['price', 'title', 'datetime_created', 'total_sold', ]
     lookup_field = 'slug'
 
     def get_queryset(self):
-        queryset = Product.objects\
-            .prefetch_related(Prefetch("attributes", queryset=ProductAttribute.objects.select_related("discount").all()), "images")\
+        queryset = self.prefetch_selected(Product.objects.all())\
             .order_by("-datetime_created", "-in_stock")\
             .all()\
 
@@ -71,28 +114,153 @@ class ProductViewSet(ReadOnlyModelViewSet):
 
         return queryset
 
+    def get_serializer_class(self):
+        if self.action == "retrieve":
+            return ProductDetailSerializer
+
+        return ProductSerializer
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+
+        # ?facets=true adds the counts of the filtered products per price, stock, rating, size and color
+        if self.request.query_params.get('facets') in ('1', 'true', 'True', ):
+            response.data['facets'] = get_product_facets(self.filter_queryset(self.get_queryset()))
+
+        return response
+
+    def get_sticky_keys(self):
+        sticky_keys = super().get_sticky_keys()
+        cart_id = self.get_cart_id()
+        if cart_id:
+            sticky_keys.append(f'shop:primary:cart:{cart_id}')
+        return sticky_keys
+
+    def should_cache_response(self, request):
+        query_params = request.query_params
+        selected = {*split_query_param(query_params.get('fields')), *split_query_param(query_params.get('expand'))}
+        return super().should_cache_response(request) and not self.shopper_fields & selected
+
+    def get_cart_id(self):
+        """The cart of ?cart=<uuid>, used for in_cart_quantity."""
+        cart_id = self.request.query_params.get('cart')
+        if not cart_id:
+            return None
+        try:
+            return UUID(cart_id)
+        except ValueError:
+            raise ValidationError({'cart': 'Must be a valid cart id.'})
+
+    def prefetch_selected(self, queryset):
+        """Prunes columns and only prefetches the relations the selected fields render."""
+        fields = self.get_selected_fields()
+        queryset = self.prune_queryset(queryset)
+
+        if "attributes" in fields or "default_attribute" in fields:
+            queryset = queryset.prefetch_related(Prefetch("attributes", queryset=ProductAttribute.objects.select_related("variable")))
+        if "images" in fields:
+            queryset = queryset.prefetch_related("images")
+
+        return self.annotate_shopper_state(queryset, fields)
+
+    def annotate_shopper_state(self, queryset, fields):
+        """
+        ?expand=in_wishlist,in_cart_quantity&cart=<uuid> marks the products the user saved
+        or put in the cart with one correlated subquery each, evaluated for the current page only.
+        """
+        if "in_wishlist" in fields:
+            user_id = self.request.user.id
+            if user_id:
+                queryset = queryset.annotate(in_wishlist=Exists(
+                    WishlistItem.objects.filter(wish_list__user_id=user_id, product_id=OuterRef('pk'))
+                ))
+            else:
+                queryset = queryset.annotate(in_wishlist=Value(False))
+
+        if "in_cart_quantity" in fields:
+            cart_id = self.get_cart_id()
+            if cart_id:
+                cart_quantities = CartItem.objects\
+                    .filter(cart_id=cart_id, product__product_id=OuterRef('pk'))\
+                    .values('product__product_id')\
+                    .annotate(total=Sum('quantity'))\
+                    .values('total')
+                queryset = queryset.annotate(in_cart_quantity=Coalesce(Subquery(cart_quantities), 0))
+            else:
+                queryset = queryset.annotate(in_cart_quantity=Value(0))
+
+        return queryset
+
     def retrieve(self, request, *args, **kwargs):
+        response = self.get_cached_response(request)
+        if response is not None:
+            return response
+
         product = self.get_object_or_404(kwargs.get("slug"))
         
-        data = ProductDetailSerializer(product).data
+        data = self.get_serializer(product).data
 
         return Response(data)
 
     def get_object_or_404(self, slug):
         try:
-            return Product.objects.select_related("category", "subcategory", )\
-                .prefetch_related(Prefetch("comments", queryset=Comment.objects.select_related("user")), 
-                                  Prefetch("attributes", queryset=ProductAttribute.objects.select_related("variable")),
-                                  "images")\
-                .get(slug=slug)
+            return self.prefetch_selected(Product.objects.all()).get(slug=slug)
         except Product.DoesNotExist:
             raise Http404("Product not found.")
 
+    def ranked_products(self, ranking):
+        """Serves a precomputed top-N ranking, ?limit= up to 50 products."""
+        try:
+            limit = min(int(self.request.query_params.get('limit', 20)), 50)
+        except ValueError:
+            limit = 20
+
+        product_ids = get_ranked_product_ids(
+            ranking,
+            limit,
+            category_slug=self.kwargs.get('category__slug'),
+            subcategory_slug=self.kwargs.get('subcategory__slug'),
+        )
+        products = self.prefetch_selected(Product.objects.all()).in_bulk(product_ids)
+
+        serializer = self.get_serializer([products[pk] for pk in product_ids if pk in products], many=True)
+        return Response(serializer.data)
+
+    @action(detail=True, url_path='rating-histogram')
+    def rating_histogram(self, request, *args, **kwargs):
+        try:
+            product = Product.objects\
+                .only('rates_average', 'number_of_reviews', *Product.RATING_COUNT_FIELDS.values())\
+                .get(slug=kwargs.get("slug"))
+        except Product.DoesNotExist:
+            raise Http404("Product not found.")
+
+        return Response({
+            "rates_average": product.rates_average,
+            "number_of_reviews": product.number_of_reviews or 0,
+            "histogram": product.rating_histogram(),
+        })
+
+    @action(detail=False, url_path='best-sellers')
+    def best_sellers(self, request, *args, **kwargs):
+        return self.ranked_products('best_sellers')
+
+    @action(detail=False, url_path='top-rated')
+    def top_rated(self, request, *args, **kwargs):
+        return self.ranked_products('top_rated')
+
+    @action(detail=False)
+    def trending(self, request, *args, **kwargs):
+        return self.ranked_products('trending')
+
 
 # checked
-class CommentViewSet(ModelViewSet):
+class CommentViewSet(ReplicaRoutingMixin, IdempotencyMixin, ModelViewSet):
     http_method_names = ["get", "post", "head", "options", ]
     permission_classes = [IsAuthenticatedOrReadOnly, ]
+    throttle_scope = 'comments'
+    pagination_class = CommentCursorPagination
+    read_from_replica = True
 
     def get_queryset(self):
         queryset = Comment.objects.select_related("user").all()
@@ -110,20 +278,60 @@ class CommentViewSet(ModelViewSet):
         return CommentSerializer
 
 
+class CommentModerationViewSet(ReplicaRoutingMixin, ListModelMixin, GenericViewSet):
+    """Queue of waiting comments for staff, moderated in bulk with POST moderate/."""
+    permission_classes = [IsAdminUser, ]
+    pagination_class = ModerationCursorPagination
+
+    def get_queryset(self):
+        queryset = Comment.objects.select_related("user", "product").filter(status=Comment.COMMENT_STATUS_WAITING)
+        product_id = self.request.query_params.get("product")
+        if product_id:
+            return queryset.filter(product_id=product_id)
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action == "moderate":
+            return CommentModerationSerializer
+
+        return ModerationCommentSerializer
+
+    @action(detail=False, methods=["post"])
+    def moderate(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        queryset = Comment.objects.all()
+        if data.get("ids"):
+            queryset = queryset.filter(pk__in=data["ids"])
+        if data["all_waiting"]:
+            queryset = queryset.filter(status=Comment.COMMENT_STATUS_WAITING)
+        if data.get("product"):
+            queryset = queryset.filter(product_id=data["product"])
+
+        updated = moderate_comments(queryset, data["status"])
+        return Response({"updated": updated})
+
+
 # checked
-class CategoryViewSet(ReadOnlyModelViewSet):
-    queryset = Category.objects.prefetch_related("products").all()
+class CategoryViewSet(ReplicaRoutingMixin, CachedResponseMixin, SparseFieldsetMixin, ReadOnlyModelViewSet):
     serializer_class = CategorySerializer
+    read_from_replica = True
     lookup_field = 'slug'
 
+    def get_queryset(self):
+        return self.prune_queryset(Category.objects.all())
+
 
 # checked
-class SubCategoryViewSet(ReadOnlyModelViewSet):
+class SubCategoryViewSet(ReplicaRoutingMixin, CachedResponseMixin, SparseFieldsetMixin, ReadOnlyModelViewSet):
     serializer_class = SubCategorySerializer
+    read_from_replica = True
     lookup_field = 'slug'
 
     def get_queryset(self):
-        queryset = SubCategory.objects.all()
+        queryset = self.prune_queryset(SubCategory.objects.all())
         category_slug = self.kwargs.get('category__slug')
 
         if category_slug:
@@ -133,7 +341,7 @@ class SubCategoryViewSet(ReadOnlyModelViewSet):
 
 
 # checked
-class AddressViewSet(ModelViewSet):
+class AddressViewSet(ReplicaRoutingMixin, IdempotencyMixin, ModelViewSet):
     http_method_names = ['get', 'post', 'patch', 'delete', 'options', 'head', ]
     permission_classes = [IsAuthenticated, ]
     serializer_class = AddressSerializer
@@ -149,22 +357,31 @@ class AddressViewSet(ModelViewSet):
 
 
 # checked
-class CartViewSet(CreateModelMixin, DestroyModelMixin, RetrieveModelMixin, GenericViewSet):
+class CartViewSet(ReplicaRoutingMixin, IdempotencyMixin, CreateModelMixin, DestroyModelMixin, RetrieveModelMixin, GenericViewSet):
+    throttle_scope = 'carts'
     queryset = Cart.objects.prefetch_related(Prefetch(
         "items",
         queryset = CartItem.objects.select_related('product__variable', 'product__product').all()))\
         .all()
     serializer_class = CartSerializer
 
+    def get_sticky_keys(self):
+        cart_pk = self.kwargs.get('pk')
+        return [f'shop:primary:cart:{cart_pk}'] if cart_pk else []
+
     def get_serializer_context(self):
         request = self.request
         return {'request': request}
 
 
 # checked
-class CartItemViewSet(ModelViewSet):
+class CartItemViewSet(ReplicaRoutingMixin, IdempotencyMixin, ModelViewSet):
+    throttle_scope = 'cart_items'
     http_method_names = ['get', 'post', 'patch', 'delete', 'options', 'head', ]
 
+    def get_sticky_keys(self):
+        return [f"shop:primary:cart:{self.kwargs['cart_pk']}"]
+
     def get_queryset(self):
         queryset = CartItem.objects.select_related('product__variable', 'product__product').all()
         cart_pk = self.kwargs['cart_pk']
@@ -183,21 +400,39 @@ class CartItemViewSet(ModelViewSet):
 
 
 # checked
-class OrderViewSet(ModelViewSet):
+class OrderViewSet(ReplicaRoutingMixin, ModelViewSet):
     http_method_names = ['get', 'delete', 'options', 'head', ]
     permission_classes = [IsAuthenticated, ]
-    serializer_class = OrderSerializer
+    pagination_class = OrderCursorPagination
 
     def get_queryset(self):
+        user_id = self.request.user.id
+
+        if self.action == "list":
+            first_item = OrderItem.objects.filter(order_id=OuterRef("pk")).order_by("id")
+            items_count = OrderItem.objects.filter(order_id=OuterRef("pk"))\
+                .values("order_id")\
+                .annotate(count=Count("id"))\
+                .values("count")
+            return Order.objects\
+                .filter(user_id=user_id)\
+                .annotate(items_count=Coalesce(Subquery(items_count), 0),
+                          first_item_image=Subquery(first_item.values("product__product__image")[:1]))
+
         queryset = Order.objects.select_related("shipping_method")\
             .prefetch_related(Prefetch("items", OrderItem.objects.select_related("product__variable", "product__product").all()))\
             .all()
-        user_id = self.request.user.id
         return queryset.filter(user_id=user_id)
 
+    def get_serializer_class(self):
+        if self.action == "list":
+            return OrderListSerializer
+
+        return OrderSerializer
+
 
 # checked
-class OrderItemViewSet(ModelViewSet):
+class OrderItemViewSet(ReplicaRoutingMixin, ModelViewSet):
     http_method_names = ['get', 'options', 'head', ]
     permission_classes = [IsAuthenticated, ]
     serializer_class = OrderItemSerializer
@@ -209,10 +444,18 @@ class OrderItemViewSet(ModelViewSet):
 
 
 # checked
-class ProductReviewViewSet(ModelViewSet):
+class ProductReviewViewSet(ReplicaRoutingMixin, CachedResponseMixin, IdempotencyMixin, ModelViewSet):
     http_method_names = ["get", "post", "delete", "head", "options", ]
     serializer_class = ProductReviewSerializer
     permission_classes = [IsOwnerOrReadOnly, ]
+    throttle_scope = 'reviews'
+    pagination_class = ReviewCursorPagination
+    read_from_replica = True
+    cache_actions = ["list", ]
+
+    def should_cache_response(self, request):
+        # Only first pages are cached, review signals move the catalog cache version
+        return super().should_cache_response(request) and "cursor" not in request.query_params
 
     def get_queryset(self):
         product_slug = self.kwargs["product_slug"]
@@ -230,14 +473,37 @@ class ProductReviewViewSet(ModelViewSet):
 
         return ProductReviewSerializer
 
+    @action(detail=False, url_path="mine", permission_classes=[IsAuthenticated, ])
+    def my_review(self, request, *args, **kwargs):
+        review = ProductReview.objects\
+            .select_related("user")\
+            .filter(product__slug=self.kwargs["product_slug"], user_id=request.user.id)\
+            .first()
+
+        if review is None:
+            raise Http404("You have not rated this product.")
+
+        return Response(ProductReviewSerializer(review).data)
+
 
 # checked
-class WishlistViewSet(ModelViewSet):
+class WishlistViewSet(ReplicaRoutingMixin, IdempotencyMixin, ModelViewSet):
     http_method_names = ['get', 'post', 'delete', 'options', 'head', ]
     permission_classes = [IsAuthenticated, ]
-    queryset = Wishlist.objects.prefetch_related(Prefetch("items", queryset=WishlistItem.objects.select_related("product").all())).all()
+
+    def get_queryset(self):
+        items = WishlistItem.objects\
+            .select_related('product')\
+            .only('id', 'wish_list_id', *[f'product__{field}' for field in ProductCardSerializer.Meta.fields])
+        return Wishlist.objects\
+            .filter(user_id=self.request.user.id)\
+            .prefetch_related(Prefetch("items", queryset=items))\
+            .all()
 
     def get_serializer_class(self):
+        if self.action == "contains":
+            return WishlistMembershipSerializer
+
         if self.request.method == "POST":
             return WishlistCreateSerializer
         
@@ -246,9 +512,23 @@ class WishlistViewSet(ModelViewSet):
     def get_serializer_context(self):
         return {'user_id': self.request.user.id}
 
+    @action(detail=False, methods=['get'])
+    def contains(self, request):
+        """Which of ?products=1,2,3 are in the user's wish list, in one query."""
+        serializer = self.get_serializer(data={'products': split_query_param(request.query_params.get('products'))})
+        serializer.is_valid(raise_exception=True)
+        product_ids = serializer.validated_data['products']
+
+        saved_ids = set(
+            WishlistItem.objects
+            .filter(wish_list__user_id=request.user.id, product_id__in=product_ids)
+            .values_list('product_id', flat=True)
+        )
+        return Response({str(product_id): product_id in saved_ids for product_id in product_ids})
+
 
 # checked
-class WishlistItemViewSet(ModelViewSet):
+class WishlistItemViewSet(ReplicaRoutingMixin, IdempotencyMixin, ModelViewSet):
     http_method_names = ['get', 'post', 'delete', 'options', 'head', ]
     permission_classes = [IsAuthenticated, ]
     serializer_class = WishlistItemSerializer
@@ -259,10 +539,47 @@ class WishlistItemViewSet(ModelViewSet):
 
     def get_queryset(self):
         wishlist_pk = self.kwargs['wishlist_pk']
-        return WishlistItem.objects.select_related('product').filter(wish_list_id=wishlist_pk).all()
+        return WishlistItem.objects\
+            .select_related('product')\
+            .only('id', 'wish_list_id', *[f'product__{field}' for field in ProductCardSerializer.Meta.fields])\
+            .filter(wish_list_id=wishlist_pk, wish_list__user_id=self.request.user.id)\
+            .all()
 
     def get_serializer_class(self):
+        if self.action == "remove":
+            return RemoveWishlistItemSerializer
+
         if self.request.method == "POST":
             return AddWishlistItemSerializer
 
         return WishlistItemSerializer
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        # Items can only be read or written through the user's own wish list
+        if not Wishlist.objects.filter(pk=kwargs['wishlist_pk'], user_id=request.user.id).exists():
+            raise Http404
+
+    @action(detail=False, methods=['post'])
+    def remove(self, request, wishlist_pk=None):
+        """Removes a product from the wish list, succeeds whether or not it was there."""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        WishlistItem.objects.filter(wish_list_id=wishlist_pk, product_id=serializer.validated_data['product']).delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+def metrics(request):
+    """Prometheus scrape endpoint, open to SHOP_METRICS['ALLOWED_IPS'], its TOKEN and staff users."""
+    metrics_settings = getattr(settings, 'SHOP_METRICS', {})
+    allowed_ips = metrics_settings.get('ALLOWED_IPS', [])
+    token = metrics_settings.get('TOKEN')
+    has_token = bool(token) and compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+    if request.META.get('REMOTE_ADDR') not in allowed_ips and not has_token and not request.user.is_staff:
+        return HttpResponseForbidden()
+
+    body = registry.render(metrics_settings.get('SAMPLE_RATE', 1.0)) + render_outbox_metrics() + render_task_metrics()
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
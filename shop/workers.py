@@ -0,0 +1,107 @@
+import multiprocessing
+import time
+from datetime import timedelta
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import F, Min
+from django.utils import timezone
+
+
+# The queue tables of shop/outbox.py and shop/tasks.py share this worker: rows are leased
+# by moving their `available_at` forward, and failed rows come back after a backoff.
+
+
+def claim(queryset, batch_size, lease_seconds, order_by=('id', )):
+    """
+    Leases the next `batch_size` available rows of `queryset` to this worker, returns their ids.
+
+    Rows locked by another worker are skipped where the database supports it. A row whose
+    worker dies before finishing becomes available again when the lease ends, so every
+    row is handled at least once.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        row_ids = list(
+            queryset
+            .select_for_update(skip_locked=True)
+            .filter(available_at__lte=now)
+            .order_by(*order_by)
+            .values_list('id', flat=True)[:batch_size]
+        )
+        queryset.model.objects.filter(id__in=row_ids).update(available_at=now + timedelta(seconds=lease_seconds))
+    return row_ids
+
+
+def retry_later(queryset, error, max_backoff):
+    """Makes the rows of `queryset` available again after an exponential backoff."""
+    attempts = (queryset.aggregate(attempts=Min('attempts'))['attempts'] or 0) + 1
+    queryset.update(
+        attempts=F('attempts') + 1,
+        last_error=error[-2000:],
+        available_at=timezone.now() + timedelta(seconds=min(2 ** attempts, max_backoff)),
+    )
+
+
+def init_worker():
+    # Forked children must not share the parent's database connections
+    django.setup()
+    connections.close_all()
+
+
+class WorkerCommand(BaseCommand):
+    """
+    Claims batches in a loop and runs their jobs, in a pool of processes with --processes.
+
+    Subclasses set the defaults and implement `run_batch(pool, options)`, which returns
+    the number of rows it claimed.
+    """
+    default_batch_size = 100
+    default_lease_seconds = 60
+    chunk_help = "Items per job handed to a process."
+    once_help = "Run until nothing is left and exit."
+
+    def get_worker_settings(self):
+        return {}
+
+    def add_arguments(self, parser):
+        worker_settings = self.get_worker_settings()
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=worker_settings.get('BATCH_SIZE', self.default_batch_size))
+        parser.add_argument('--chunk-size', type=int, default=100, help=self.chunk_help)
+        parser.add_argument('--lease', type=int, default=worker_settings.get('LEASE_SECONDS', self.default_lease_seconds))
+        parser.add_argument('--idle-sleep', type=float, default=1.0)
+        parser.add_argument('--once', action='store_true', help=self.once_help)
+
+    def handle(self, *args, **options):
+        if options['processes'] > 1 and connections['default'].vendor == 'sqlite':
+            self.stderr.write("SQLite allows a single writer, running with one process.")
+            options['processes'] = 1
+
+        pool = None
+        if options['processes'] > 1:
+            connections.close_all()
+            pool = multiprocessing.Pool(options['processes'], initializer=init_worker)
+
+        try:
+            while True:
+                claimed = self.run_batch(pool, options)
+                if not claimed:
+                    if options['once']:
+                        return
+                    time.sleep(options['idle_sleep'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def run_batch(self, pool, options):
+        raise NotImplementedError
+
+    def map_jobs(self, pool, func, jobs, ordered=False):
+        if pool is None:
+            return map(func, jobs)
+        return pool.imap(func, jobs) if ordered else pool.imap_unordered(func, jobs)